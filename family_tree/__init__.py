@@ -3,24 +3,19 @@ import os
 
 from logging.handlers import RotatingFileHandler
 
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-
+import click
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
-from flask_bcrypt import Bcrypt
-from flask_migrate import Migrate
-from sqlalchemy import text
 
 from family_tree.config import Config
+from family_tree.database import RoutingSession
 
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 bcrypt = Bcrypt()
 login_manager = LoginManager()
-migrate = Migrate()
 
 def create_app(config_class = Config):
     app = Flask(__name__)
@@ -29,12 +24,23 @@ def create_app(config_class = Config):
     app.config.from_object(config_class)
 
     # Initialize extensions with app
+    from family_tree.database import configure_engines, init_database
+    configure_engines(app)
     db.init_app(app)
+    init_database(app, db)
+
+    from family_tree.writes import init_write_queue
+    init_write_queue(app, db)
     bcrypt.init_app(app)
     login_manager.init_app(app)
-    migrate.init_app(app, db)
+    init_migrate(app)
     init_logging(app)
 
+    from family_tree.cache import init_cache
+    from family_tree.templating import init_templating
+    init_cache(app)
+    init_templating(app)
+
     # Set up login manager
     login_manager.login_view = 'common.login'
     login_manager.login_message_category = 'info'
@@ -43,11 +49,14 @@ def create_app(config_class = Config):
     @login_manager.user_loader
     def load_user(user_id):
         from family_tree.models import User
-        return User.query.get(int(user_id))
+        user = User.query.get(int(user_id))
+        # Deleted users are logged out straight away
+        return user if user is not None and user.deleted_at is None else None
 
     # Import models so they are registered with SQLAlchemy
     from family_tree.models import (
         User, 
+        Family,
         GenderEnum,
         Person,
         Address,
@@ -55,13 +64,20 @@ def create_app(config_class = Config):
         ImportantDates,
         ContactDetails,
         RelativesTypeEnum,
-        Relatives
+        Relatives,
+        Ancestry,
+        DerivedRelationEnum,
+        DerivedRelative,
+        DuplicateCandidate,
+        DataVersion,
+        TreeLayout,
+        JobStatusEnum,
+        Job
     )
 
-    # Enable foreign keys on SQLite
-    @app.before_request
-    def _enable_foreign_keys():
-        db.session.execute(text('PRAGMA foreign_keys = ON'))
+    # Import listeners so writes bump data versions and evict snapshots
+    import family_tree.services.versions
+    import family_tree.services.snapshot
 
     # Register blueprints
     from family_tree.routes.common import bp as common_bp
@@ -70,9 +86,45 @@ def create_app(config_class = Config):
     app.register_blueprint(user_bp)
     from family_tree.routes.admin import bp as admin_bp
     app.register_blueprint(admin_bp)
+    from family_tree.routes.tree import bp as tree_bp
+    app.register_blueprint(tree_bp)
+    from family_tree.routes.jobs import bp as jobs_bp
+    app.register_blueprint(jobs_bp)
+
+    # Compress responses; must follow the blueprints so the static view is wrapped
+    from family_tree.compression import init_compression
+    init_compression(app)
+
+    # Register CLI commands
+    from family_tree.commands import register_commands
+    register_commands(app)
 
     return app
 
+def init_migrate(app):
+    """
+    Flask-Migrate imports alembic, which takes about as long as the rest
+    of the app, and only the `flask db` commands use it, so it is only
+    set up when the app is created by the flask command line.
+    """
+    if click.get_current_context(silent=True) is None:
+        return
+    from flask_migrate import Migrate
+    # SQLite cannot alter columns in place; batch mode recreates the table
+    Migrate(app, db, render_as_batch=True)
+
+def reset_after_fork(app):
+    """
+    Drop the database connections a worker inherited from the preloaded
+    master. Sharing a SQLite connection across processes corrupts it, so
+    each worker must open its own. The cache backends reconnect by
+    themselves when they notice the pid changed.
+    """
+    with app.app_context():
+        # Every bind has its own pool: the writer, the reader and the snapshot copy
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
 def init_logging(app):
     # Only configure logging if not already configured
     if not app.debug and not app.testing:
@@ -0,0 +1,210 @@
+"""
+Online backup and restore of the SQLite database.
+
+Backups use SQLite's backup API, which copies the database page by page
+while the app keeps running. Each step copies BACKUP_PAGES_PER_STEP pages
+and then sleeps, so writers are only held up for one step at a time
+instead of for a whole file copy, and the copy is always consistent.
+A write between two steps restarts the copy from the first page, so
+after BACKUP_MAX_RESTARTS restarts the database is copied again in a
+single step, which always finishes. Copies are gzip compressed into BACKUP_DIR and
+the oldest are pruned.
+
+The family graph (relations, ancestry, families) lives in the same
+database, so one backup covers it.
+"""
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy.engine import make_url
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where there is one process anyway
+    fcntl = None
+
+BACKUP_PREFIX = 'site-'
+BACKUP_SUFFIX = '.db.gz'
+
+
+def database_path(config):
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        raise ValueError('Backups need a SQLite database file')
+    return url.database
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _step_progress(sleep, max_restarts):
+    """
+    Backup progress callback that sleeps between steps, which the backup
+    API itself only does while the database is busy, and aborts the copy
+    once it has been restarted more than max_restarts times by other
+    connections' writes.
+    """
+    state = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        if state['remaining'] is not None and remaining >= state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > max_restarts:
+                raise _TooManyRestarts()
+        state['remaining'] = remaining
+        if remaining and sleep:
+            time.sleep(sleep)
+    return progress
+
+
+def _copy_database(source_path, target_path, pages, sleep, max_restarts=0):
+    """
+    Copy a database with the backup API. Returns False when the copy in
+    steps kept being restarted and was finished in a single step instead.
+    """
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        try:
+            source.backup(target, pages=pages, sleep=sleep,
+                          progress=_step_progress(sleep, max_restarts))
+            return True
+        except _TooManyRestarts:
+            source.backup(target, pages=-1)
+            return False
+    finally:
+        target.close()
+        source.close()
+
+
+def _check_integrity(path):
+    connection = sqlite3.connect(path)
+    try:
+        result = connection.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        connection.close()
+    if result != 'ok':
+        raise ValueError(f'Backup {path} is corrupt: {result}')
+
+
+def list_backups(config):
+    """
+    Backup paths, newest first.
+    """
+    directory = config['BACKUP_DIR']
+    if not os.path.isdir(directory):
+        return []
+    names = sorted((name for name in os.listdir(directory)
+                    if name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX)),
+                   reverse=True)
+    return [os.path.join(directory, name) for name in names]
+
+
+def create_backup(config, logger=None):
+    """
+    Write a compressed copy of the live database to BACKUP_DIR and prune
+    all but the newest BACKUP_KEEP. Returns the backup path.
+    """
+    directory = config['BACKUP_DIR']
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    path = os.path.join(directory, f'{BACKUP_PREFIX}{stamp}{BACKUP_SUFFIX}')
+
+    with tempfile.TemporaryDirectory(dir=directory) as workdir:
+        copy_path = os.path.join(workdir, 'site.db')
+        stepped = _copy_database(database_path(config), copy_path,
+                                 config['BACKUP_PAGES_PER_STEP'], config['BACKUP_STEP_SLEEP'],
+                                 config['BACKUP_MAX_RESTARTS'])
+        if not stepped and logger:
+            logger.warning(f'Backup restarted more than {config["BACKUP_MAX_RESTARTS"]} times '
+                           'by concurrent writes, copied it in one step')
+        partial_path = path + '.part'
+        with open(copy_path, 'rb') as source, \
+                gzip.open(partial_path, 'wb', compresslevel=config['BACKUP_COMPRESS_LEVEL']) as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        os.replace(partial_path, path)
+
+    for old_path in list_backups(config)[config['BACKUP_KEEP']:]:
+        os.remove(old_path)
+    if logger:
+        logger.info(f'Backed up database to {path}')
+    return path
+
+
+def restore_backup(config, path, logger=None):
+    """
+    Replace the live database with a backup. The backup is checked
+    first, then copied in with the backup API in a single step, so other
+    connections see either the old or the restored database.
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as workdir:
+        copy_path = os.path.join(workdir, 'site.db')
+        with gzip.open(path, 'rb') as source, open(copy_path, 'wb') as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        _check_integrity(copy_path)
+        _copy_database(copy_path, database_path(config), -1, 0)
+    if logger:
+        logger.info(f'Restored database from {path}')
+
+
+class BackupScheduler:
+    """
+    Back up every BACKUP_INTERVAL seconds on a daemon thread.
+
+    Every gunicorn worker tries to start one after it is forked; a lock
+    file in BACKUP_DIR lets only the first run, and it is released when
+    that worker exits, so the next worker forked takes over.
+    """
+
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_file = None
+
+    def _lock(self):
+        if fcntl is None:
+            return True
+        os.makedirs(self.config['BACKUP_DIR'], exist_ok=True)
+        lock_file = open(os.path.join(self.config['BACKUP_DIR'], 'scheduler.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def start(self):
+        """
+        Start the thread unless another process runs a scheduler already.
+        Returns whether it was started.
+        """
+        if not self._lock():
+            return False
+        self._thread = threading.Thread(target=self._run, name='backup-scheduler', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _run(self):
+        while not self._stop.wait(self.config['BACKUP_INTERVAL']):
+            try:
+                create_backup(self.config, self.logger)
+            except Exception as error:
+                self.logger.error(f'Scheduled backup failed: {error}')
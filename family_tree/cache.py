@@ -0,0 +1,405 @@
+"""
+Pluggable cache backends shared by the services.
+
+The backend is chosen with the CACHE_TYPE setting:
+
+- 'lru': in-process LRU with TTL, one per worker
+- 'sqlite': a SQLite file (memory mapped, WAL) shared by every worker on the host
+- 'redis': any server speaking the Redis protocol, shared across hosts
+- 'null': caching disabled
+
+Values are pickled, so anything picklable can be cached, but cache plain
+data rather than ORM objects.
+"""
+import functools
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from flask import current_app
+from flask_sqlalchemy import SQLAlchemy
+from werkzeug.local import LocalProxy
+
+
+class BaseCache:
+    """
+    Common interface of all backends. Keys are strings, ttl is in seconds
+    and None means the backend default (0 for no expiry).
+    """
+
+    def __init__(self, default_ttl=300):
+        self.default_ttl = default_ttl
+
+    def _ttl(self, ttl):
+        return self.default_ttl if ttl is None else ttl
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def incr(self, key):
+        """
+        Atomically increment an integer counter that never expires.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+
+class NullCache(BaseCache):
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def incr(self, key):
+        return 0
+
+    def clear(self):
+        pass
+
+
+class LRUCache(BaseCache):
+    """
+    In-process cache bounded by entry count, with per-entry expiry.
+
+    Counters are kept apart and never evicted, since losing a tag counter
+    would bring back results cached under an old version.
+    """
+
+    def __init__(self, max_entries=1024, default_ttl=300):
+        super().__init__(default_ttl)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self._ttl(ttl)
+        with self._lock:
+            self._counters.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + ttl if ttl else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._counters.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters.get(key, 0) + 1
+            self._counters[key] = value
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache stored in a SQLite file so every worker process on the host
+    shares entries. Reads go through a memory mapped file and WAL lets
+    readers run alongside the single writer.
+
+    The table is kept to about max_entries rows: every few writes the
+    expired entries are deleted, then the oldest written ones beyond the
+    limit. Entries without expiry, the tag counters, are never evicted,
+    since losing one would bring back results cached under an old version.
+    """
+
+    def __init__(self, path, default_ttl=300, max_entries=1024, mmap_size=64 * 1024 * 1024):
+        super().__init__(default_ttl)
+        self.path = path
+        self.max_entries = max_entries
+        self.mmap_size = mmap_size
+        # Trim every so many writes of this process rather than on each one
+        self.trim_interval = max(1, max_entries // 16)
+        self._writes = 0
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache '
+                '(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)')
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires and expires < time.time():
+            self.delete(key)
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self._ttl(ttl)
+        self._connection().execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+            (key, pickle.dumps(value), time.time() + ttl if ttl else None))
+        self._writes += 1
+        if self._writes >= self.trim_interval:
+            self._writes = 0
+            self.trim()
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def incr(self, key):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            value = (pickle.loads(row[0]) if row else 0) + 1
+            connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, NULL)',
+                (key, pickle.dumps(value)))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return value
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+
+    def purge_expired(self):
+        self._connection().execute(
+            'DELETE FROM cache WHERE expires IS NOT NULL AND expires < ?', (time.time(),))
+
+    def trim(self):
+        """
+        Delete the expired entries, then the oldest written entries until
+        at most max_entries are left. REPLACE gives a rewritten entry a new
+        rowid, so rowid order is write order.
+        """
+        self.purge_expired()
+        self._connection().execute(
+            'DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache WHERE expires IS NOT NULL '
+            'ORDER BY rowid LIMIT max(0, (SELECT count(*) FROM cache) - ?))', (self.max_entries,))
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisCache(BaseCache):
+    """
+    Minimal client for servers speaking the Redis protocol (RESP), so no
+    client library is needed. Counters are stored as plain integers so
+    INCR works; every other value is pickled.
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', default_ttl=300, prefix='family_tree:',
+                 timeout=2):
+        super().__init__(default_ttl)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.database = int(parsed.path.lstrip('/') or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._local.sock = sock
+        self._local.reader = sock.makefile('rb')
+        self._local.pid = os.getpid()
+        if self.password:
+            self._send('AUTH', self.password)
+        if self.database:
+            self._send('SELECT', self.database)
+
+    def _read(self):
+        line = self._local.reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by cache server')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise RedisError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._local.reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            return None if length < 0 else [self._read() for _ in range(length)]
+        raise RedisError(f'Unexpected reply {line!r}')
+
+    def _send(self, *args):
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self._local.sock.sendall(b''.join(parts))
+        return self._read()
+
+    def execute(self, *args):
+        # Reconnect once on a dropped connection or after a fork
+        if getattr(self._local, 'sock', None) is None or self._local.pid != os.getpid():
+            self._connect()
+        try:
+            return self._send(*args)
+        except (ConnectionError, OSError):
+            self._connect()
+            return self._send(*args)
+
+    def _decode(self, data):
+        if data is None:
+            return None
+        if data.lstrip(b'-').isdigit():
+            return int(data)
+        return pickle.loads(data)
+
+    def get(self, key):
+        return self._decode(self.execute('GET', self.prefix + key))
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [self._decode(data) for data in self.execute('MGET', *[self.prefix + key for key in keys])]
+
+    def set(self, key, value, ttl=None):
+        ttl = self._ttl(ttl)
+        args = ['SET', self.prefix + key, pickle.dumps(value)]
+        if ttl:
+            args += ['PX', int(ttl * 1000)]
+        self.execute(*args)
+
+    def delete(self, key):
+        self.execute('DEL', self.prefix + key)
+
+    def incr(self, key):
+        return self.execute('INCR', self.prefix + key)
+
+    def clear(self):
+        cursor = '0'
+        while True:
+            cursor, keys = self.execute('SCAN', cursor, 'MATCH', self.prefix + '*', 'COUNT', 500)
+            cursor = cursor.decode() if isinstance(cursor, bytes) else cursor
+            if keys:
+                self.execute('DEL', *keys)
+            if cursor == '0':
+                break
+
+
+def create_cache(config):
+    cache_type = config.get('CACHE_TYPE', 'lru')
+    ttl = config.get('CACHE_DEFAULT_TTL', 300)
+    if cache_type == 'lru':
+        return LRUCache(config.get('CACHE_MAX_ENTRIES', 1024), ttl)
+    if cache_type == 'sqlite':
+        return SQLiteCache(config['CACHE_PATH'], ttl, config.get('CACHE_MAX_ENTRIES', 1024))
+    if cache_type == 'redis':
+        return RedisCache(config['CACHE_URL'], ttl)
+    if cache_type == 'null':
+        return NullCache(ttl)
+    raise ValueError(f'Unknown CACHE_TYPE {cache_type}')
+
+
+def init_cache(app):
+    app.extensions['cache'] = create_cache(app.config)
+
+
+cache = LocalProxy(lambda: current_app.extensions['cache'])
+
+
+def _tag_key(tag):
+    return f'tag:{tag}'
+
+
+def invalidate_tags(*tags):
+    """
+    Invalidate every cached result carrying one of the tags. Tags are
+    versioned, so old entries are simply never read again and expire.
+    """
+    for tag in tags:
+        cache.incr(_tag_key(tag))
+
+
+def cached(ttl=None, tags=()):
+    """
+    Cache the result of a service function.
+
+    The key is built from the function name and its arguments, skipping
+    the db argument, plus the current version of each tag. `tags` is a
+    tuple of strings or a callable taking the function's arguments and
+    returning one.
+    """
+    def decorator(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key_args = [arg for arg in args if not isinstance(arg, SQLAlchemy)]
+            func_tags = tags(*args, **kwargs) if callable(tags) else tags
+            versions = cache.get_many([_tag_key(tag) for tag in func_tags])
+            key = f'{name}:{key_args!r}:{sorted(kwargs.items())!r}:{[v or 0 for v in versions]!r}'
+
+            value = cache.get(key)
+            if value is None:
+                value = func(*args, **kwargs)
+                cache.set(key, value, ttl)
+            return value
+
+        wrapper.uncached = func
+        return wrapper
+    return decorator
@@ -0,0 +1,234 @@
+import click
+
+from flask.cli import with_appcontext
+
+
+@click.command('rebuild-ancestry')
+@with_appcontext
+def rebuild_ancestry_command():
+    """
+    Rebuild the ancestry closure table from the relatives table.
+    """
+    from family_tree import db
+    from family_tree.services.ancestry import rebuild_ancestry
+
+    count = rebuild_ancestry(db)
+    click.echo(f'Rebuilt ancestry table with {count} rows.')
+
+
+@click.command('rebuild-families')
+@with_appcontext
+def rebuild_families_command():
+    """
+    Recompute the family (connected component) of every user.
+    """
+    from family_tree import db
+    from family_tree.services.family import rebuild_families
+
+    count = rebuild_families(db)
+    click.echo(f'Rebuilt {count} families.')
+
+
+@click.command('rebuild-derived')
+@with_appcontext
+def rebuild_derived_command():
+    """
+    Rebuild the derived relations (grandparents, cousins, in-laws, ...).
+    """
+    from family_tree import db
+    from family_tree.services.derived import rebuild_derived_relatives
+
+    count = rebuild_derived_relatives(db)
+    click.echo(f'Rebuilt derived relations table with {count} rows.')
+
+
+@click.command('rebuild-graph-index')
+@with_appcontext
+def rebuild_graph_index_command():
+    """
+    Rebuild the memory mapped index of the relatives graph.
+    """
+    from family_tree import db
+    from family_tree.graph_index import rebuild_graph_index
+
+    count = rebuild_graph_index(db)
+    if count is None:
+        raise click.ClickException('GRAPH_INDEX_PATH is not set.')
+    click.echo(f'Rebuilt graph index with {count} edges.')
+
+
+@click.command('backfill-month-days')
+@with_appcontext
+def backfill_month_days_command():
+    """
+    Fill in important_dates.month_day where bulk writes left it empty.
+    """
+    from family_tree import db
+    from family_tree.services.events import backfill_month_days
+
+    count = backfill_month_days(db)
+    click.echo(f'Backfilled month_day of {count} dates.')
+
+
+@click.command('import-relatives')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Validate the file without importing it.')
+@with_appcontext
+def import_relatives_command(path, dry_run):
+    """
+    Import relations from a CSV or JSON file.
+    """
+    from family_tree import db
+    from family_tree.services.imports import import_relatives, read_relative_rows
+
+    with open(path, encoding='utf-8-sig') as relatives_file:
+        try:
+            rows = read_relative_rows(relatives_file, path)
+        except ValueError as error:
+            raise click.ClickException(str(error))
+    result = import_relatives(db, rows, dry_run=dry_run)
+    for error in result['errors']:
+        click.echo(f'Row {error["row"]}: {error["error"]}', err=True)
+    verb = 'Validated' if dry_run else 'Imported'
+    click.echo(f'{verb} {result["imported"]} relations, {len(result["errors"])} rows rejected.')
+
+
+@click.command('import-gedcom')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def import_gedcom_command(path):
+    """
+    Import individuals and families from a GEDCOM file.
+    """
+    from family_tree import db
+    from family_tree.services.gedcom import import_gedcom
+
+    with open(path, 'rb') as gedcom_file:
+        result = import_gedcom(db, gedcom_file)
+    click.echo(f'Imported {result["individuals"]} individuals, {result["families"]} families '
+               f'and {result["relations"]} relations.')
+
+
+@click.command('export-gedcom')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@with_appcontext
+def export_gedcom_command(path):
+    """
+    Export every user and family to a GEDCOM 5.5.1 file.
+    """
+    from family_tree import db
+    from family_tree.services.gedcom import iter_gedcom
+
+    with open(path, 'w', encoding='utf-8') as gedcom_file:
+        for chunk in iter_gedcom(db):
+            gedcom_file.write(chunk)
+    click.echo(f'Exported family tree to {path}.')
+
+
+@click.command('precompile-templates')
+@with_appcontext
+def precompile_templates_command():
+    """
+    Compile every template into the bytecode cache.
+    """
+    from flask import current_app
+    from family_tree.templating import precompile_templates
+
+    count = precompile_templates(current_app)
+    click.echo(f'Precompiled {count} templates.')
+
+
+@click.command('compress-static')
+@with_appcontext
+def compress_static_command():
+    """
+    Write precompressed .gz/.br copies of the static files.
+    """
+    from flask import current_app
+    from family_tree.compression import compress_static
+
+    count = compress_static(current_app.static_folder)
+    click.echo(f'Wrote {count} compressed static files.')
+
+
+@click.command('backup-db')
+@with_appcontext
+def backup_db_command():
+    """
+    Write a compressed online backup of the database.
+    """
+    from flask import current_app
+    from family_tree.backup import create_backup
+
+    path = create_backup(current_app.config, current_app.logger)
+    click.echo(f'Backed up database to {path}.')
+
+
+@click.command('restore-db')
+@click.argument('path', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.confirmation_option(prompt='This replaces the current database. Continue?')
+@with_appcontext
+def restore_db_command(path):
+    """
+    Restore the database from a backup, the newest one by default.
+    """
+    from flask import current_app
+    from family_tree import db
+    from family_tree.backup import list_backups, restore_backup
+    from family_tree.cache import cache
+    from family_tree.graph_index import rebuild_graph_index
+
+    if path is None:
+        backups = list_backups(current_app.config)
+        if not backups:
+            raise click.ClickException('No backups found.')
+        path = backups[0]
+    restore_backup(current_app.config, path, current_app.logger)
+    # Cached pages and snapshots describe the replaced database
+    cache.clear()
+    for engine in db.engines.values():
+        engine.dispose()
+    # So is the graph index every worker maps
+    rebuild_graph_index(db)
+    db.session.remove()
+    click.echo(f'Restored database from {path}.')
+
+
+@click.command('run-jobs')
+@click.option('--workers', default=None, type=int, help='Number of worker threads.')
+@with_appcontext
+def run_jobs_command(workers):
+    """
+    Run background jobs in the foreground until interrupted.
+    """
+    import time
+    from flask import current_app
+    from family_tree import db
+    from family_tree.jobs import JobWorkerPool
+
+    config = current_app.config
+    pool = JobWorkerPool(current_app._get_current_object(), db,
+                         workers or config['JOBS_WORKERS'], config['JOBS_POLL_INTERVAL'])
+    pool.start()
+    click.echo(f'Running {pool.size} job workers, press Ctrl+C to stop.')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+def register_commands(app):
+    app.cli.add_command(rebuild_ancestry_command)
+    app.cli.add_command(rebuild_families_command)
+    app.cli.add_command(rebuild_derived_command)
+    app.cli.add_command(rebuild_graph_index_command)
+    app.cli.add_command(backfill_month_days_command)
+    app.cli.add_command(import_relatives_command)
+    app.cli.add_command(import_gedcom_command)
+    app.cli.add_command(export_gedcom_command)
+    app.cli.add_command(precompile_templates_command)
+    app.cli.add_command(compress_static_command)
+    app.cli.add_command(backup_db_command)
+    app.cli.add_command(restore_db_command)
+    app.cli.add_command(run_jobs_command)
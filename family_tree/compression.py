@@ -0,0 +1,163 @@
+"""
+gzip/brotli response compression.
+
+Dynamic HTML/JSON responses above COMPRESS_MIN_SIZE are compressed in an
+after_request hook. Streamed responses are compressed chunk by chunk with
+a sync flush so every chunk still reaches the client as it is produced.
+Static files are served from precompressed .br/.gz siblings written by
+'flask compress-static'. Brotli is used when the optional brotli package
+is installed.
+"""
+import functools
+import gzip
+import mimetypes
+import os
+import zlib
+
+from flask import request, send_from_directory
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.html', '.json', '.txt', '.map')
+
+
+@functools.lru_cache(maxsize=None)
+def _brotli():
+    """
+    The optional brotli module, imported on first use so app start up does
+    not pay for it, or None when it is not installed.
+    """
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def _accepted_encodings():
+    encodings = []
+    if request.accept_encodings['br'] and _brotli() is not None:
+        encodings.append('br')
+    if request.accept_encodings['gzip']:
+        encodings.append('gzip')
+    return encodings
+
+
+def _compressor(encoding, level):
+    """
+    Return (compress, flush, finish) callables for a streaming encoder.
+    """
+    if encoding == 'br':
+        compressor = _brotli().Compressor(quality=min(level, 11))
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return (compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush)
+
+
+def _compress_stream(chunks, encoding, level):
+    compress, flush, finish = _compressor(encoding, level)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compress(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+def _should_compress(response, config):
+    return (
+        config['COMPRESS_ENABLED']
+        and response.status_code == 200
+        and request.method != 'HEAD'
+        and not response.direct_passthrough
+        and 'Content-Encoding' not in response.headers
+        and response.mimetype in config['COMPRESS_MIMETYPES']
+    )
+
+
+def init_compression(app):
+    config = app.config
+
+    @app.after_request
+    def _compress(response):
+        if not _should_compress(response, config):
+            return response
+        encodings = _accepted_encodings()
+        response.vary.add('Accept-Encoding')
+        if not encodings:
+            return response
+        encoding = encodings[0]
+        level = config['COMPRESS_LEVEL']
+
+        if response.is_streamed:
+            response.response = _compress_stream(response.response, encoding, level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < config['COMPRESS_MIN_SIZE']:
+                return response
+            if encoding == 'br':
+                response.set_data(_brotli().compress(data, quality=min(level, 11)))
+            else:
+                response.set_data(gzip.compress(data, compresslevel=level))
+        response.headers['Content-Encoding'] = encoding
+        # The compressed body is a different representation of the same data
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    static_view = app.view_functions.get('static')
+    if static_view is not None:
+        def static(filename):
+            return _serve_precompressed(app, filename) or static_view(filename=filename)
+        app.view_functions['static'] = static
+
+
+def _serve_precompressed(app, filename):
+    if not app.config['COMPRESS_ENABLED'] or not filename.endswith(COMPRESSIBLE_EXTENSIONS):
+        return None
+    extensions = {'br': '.br', 'gzip': '.gz'}
+    for encoding in _accepted_encodings():
+        compressed = filename + extensions[encoding]
+        if os.path.isfile(os.path.join(app.static_folder, compressed)):
+            response = send_from_directory(app.static_folder, compressed,
+                                           mimetype=_guess_mimetype(filename))
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+
+def _guess_mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def compress_static(static_folder, level=9, min_size=256):
+    """
+    Write .gz (and .br when brotli is installed) siblings for every
+    compressible static file whose compressed copy is missing or older.
+    Returns the number of files written.
+    """
+    written = 0
+    for root, _, files in os.walk(static_folder):
+        for filename in files:
+            if not filename.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as source:
+                data = source.read()
+            if len(data) < min_size:
+                continue
+            targets = [('.gz', lambda data: gzip.compress(data, compresslevel=level, mtime=0))]
+            if _brotli() is not None:
+                targets.append(('.br', lambda data: _brotli().compress(data, quality=11)))
+            for extension, compress in targets:
+                target = path + extension
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+                with open(target, 'wb') as output:
+                    output.write(compress(data))
+                written += 1
+    return written
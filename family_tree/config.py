@@ -9,4 +9,92 @@ class Config:
     SQLALCHEMY_DATABASE_URI = f'sqlite:///{__database_path}'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Reads use a read-only engine, writes a single-connection engine
+    # (see family_tree/database.py). Reports can read a copy of the database.
+    DATABASE_READ_ROUTING = True
+    DATABASE_READ_POOL_SIZE = 8
+    DATABASE_WRITE_TIMEOUT = 30
+    DATABASE_SNAPSHOT_URI = os.getenv('DATABASE_SNAPSHOT_URI')
+    DATABASE_BUSY_TIMEOUT = 5000
 
+    # Online backups (see family_tree/backup.py); an interval of 0 turns
+    # off the scheduled backups
+    BACKUP_DIR = os.getenv('BACKUP_DIR', os.path.join(os.path.dirname(__file__), 'databases', 'backups'))
+    BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', 0))
+    BACKUP_KEEP = 7
+    BACKUP_PAGES_PER_STEP = 256
+    BACKUP_STEP_SLEEP = 0.01
+    BACKUP_MAX_RESTARTS = 3
+    BACKUP_COMPRESS_LEVEL = 6
+
+    # Background jobs (see family_tree/jobs.py), run by JOBS_WORKERS threads
+    # in every gunicorn worker
+    JOBS_EAGER = False
+    JOBS_WORKERS = int(os.getenv('JOBS_WORKERS', 2))
+    JOBS_POLL_INTERVAL = 1.0
+    JOBS_MAX_ATTEMPTS = 3
+    JOBS_RETRY_DELAY = 5
+    JOBS_TIMEOUT = 600
+
+    # Cursor writes go through one writer thread per worker that group
+    # commits them (see family_tree/writes.py)
+    WRITE_QUEUE_ENABLED = True
+    WRITE_QUEUE_MAX_BATCH = 100
+    WRITE_QUEUE_LINGER = 0.0
+    WRITE_QUEUE_RETRIES = 5
+    WRITE_QUEUE_TIMEOUT = 30
+
+    # Cache backend: 'lru' (per process), 'sqlite' (shared by the workers
+    # on a host), 'redis' (shared across hosts) or 'null'
+    CACHE_TYPE = os.getenv('CACHE_TYPE', 'sqlite')
+    CACHE_PATH = os.getenv('CACHE_PATH', os.path.join(os.path.dirname(__file__), 'databases', 'cache.db'))
+    CACHE_URL = os.getenv('CACHE_URL', 'redis://localhost:6379/0')
+    CACHE_DEFAULT_TTL = 300
+    CACHE_MAX_ENTRIES = 1024
+
+    # Compiled templates shared by every worker; None disables it
+    JINJA_BYTECODE_CACHE_DIR = os.getenv(
+        'JINJA_BYTECODE_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'databases', 'jinja_cache'))
+    FRAGMENT_CACHE_ENABLED = True
+    FRAGMENT_CACHE_TTL = 3600
+
+    # gzip/brotli compression of dynamic responses
+    COMPRESS_ENABLED = True
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_LEVEL = 6
+    COMPRESS_MIMETYPES = (
+        'text/html', 'text/css', 'text/csv', 'application/json', 'application/x-ndjson',
+        'application/javascript', 'image/svg+xml', 'text/vnd.familysearch.gedcom')
+
+    # Gunicorn (see gunicorn.conf.py); 0 workers means size from the CPU count
+    GUNICORN_WORKER_CLASS = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+    GUNICORN_WORKERS = int(os.getenv('WEB_CONCURRENCY', 0))
+    GUNICORN_MAX_WORKERS = 8
+    GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', 4))
+    GUNICORN_WORKER_CONNECTIONS = 100
+    GUNICORN_TIMEOUT = 30
+    GUNICORN_MAX_REQUESTS = 1000
+    GUNICORN_MAX_REQUESTS_JITTER = 100
+
+    # Memory mapped index of the relatives graph shared by the workers
+    # (see family_tree/graph_index.py); None turns it off
+    GRAPH_INDEX_PATH = os.getenv(
+        'GRAPH_INDEX_PATH', os.path.join(os.path.dirname(__file__), 'databases', 'graph.idx'))
+
+    # Family tree API
+    TREE_DEFAULT_HOPS = 2
+    TREE_MAX_HOPS = 6
+    TREE_MAX_PATH_HOPS = 12
+    TREE_BATCH_SIZE = 500
+
+    # Duplicate detection (see family_tree/services/duplicates.py); people
+    # sharing a name key more often than DUPLICATES_MAX_BLOCK are skipped
+    DUPLICATES_MIN_SCORE = 0.75
+    DUPLICATES_MAX_BLOCK = 500
+
+    # Largest profile picture upload accepted, before it is resized
+    PICTURE_MAX_BYTES = 5 * 1024 * 1024
+
+    # Upcoming events feed on the user dashboard
+    UPCOMING_EVENTS_DAYS = 30
+    UPCOMING_EVENTS_LIMIT = 10
@@ -1,5 +1,12 @@
+from concurrent import futures
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
 from flask import current_app as app
 
+from family_tree.database import WROTE_KEY
+from family_tree.writes import WriteTimeout
+
 class Cursor:
     def query(self, db, table, *args, filter_by=False, **kwargs):
         """
@@ -14,6 +21,9 @@ class Cursor:
 
         Returns:
         - A query object you can call .all(), .first(), etc.
+
+        The session sends these reads to the read-only engine and the
+        writes below to the writer (see family_tree/database.py).
         """
 
         if filter_by:
@@ -37,9 +47,10 @@ class Cursor:
 
         Commits the new record to the database.
         """
-        new_record = table(**kwargs)
-        db.session.add(new_record)
-        db.session.commit()
+        def add_record(session):
+            session.add(table(**kwargs))
+
+        self._write(db, add_record)
 
     def update(self, db, table, record_id, **kwargs):
         """
@@ -51,12 +62,14 @@ class Cursor:
             record_id: The primary key of the record to update
             **kwargs: Field values to update (passed to model instance)
         """
-        record = db.session.query(table).filter_by(id=record_id).first()
-        if not record:
-            raise ValueError(f"Record with id {record_id} not found in {table.__tablename__}")
-        for key, value in kwargs.items():
-            setattr(record, key, value)
-        db.session.commit()
+        def update_record(session):
+            record = session.query(table).filter_by(id=record_id).first()
+            if not record:
+                raise ValueError(f"Record with id {record_id} not found in {table.__tablename__}")
+            for key, value in kwargs.items():
+                setattr(record, key, value)
+
+        self._write(db, update_record)
 
     def delete(self, db, table, **kwargs):
         """
@@ -67,9 +80,50 @@ class Cursor:
             table: The SQLAlchemy model class (e.g. User, Order)
             record_id: The primary key of the record to delete
         """
-        records = db.session.query(table).filter_by(**kwargs).all()
-        if not records:
-            app.logger.warning(f"No records found in {table.__tablename__} matching {kwargs}")
-        for record in records:
-            db.session.delete(record)
-        db.session.commit()
+        def delete_records(session):
+            records = session.query(table).filter_by(**kwargs).all()
+            if not records:
+                app.logger.warning(f"No records found in {table.__tablename__} matching {kwargs}")
+            for record in records:
+                session.delete(record)
+
+        self._write(db, delete_records)
+
+    def _write(self, db, mutation):
+        """
+        Apply a mutation and commit it, through the write queue when there
+        is one (see family_tree/writes.py).
+
+        The caller's own uncommitted changes used to be committed along
+        with the record, so while there are any the mutation runs in the
+        caller's session as before.
+
+        Raises WriteTimeout when the queue has not committed the change
+        within WRITE_QUEUE_TIMEOUT seconds, or when the single writer
+        connection stayed busy (a long job, import or merge) for
+        DATABASE_WRITE_TIMEOUT seconds.
+        """
+        write_queue = app.extensions.get('write_queue')
+        session = db.session
+        if write_queue is None or session.new or session.dirty or session.deleted \
+                or session.info.get(WROTE_KEY):
+            try:
+                mutation(session)
+                session.commit()
+            except PoolTimeoutError as error:
+                session.rollback()
+                raise WriteTimeout(f'Writer connection busy: {error}') from error
+            return
+        timeout = app.config['WRITE_QUEUE_TIMEOUT']
+        future = write_queue.submit(mutation)
+        try:
+            future.result(timeout=timeout)
+        except futures.TimeoutError:
+            # Skipped by the writer unless it has started on it already
+            if future.cancel():
+                raise WriteTimeout(f'Write abandoned after waiting {timeout}s')
+            raise WriteTimeout(f'Write not committed after {timeout}s, it may still be')
+        except PoolTimeoutError as error:
+            raise WriteTimeout(f'Writer connection busy: {error}') from error
+        # The writer committed on its own session; reload what this one holds
+        session.expire_all()
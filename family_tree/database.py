@@ -0,0 +1,135 @@
+"""
+Read/write routing of the SQLAlchemy session for SQLite.
+
+With a file database in WAL mode readers never block the writer, so:
+
+- reads go to a read-only engine ('reader', mode=ro and query_only) with
+  its own pool, one connection per thread
+- writes go to the default engine, whose pool holds a single connection
+  so writers queue in the pool instead of fighting over the lock
+- reports can be sent to a copy of the database ('snapshot') with
+  use_bind(db, SNAPSHOT_BIND)
+
+Once a transaction has written, it keeps reading from the writer so it
+sees its own uncommitted changes. Routing is off for in-memory databases.
+"""
+from contextlib import contextmanager
+from functools import partial
+
+from sqlalchemy import Select, event
+from sqlalchemy.engine import make_url
+from flask_sqlalchemy.session import Session
+
+READ_BIND = 'reader'
+SNAPSHOT_BIND = 'snapshot'
+
+# Session.info keys
+ROUTE_KEY = 'bind_route'
+WROTE_KEY = 'bind_wrote'
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        engines = self._db.engines
+        route = self.info.get(ROUTE_KEY)
+        if route is None and READ_BIND in engines:
+            if isinstance(clause, Select) and not self._flushing and not self.info.get(WROTE_KEY):
+                route = READ_BIND
+            else:
+                self.info[WROTE_KEY] = True
+        if route == SNAPSHOT_BIND and route not in engines:
+            route = READ_BIND
+        if route in engines:
+            return engines[route]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _reset_route(session, *args):
+    session.info.pop(WROTE_KEY, None)
+
+
+@contextmanager
+def use_bind(db, route):
+    """
+    Send every statement of the block to the named engine, e.g. to run a
+    report against the snapshot copy.
+    """
+    previous = db.session.info.get(ROUTE_KEY)
+    db.session.info[ROUTE_KEY] = route
+    try:
+        yield
+    finally:
+        db.session.info[ROUTE_KEY] = previous
+
+
+def iter_with_bind(db, route, chunks):
+    """
+    use_bind() for a streamed response, whose body runs after the view
+    has returned.
+    """
+    with use_bind(db, route):
+        yield from chunks
+
+
+def _read_only_url(url):
+    return url.set(database=f'file:{url.database}').update_query_dict({'mode': 'ro', 'uri': 'true'})
+
+
+def configure_engines(app):
+    """
+    Add the reader and snapshot binds to the config. Must run before
+    db.init_app().
+    """
+    config = app.config
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if not config.get('DATABASE_READ_ROUTING') or url.get_backend_name() != 'sqlite' \
+            or url.database in (None, '', ':memory:'):
+        return
+    binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+    binds[READ_BIND] = {'url': _read_only_url(url),
+                        'pool_size': config['DATABASE_READ_POOL_SIZE'], 'max_overflow': 0}
+    if config.get('DATABASE_SNAPSHOT_URI'):
+        binds[SNAPSHOT_BIND] = {'url': _read_only_url(make_url(config['DATABASE_SNAPSHOT_URI']))}
+    config['SQLALCHEMY_BINDS'] = binds
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 1, 'max_overflow': 0, 'pool_timeout': config['DATABASE_WRITE_TIMEOUT'],
+        **config.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
+
+
+def init_database(app, db):
+    """
+    Set the connection pragmas on every engine as connections open.
+    """
+    with app.app_context():
+        engines = dict(db.engines)
+    routed = READ_BIND in engines
+    # The read-only binds hold no tables; keep create_all() and drop_all() off them
+    db.metadatas.pop(READ_BIND, None)
+    db.metadatas.pop(SNAPSHOT_BIND, None)
+
+    for name, engine in engines.items():
+        if name in (READ_BIND, SNAPSHOT_BIND):
+            event.listen(engine, 'connect', _set_read_pragmas)
+        else:
+            event.listen(engine, 'connect', partial(
+                _set_write_pragmas, app.config['DATABASE_BUSY_TIMEOUT']) if routed else _set_foreign_keys)
+
+
+def _set_foreign_keys(dbapi_connection, connection_record):
+    dbapi_connection.execute('PRAGMA foreign_keys = ON')
+
+
+def _set_write_pragmas(busy_timeout, dbapi_connection, connection_record):
+    _set_foreign_keys(dbapi_connection, connection_record)
+    # Wait for another process's write to finish before failing as locked
+    dbapi_connection.execute(f'PRAGMA busy_timeout = {int(busy_timeout)}')
+    dbapi_connection.execute('PRAGMA journal_mode = WAL')
+    dbapi_connection.execute('PRAGMA synchronous = NORMAL')
+
+
+def _set_read_pragmas(dbapi_connection, connection_record):
+    dbapi_connection.execute('PRAGMA query_only = ON')
@@ -1,3 +1,4 @@
+from flask import current_app
 from flask_wtf import FlaskForm
 
 from flask_wtf.file import FileField, FileAllowed, FileRequired
@@ -5,7 +6,8 @@ from flask_wtf.file import FileField, FileAllowed, FileRequired
 from wtforms.validators import (
     DataRequired,
     Email,
-    Optional
+    Optional,
+    ValidationError
 )
 from wtforms import (
     StringField,
@@ -33,11 +35,29 @@ class RegistrationForm(FlaskForm):
     submit = SubmitField('Register')
 
 
+# Leading bytes of the accepted picture formats
+IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n')
+
+
 class UpsertProfilePictureForm(FlaskForm):
     picture_filename = FileField('Update Profile Picture', validators=[
                                  FileRequired(), FileAllowed(['jpg', 'jpeg', 'png'])])
     submit = SubmitField('Submit')
 
+    def validate_picture_filename(self, picture_filename):
+        # Checked before anything is stored, the extension alone proves nothing
+        stream = picture_filename.data.stream
+        stream.seek(0, 2)
+        size = stream.tell()
+        stream.seek(0)
+        header = stream.read(8)
+        stream.seek(0)
+        if size > current_app.config['PICTURE_MAX_BYTES']:
+            raise ValidationError(
+                f'Pictures can be at most {current_app.config["PICTURE_MAX_BYTES"] // (1024 * 1024)} MB.')
+        if not header.startswith(IMAGE_SIGNATURES):
+            raise ValidationError('The file is not a JPEG or PNG image.')
+
 
 class UpsertPersonForm(FlaskForm):
     gender = SelectField('Gender', choices=[
@@ -101,3 +121,10 @@ class UpsertRelativeForm(FlaskForm):
     relation_type = SelectField(
         'Relation Type', choices=[], validators=[DataRequired()])
     submit = SubmitField('Add Relative')
+
+
+class ImportRelativesForm(FlaskForm):
+    relatives_file = FileField('Relations File (CSV or JSON)', validators=[
+                               FileRequired(), FileAllowed(['csv', 'json'])])
+    dry_run = BooleanField('Validate only', default=False)
+    submit = SubmitField('Import')
@@ -0,0 +1,298 @@
+"""
+Memory mapped adjacency index of the relatives graph.
+
+The Relatives table is kept in a file as compressed sparse rows:
+
+    header    magic, format, number of users, number of edges
+    user_ids  int32, sorted, the users with at least one relation
+    indptr    int32, row i spans indices[indptr[i]:indptr[i + 1]]
+    indices   int32, relative user ids
+    codes     uint8, relation types as RelativesTypeEnum positions
+
+Every worker maps the file read-only, so the page cache holds one copy
+of the graph for the whole host and a walk over it needs no queries.
+Soft deleted users are left out. Writers patch the rows of the users
+whose relations changed, or who were deleted, and replace the file
+atomically under a lock; readers notice the new file and map it on
+their next lookup. Bulk imports rebuild it, as does
+'flask rebuild-graph-index' should it ever drift from the database.
+"""
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from sqlalchemy import select
+
+from flask import current_app as app
+
+from family_tree.models import User, Relatives, RelativesTypeEnum
+from family_tree.utils import BATCH_SIZE, batched
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where there is one process anyway
+    fcntl = None
+
+MAGIC = b'FTGI'
+FORMAT = 1
+HEADER = struct.Struct('<4sIII')
+
+RELATION_TYPES = list(RelativesTypeEnum)
+RELATION_CODES = {relation: code for code, relation in enumerate(RELATION_TYPES)}
+
+
+class GraphIndex:
+    """
+    A read-only view of an index file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as index_file:
+            self.stat = os.fstat(index_file.fileno())
+            self._map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, file_format, users, edges = HEADER.unpack_from(self._map)
+        if magic != MAGIC or file_format != FORMAT:
+            raise ValueError(f'{path} is not a graph index')
+        view = memoryview(self._map)
+        offset = HEADER.size
+        self.user_ids = view[offset:offset + 4 * users].cast('i')
+        offset += 4 * users
+        self.indptr = view[offset:offset + 4 * (users + 1)].cast('i')
+        offset += 4 * (users + 1)
+        self.indices = view[offset:offset + 4 * edges].cast('i')
+        offset += 4 * edges
+        self.codes = view[offset:offset + edges].cast('B')
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __contains__(self, user_id):
+        return self._position(user_id) is not None
+
+    def _position(self, user_id):
+        position = bisect_left(self.user_ids, user_id)
+        if position < len(self.user_ids) and self.user_ids[position] == user_id:
+            return position
+        return None
+
+    def _row(self, user_id):
+        position = self._position(user_id)
+        if position is None:
+            return range(0)
+        return range(self.indptr[position], self.indptr[position + 1])
+
+    @property
+    def edge_count(self):
+        return len(self.indices)
+
+    def relatives(self, user_id):
+        """
+        Return [(relative_user_id, RelativesTypeEnum), ...] of a user.
+        """
+        return [(self.indices[k], RELATION_TYPES[self.codes[k]]) for k in self._row(user_id)]
+
+    def neighbour_ids(self, user_id):
+        return [self.indices[k] for k in self._row(user_id)]
+
+    def component_ids(self, user_id):
+        """
+        Everyone connected to a user through any relation, including the user.
+        """
+        seen = {user_id}
+        frontier = [user_id]
+        while frontier:
+            next_frontier = []
+            for node in frontier:
+                for k in self._row(node):
+                    relative_user_id = self.indices[k]
+                    if relative_user_id not in seen:
+                        seen.add(relative_user_id)
+                        next_frontier.append(relative_user_id)
+            frontier = next_frontier
+        return seen
+
+    def close(self):
+        for view in (self.user_ids, self.indptr, self.indices, self.codes):
+            view.release()
+        self._map.close()
+
+
+def _write_index(path, user_ids, indptr, indices, codes):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    descriptor, partial_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(descriptor, 'wb') as index_file:
+            index_file.write(HEADER.pack(MAGIC, FORMAT, len(user_ids), len(indices)))
+            for values in (user_ids, indptr, indices, codes):
+                values.tofile(index_file)
+        # Readers still mapping the old file keep a consistent copy
+        os.replace(partial_path, path)
+    except BaseException:
+        os.remove(partial_path)
+        raise
+
+
+@contextmanager
+def _locked(path):
+    # Serialises writers across processes so no patch is lost
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_rows(db, user_ids=None):
+    """
+    Yield (user_id, [(relative_user_id, code), ...]) in user id order, for
+    every user or only the given ones, leaving out soft deleted users.
+    """
+    # Soft deleted users are left out, from both ends of their relations
+    deleted_ids = select(User.id).where(User.deleted_at.isnot(None))
+    query = select(Relatives.user_id, Relatives.relative_user_id, Relatives.relation_type) \
+        .where(Relatives.user_id.not_in(deleted_ids), Relatives.relative_user_id.not_in(deleted_ids)) \
+        .order_by(Relatives.user_id, Relatives.relative_user_id)
+    queries = [query.execution_options(yield_per=BATCH_SIZE)] if user_ids is None else [
+        query.filter(Relatives.user_id.in_(batch)) for batch in batched(sorted(user_ids))]
+    current_id, row = None, []
+    for batch_query in queries:
+        for user_id, relative_user_id, relation_type in db.session.execute(batch_query):
+            if user_id != current_id:
+                if row:
+                    yield current_id, row
+                current_id, row = user_id, []
+            row.append((relative_user_id, RELATION_CODES[relation_type]))
+    if row:
+        yield current_id, row
+
+
+def _append_row(arrays, user_id, row):
+    user_ids, indptr, indices, codes = arrays
+    user_ids.append(user_id)
+    indices.extend(relative_user_id for relative_user_id, _ in row)
+    codes.extend(code for _, code in row)
+    indptr.append(len(indices))
+
+
+def _empty_arrays():
+    return array('i'), array('i', [0]), array('i'), array('B')
+
+
+def _write_full_index(db, path):
+    arrays = _empty_arrays()
+    for user_id, row in _read_rows(db):
+        _append_row(arrays, user_id, row)
+    _write_index(path, *arrays)
+    return len(arrays[2])
+
+
+def build_graph_index(db, path):
+    """
+    Write the index of the whole Relatives table. Returns the edge count.
+    """
+    with _locked(path):
+        return _write_full_index(db, path)
+
+
+def patch_graph_index(db, path, user_ids):
+    """
+    Reread the relations of the given users and splice them into the
+    index, leaving the rows of everyone else as they are. Returns the edge
+    count.
+    """
+    with _locked(path):
+        if not os.path.exists(path):
+            return _write_full_index(db, path)
+
+        rows = dict(_read_rows(db, user_ids))
+        index = GraphIndex(path)
+        try:
+            arrays = _empty_arrays()
+            user_ids_out, indptr_out, indices_out, codes_out = arrays
+            position = 0
+            for user_id in sorted(set(user_ids)):
+                # Copy the untouched rows before this user as whole slices
+                end = bisect_left(index.user_ids, user_id, position)
+                if end > position:
+                    start_edge, end_edge = index.indptr[position], index.indptr[end]
+                    shift = len(indices_out) - start_edge
+                    user_ids_out.frombytes(index.user_ids[position:end].tobytes())
+                    indptr_out.extend(offset + shift for offset in index.indptr[position + 1:end + 1])
+                    indices_out.frombytes(index.indices[start_edge:end_edge].tobytes())
+                    codes_out.frombytes(index.codes[start_edge:end_edge].tobytes())
+                position = end
+                if position < len(index) and index.user_ids[position] == user_id:
+                    position += 1
+                if rows.get(user_id):
+                    _append_row(arrays, user_id, rows[user_id])
+            if position < len(index):
+                start_edge = index.indptr[position]
+                shift = len(indices_out) - start_edge
+                user_ids_out.frombytes(index.user_ids[position:].tobytes())
+                indptr_out.extend(offset + shift for offset in index.indptr[position + 1:])
+                indices_out.frombytes(index.indices[start_edge:].tobytes())
+                codes_out.frombytes(index.codes[start_edge:].tobytes())
+        finally:
+            index.close()
+        _write_index(path, *arrays)
+        return len(indices_out)
+
+
+_mapped = {}
+
+
+def get_graph_index():
+    """
+    Return this process's mapping of the current index file, or None when
+    the index is turned off or not built yet.
+    """
+    path = app.config.get('GRAPH_INDEX_PATH')
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    index = _mapped.get(path)
+    if index is None or (index.stat.st_ino, index.stat.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+        # Dropping the old mapping unmaps it once no caller holds it
+        index = _mapped[path] = GraphIndex(path)
+    return index
+
+
+def update_graph_index(db, user_ids):
+    """
+    Patch the index after the relations of the given users were committed.
+    """
+    path = app.config.get('GRAPH_INDEX_PATH')
+    if not path:
+        return
+    try:
+        count = patch_graph_index(db, path, user_ids)
+    except OSError as error:
+        app.logger.error(f'Could not update the graph index: {error}')
+        return
+    app.logger.info(f'Graph index patched for {len(set(user_ids))} users ({count} edges)')
+
+
+def rebuild_graph_index(db):
+    """
+    Rebuild the index from the Relatives table, e.g. after a bulk import.
+    Returns the edge count, or None when the index is turned off.
+    """
+    path = app.config.get('GRAPH_INDEX_PATH')
+    if not path:
+        return None
+    count = build_graph_index(db, path)
+    app.logger.info(f'Rebuilt graph index with {count} edges')
+    return count
@@ -0,0 +1,215 @@
+"""
+Durable background jobs stored in the Job table.
+
+Slow work (picture processing, imports, graph rebuilds) is enqueued from
+a request and run by a pool of worker threads, so the request returns at
+once and the client polls /jobs/<id> for progress.
+
+- Jobs are functions registered with @job('name'). They take the db, a
+  progress(fraction, message) callback and the JSON payload as keyword
+  arguments, and return a JSON serialisable result. The job's writes are
+  committed together with its success; progress() commits the work done
+  so far.
+- Workers claim a job with a single UPDATE ... RETURNING, so the workers
+  of every gunicorn process can share the table without a broker.
+- A failed job is retried after JOBS_RETRY_DELAY seconds, doubling each
+  time, until it has run max_attempts times. progress() also records a
+  heartbeat, and a running job whose last heartbeat is older than
+  JOBS_TIMEOUT, because its worker died, is claimed again. Long jobs
+  must call progress() at least that often.
+- With JOBS_EAGER set, jobs run inside enqueue(), which the tests use.
+"""
+import importlib
+import json
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, select, update
+
+from flask import current_app as app
+
+from family_tree.models import Job, JobStatusEnum
+
+JOBS = {}
+
+# Modules defining jobs, imported when a worker first needs them
+JOB_MODULES = (
+    'family_tree.services.user',
+    'family_tree.services.imports',
+    'family_tree.services.family',
+    'family_tree.services.duplicates',
+    'family_tree.services.purge'
+)
+
+
+def job(name):
+    def decorator(func):
+        JOBS[name] = func
+        return func
+    return decorator
+
+
+def get_job_function(name):
+    if name not in JOBS:
+        for module in JOB_MODULES:
+            importlib.import_module(module)
+    if name not in JOBS:
+        raise ValueError(f'Unknown job {name}')
+    return JOBS[name]
+
+
+def enqueue(db, name, user_id=None, max_attempts=None, **payload):
+    """
+    Store a job and return it. Commits the session.
+    """
+    new_job = Job(name=name, payload=json.dumps(payload), user_id=user_id,
+                  max_attempts=max_attempts or app.config['JOBS_MAX_ATTEMPTS'])
+    db.session.add(new_job)
+    db.session.commit()
+    app.logger.info(f'Queued job {new_job.id} {name}')
+
+    if app.config.get('JOBS_EAGER'):
+        while new_job.status == JobStatusEnum.QUEUED:
+            new_job.status = JobStatusEnum.RUNNING
+            new_job.attempts += 1
+            new_job.started_at = new_job.heartbeat_at = datetime.utcnow()
+            db.session.commit()
+            run_job(db, new_job.id)
+    return new_job
+
+
+def claim_job(db, worker):
+    """
+    Mark the next due job as running for this worker and return its id,
+    or None when there is nothing to do.
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=app.config['JOBS_TIMEOUT'])
+    next_job = (
+        select(Job.id)
+        .where(or_(and_(Job.status == JobStatusEnum.QUEUED, Job.run_after <= now),
+                   and_(Job.status == JobStatusEnum.RUNNING, Job.heartbeat_at < stale)))
+        .order_by(Job.run_after, Job.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    job_id = db.session.execute(
+        update(Job)
+        .where(Job.id == next_job)
+        .values(status=JobStatusEnum.RUNNING, worker=worker, started_at=now,
+                heartbeat_at=now, attempts=Job.attempts + 1)
+        .returning(Job.id)
+        .execution_options(synchronize_session=False)
+    ).scalar_one_or_none()
+    db.session.commit()
+    return job_id
+
+
+def run_job(db, job_id):
+    """
+    Run a claimed job and record its result, or schedule a retry.
+    """
+    current_job = db.session.get(Job, job_id)
+
+    def progress(fraction, message=None):
+        current_job.progress = max(0.0, min(float(fraction), 1.0))
+        current_job.message = message
+        current_job.heartbeat_at = datetime.utcnow()
+        db.session.commit()
+
+    try:
+        func = get_job_function(current_job.name)
+        result = func(db, progress, **json.loads(current_job.payload))
+    except Exception as error:
+        db.session.rollback()
+        current_job.error = f'{type(error).__name__}: {error}'
+        if current_job.attempts < current_job.max_attempts:
+            delay = app.config['JOBS_RETRY_DELAY'] * 2 ** (current_job.attempts - 1)
+            current_job.status = JobStatusEnum.QUEUED
+            current_job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+            app.logger.warning(f'Job {job_id} {current_job.name} failed, retrying in {delay}s: {error}')
+        else:
+            current_job.status = JobStatusEnum.FAILED
+            current_job.finished_at = datetime.utcnow()
+            app.logger.error(f'Job {job_id} {current_job.name} failed: {error}')
+        db.session.commit()
+        return current_job
+
+    current_job.status = JobStatusEnum.SUCCEEDED
+    current_job.progress = 1.0
+    current_job.result = json.dumps(result)
+    current_job.error = None
+    current_job.finished_at = datetime.utcnow()
+    db.session.commit()
+    app.logger.info(f'Job {job_id} {current_job.name} succeeded')
+    return current_job
+
+
+def job_to_dict(current_job):
+    return {
+        'id': current_job.id,
+        'name': current_job.name,
+        'status': current_job.status.value,
+        'progress': current_job.progress,
+        'message': current_job.message,
+        'attempts': current_job.attempts,
+        'result': json.loads(current_job.result) if current_job.result else None,
+        'error': current_job.error,
+        'created_at': current_job.created_at.isoformat(),
+        'finished_at': current_job.finished_at.isoformat() if current_job.finished_at else None
+    }
+
+
+class JobWorkerPool:
+    """
+    Worker threads polling the Job table.
+    """
+
+    def __init__(self, app, db, size=2, poll_interval=1.0):
+        self.app = app
+        self.db = db
+        self.size = size
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for number in range(self.size):
+            thread = threading.Thread(target=self._run, args=(number,), name=f'job-worker-{number}',
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, number):
+        worker = f'{socket.gethostname()}:{os.getpid()}:{number}'
+        while not self._stop.is_set():
+            with self.app.app_context():
+                try:
+                    job_id = claim_job(self.db, worker)
+                    if job_id is not None:
+                        run_job(self.db, job_id)
+                except Exception as error:
+                    job_id = None
+                    self.db.session.rollback()
+                    self.app.logger.error(f'Job worker {worker} error: {error}')
+            if job_id is None:
+                self._stop.wait(self.poll_interval)
+
+
+def start_job_workers(app, db):
+    """
+    Start this process's job workers, e.g. from gunicorn's post_fork.
+    """
+    if app.config['JOBS_EAGER'] or not app.config['JOBS_WORKERS']:
+        return None
+    pool = JobWorkerPool(app, db, app.config['JOBS_WORKERS'], app.config['JOBS_POLL_INTERVAL'])
+    pool.start()
+    app.extensions['job_workers'] = pool
+    return pool
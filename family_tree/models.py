@@ -2,8 +2,10 @@ from datetime import datetime
 import enum
 
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
 
 from family_tree import db, bcrypt
+from family_tree.utils import name_key
 
 
 class User(db.Model, UserMixin):
@@ -12,6 +14,11 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.Text, nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
+    # Connected component of the relatives graph; None while unconnected
+    family_id = db.Column(db.Integer, db.ForeignKey('family.id'), index=True)
+    # Set when an admin deletes the user, who is hidden from then on; the
+    # purge_user job removes the rows in the background
+    deleted_at = db.Column(db.DateTime, index=True)
 
     profile_picture = db.relationship(
         'Picture', backref='user', uselist=False, cascade='all, delete-orphan')
@@ -56,6 +63,26 @@ class User(db.Model, UserMixin):
     # photos = db.relationship('Photos', backref='person', lazy=True, cascade='all, delete-orphan')
 
 
+class Family(db.Model):
+    """
+    A connected component of the relatives graph. Every member points
+    directly at its family, so "which family is this person in" is a
+    single column read. Maintained by family_tree.services.family.
+    """
+    # Never reuse ids, they are used as cache keys
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    size = db.Column(db.Integer, nullable=False, default=0)
+    # Bumped on every relation write inside the family
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    members = db.relationship('User', backref='family', lazy=True)
+
+    def __repr__(self):
+        return f'<Family {self.id} ({self.size} members)>'
+
+
 class Picture(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -76,6 +103,14 @@ class Person(db.Model):
     first_name = db.Column(db.String(100), nullable=False)
     middle_name = db.Column(db.String(100))
     last_name = db.Column(db.String(100), nullable=False)
+    # Soundex of the last and first name, used to find duplicates
+    name_key = db.Column(db.String(8), index=True)
+
+    @validates('first_name', 'last_name')
+    def _set_name_key(self, key, value):
+        names = {'first_name': self.first_name, 'last_name': self.last_name, key: value}
+        self.name_key = name_key(names['first_name'], names['last_name'])
+        return value
 
     def __repr__(self):
         return f'<Person {self.first_name} {self.last_name}>'
@@ -108,6 +143,13 @@ class ImportantDates(db.Model):
     date_type = db.Column(db.Enum(ImportantDateTypeEnum),
                           nullable=False)  # e.g., Birth, Anniversary
     date = db.Column(db.Date, nullable=False)
+    # month * 100 + day, so upcoming anniversaries are an index range scan
+    month_day = db.Column(db.Integer, index=True)
+
+    @validates('date')
+    def _set_month_day(self, key, value):
+        self.month_day = value.month * 100 + value.day if value else None
+        return value
 
 
 class ContactDetails(db.Model):
@@ -157,3 +199,143 @@ class Relatives(db.Model):
         if relation_type not in Relatives.REVERSE_RELATIONSHIP_MAP:
             return "UNKNOWN"
         return Relatives.REVERSE_RELATIONSHIP_MAP[relation_type]
+
+
+class Ancestry(db.Model):
+    """
+    Transitive closure of the PARENT/CHILD edges in Relatives.
+
+    One row per (ancestor, descendant) pair, where distance is the smallest
+    number of generations between them (1 = parent, 2 = grandparent, ...).
+    Maintained incrementally by family_tree.services.ancestry.
+    """
+    ancestor_id = db.Column(db.Integer, db.ForeignKey(
+        'user.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey(
+        'user.id', ondelete='CASCADE'), primary_key=True)
+    distance = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_ancestry_descendant_distance',
+                 'descendant_id', 'distance'),
+    )
+
+    def __repr__(self):
+        return f'<Ancestry {self.ancestor_id} -> {self.descendant_id} ({self.distance})>'
+
+
+class DerivedRelationEnum(enum.Enum):
+    GRANDPARENT = "GRANDPARENT"
+    GRANDCHILD = "GRANDCHILD"
+    SIBLING = "SIBLING"
+    HALFSIBLING = "HALFSIBLING"
+    AUNT_UNCLE = "AUNT_UNCLE"
+    NIECE_NEPHEW = "NIECE_NEPHEW"
+    COUSIN = "COUSIN"
+    PARENT_IN_LAW = "PARENT_IN_LAW"
+    CHILD_IN_LAW = "CHILD_IN_LAW"
+    SIBLING_IN_LAW = "SIBLING_IN_LAW"
+
+
+class DerivedRelative(db.Model):
+    """
+    Relations inferred from the PARENT and SPOUSE edges in Relatives
+    (grandparents, siblings, cousins, in-laws, ...), one row per pair of
+    users that are not directly related. Maintained incrementally by
+    family_tree.services.derived.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey(
+        'user.id', ondelete='CASCADE'), primary_key=True)
+    relative_user_id = db.Column(db.Integer, db.ForeignKey(
+        'user.id', ondelete='CASCADE'), primary_key=True)
+    relation = db.Column(db.Enum(DerivedRelationEnum), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_derived_relative_relative_user_id', 'relative_user_id'),
+    )
+
+    def __repr__(self):
+        return f'<DerivedRelative {self.user_id} -> {self.relative_user_id} ({self.relation.value})>'
+
+
+class DuplicateCandidate(db.Model):
+    """
+    Two users that probably describe the same person, found by
+    family_tree.services.duplicates. user_id is the smaller id.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey(
+        'user.id', ondelete='CASCADE'), primary_key=True)
+    other_user_id = db.Column(db.Integer, db.ForeignKey(
+        'user.id', ondelete='CASCADE'), primary_key=True, index=True)
+    score = db.Column(db.Float, nullable=False)
+    dismissed = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_duplicate_candidate_dismissed_score', 'dismissed', 'score'),
+    )
+
+    def __repr__(self):
+        return f'<DuplicateCandidate {self.user_id} ~ {self.other_user_id} ({self.score:.2f})>'
+
+
+class DataVersion(db.Model):
+    """
+    Monotonic version counters, bumped whenever the data they describe
+    changes. Used to build ETags and cache keys without reading the data.
+    """
+    scope = db.Column(db.String(50), primary_key=True)
+    key = db.Column(db.Integer, primary_key=True, default=0)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<DataVersion {self.scope}:{self.key}={self.value}>'
+
+
+class TreeLayout(db.Model):
+    """
+    Cached layered layout of one family (connected component of the
+    relatives graph), valid for as long as the family's version does not
+    change.
+    """
+    component_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    layout = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class JobStatusEnum(enum.Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+
+class Job(db.Model):
+    """
+    A unit of background work in the durable job queue (see
+    family_tree/jobs.py). The payload and result are stored as JSON.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.Enum(JobStatusEnum), nullable=False, default=JobStatusEnum.QUEUED, index=True)
+    # Jobs outlive the user who started them, so this is not a foreign key
+    user_id = db.Column(db.Integer, index=True)
+    progress = db.Column(db.Float, nullable=False, default=0.0)
+    message = db.Column(db.String(255))
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    worker = db.Column(db.String(100))
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    # Moved forward by progress(); a running job is reclaimed when it stops
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.name} {self.status.value}>'
@@ -1,3 +1,5 @@
+import json
+
 from flask import (
     Blueprint, 
     render_template,
@@ -5,6 +7,8 @@ from flask import (
     redirect,
     url_for,
     request,
+    Response,
+    stream_with_context,
     current_app as app
     )
 
@@ -17,10 +21,22 @@ from family_tree import (
 
 from family_tree.models import (
     User,
-    Person
+    Person,
+    Family,
+    Job,
+    JobStatusEnum
 )
 
 from family_tree.cursor import Cursor
+from family_tree.database import SNAPSHOT_BIND, iter_with_bind
+from family_tree.jobs import enqueue
+
+from family_tree.services.family import get_families
+from family_tree.services.purge import soft_delete_user
+from family_tree.services.tree import get_display_names
+from family_tree.services.versions import USER_SCOPE, get_versions
+
+from family_tree.forms import ImportRelativesForm
 
 cursor = Cursor()   
 
@@ -47,13 +63,168 @@ def display_user(user_id):
 @bp.route('/display_users')
 @login_required
 def display_users():
-    users = cursor.query(db, User, *[User.is_admin == False], filter_by=False).all()
-    return render_template('admin/display_users.html', users=users)
+    users = cursor.query(db, User, *[User.is_admin == False, User.deleted_at.is_(None)],
+                         filter_by=False).all()
+    versions = get_versions(db, USER_SCOPE, [user.id for user in users])
+    return render_template('admin/display_users.html', users=users, versions=versions)
 
 @bp.route('/delete_user/<int:user_id>', methods = ['POST'])
 @login_required
 def delete_user(user_id):
-    cursor.delete(db, User, id=user_id)
-    app.logger.info(f'Deleted user {user_id}')
+    # The user is hidden now and purged by a background job
+    purge_job = soft_delete_user(db, user_id, admin_id=current_user.id)
+    if purge_job is None:
+        flash('User not found.', 'danger')
+        return redirect(url_for('admin.display_users'))
+    app.logger.info(f'Deleted user {user_id}, purge queued as job {purge_job.id}')
     flash('Deleted Successfully!', 'success')
-    return redirect(url_for('admin.display_users'))
\ No newline at end of file
+    return redirect(url_for('admin.display_users'))
+
+@bp.route('/export_users.<any(csv, json):file_format>')
+@login_required
+def export_users(file_format):
+    # Exporters are only loaded when used, keeping worker start up fast
+    from family_tree.services.export import (
+        USER_TABLE_COLUMNS,
+        iter_csv,
+        iter_user_table,
+        iter_user_table_json
+    )
+
+    app.logger.info(f'Exporting user table as {file_format}')
+    rows = iter_user_table(db)
+    if file_format == 'csv':
+        chunks, mimetype = iter_csv(USER_TABLE_COLUMNS, rows), 'text/csv'
+    else:
+        chunks, mimetype = iter_user_table_json(rows), 'application/json'
+    # Reports may lag behind, so they read the snapshot copy when there is one
+    response = Response(stream_with_context(iter_with_bind(db, SNAPSHOT_BIND, chunks)),
+                        mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=users.{file_format}'
+    return response
+
+@bp.route('/display_families')
+@login_required
+def display_families():
+    families = get_families(db)
+    return render_template('admin/display_families.html', families=families)
+
+
+@bp.route('/analytics')
+@login_required
+def analytics():
+    from family_tree.services.analytics import get_graph_stats
+
+    stats = get_graph_stats(db)
+    names = get_display_names(db, stats['orphan_ids'])
+    return render_template('admin/analytics.html', stats=stats, names=names)
+
+
+@bp.route('/display_family/<int:family_id>')
+@login_required
+def display_family(family_id):
+    family = cursor.query(db, Family, filter_by=True, id=family_id).first()
+    if not family:
+        flash('Family not found.', 'danger')
+        return redirect(url_for('admin.display_families'))
+    members = cursor.query(db, User, filter_by=True, family_id=family_id).order_by(User.id).all()
+    names = get_display_names(db, [member.id for member in members])
+    return render_template('admin/display_family.html', family=family, members=members, names=names)
+
+
+@bp.route('/import_relatives', methods=['GET', 'POST'])
+@login_required
+def import_relatives_file():
+    form = ImportRelativesForm()
+    result = None
+    import_job = None
+    if form.validate_on_submit():
+        from family_tree.services.imports import import_relatives, read_relative_rows
+
+        upload = form.relatives_file.data
+        try:
+            rows = read_relative_rows(upload.stream, upload.filename)
+        except ValueError as error:
+            app.logger.warning(f'Could not read relations file {upload.filename}: {error}')
+            flash(f'Could not read file: {error}', 'danger')
+            return redirect(url_for('admin.import_relatives_file'))
+        if form.dry_run.data:
+            result = import_relatives(db, rows, dry_run=True)
+            flash(f'{result["imported"]} relations are valid, nothing was imported.', 'info')
+        else:
+            # Large files take a while, so the import runs as a background job
+            import_job = enqueue(db, 'import_relatives', user_id=current_user.id,
+                                 rows=rows, filename=upload.filename)
+            app.logger.info(f'Queued import of {len(rows)} relations from {upload.filename}')
+            return redirect(url_for('admin.import_relatives_file', job_id=import_job.id))
+    elif request.args.get('job_id', type=int):
+        import_job = db.session.get(Job, request.args.get('job_id', type=int))
+        if import_job and import_job.status == JobStatusEnum.SUCCEEDED:
+            result = json.loads(import_job.result)
+    return render_template('admin/import_relatives.html', form=form, result=result, job=import_job)
+
+
+@bp.route('/rebuild_graph', methods=['POST'])
+@login_required
+def rebuild_graph():
+    rebuild_job = enqueue(db, 'rebuild_graph', user_id=current_user.id)
+    app.logger.info(f'Queued rebuild of the ancestry and family tables as job {rebuild_job.id}')
+    flash(f'Rebuild of the family tree queued as job {rebuild_job.id}.', 'info')
+    return redirect(url_for('admin.dashboard'))
+
+
+@bp.route('/display_duplicates')
+@login_required
+def display_duplicates():
+    from family_tree.services.duplicates import get_duplicate_candidates
+
+    candidates = get_duplicate_candidates(db)
+    return render_template('admin/duplicates.html', candidates=candidates)
+
+
+@bp.route('/find_duplicates', methods=['POST'])
+@login_required
+def find_duplicates():
+    duplicates_job = enqueue(db, 'find_duplicates', user_id=current_user.id)
+    app.logger.info(f'Queued duplicate detection as job {duplicates_job.id}')
+    flash(f'Duplicate detection queued as job {duplicates_job.id}.', 'info')
+    return redirect(url_for('admin.display_duplicates'))
+
+
+@bp.route('/dismiss_duplicate/<int:user_id>/<int:other_user_id>', methods=['POST'])
+@login_required
+def dismiss_duplicate(user_id, other_user_id):
+    from family_tree.services.duplicates import dismiss_duplicate
+
+    if dismiss_duplicate(db, user_id, other_user_id):
+        flash('Dismissed, the pair will not be suggested again.', 'success')
+    else:
+        flash('Duplicate not found.', 'danger')
+    return redirect(url_for('admin.display_duplicates'))
+
+
+@bp.route('/merge_users/<int:survivor_id>/<int:duplicate_id>', methods=['POST'])
+@login_required
+def merge_users(survivor_id, duplicate_id):
+    from family_tree.services.merge import merge_users
+
+    try:
+        merge_users(db, survivor_id, duplicate_id)
+    except ValueError as error:
+        app.logger.warning(f'Could not merge user {duplicate_id} into user {survivor_id}: {error}')
+        flash(f'Could not merge: {error}', 'danger')
+    else:
+        flash('Merged Successfully!', 'success')
+    return redirect(url_for('admin.display_duplicates'))
+
+
+@bp.route('/export_gedcom')
+@login_required
+def export_gedcom():
+    from family_tree.services.gedcom import iter_gedcom
+
+    app.logger.info('Exporting family tree as GEDCOM')
+    response = Response(stream_with_context(iter_with_bind(db, SNAPSHOT_BIND, iter_gedcom(db))),
+                        mimetype='text/vnd.familysearch.gedcom')
+    response.headers['Content-Disposition'] = 'attachment; filename=family_tree.ged'
+    return response
@@ -47,7 +47,7 @@ def login():
         form = LoginForm()
         if form.validate_on_submit():
             user = cursor.query(db, User, filter_by=True, email=form.email.data).first()
-            if user and user.check_password(form.password.data):
+            if user and user.deleted_at is None and user.check_password(form.password.data):
                 login_user(user, remember=form.remember.data)
                 app.logger.info(f"User {form.email.data} logged in successfully.")
                 return redirect(url_for('common.home'))
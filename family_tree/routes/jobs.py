@@ -0,0 +1,30 @@
+from flask import (
+    Blueprint,
+    abort,
+    jsonify
+)
+
+from flask_login import current_user, login_required
+
+from family_tree import db
+
+from family_tree.models import Job
+
+from family_tree.jobs import job_to_dict
+
+bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+
+@bp.route('/<int:job_id>')
+@login_required
+def job_status(job_id):
+    """
+    Report the status and progress of a background job to the user who
+    started it, or to an admin.
+    """
+    job = db.session.get(Job, job_id)
+    if job is None or (job.user_id != current_user.id and not current_user.is_admin):
+        abort(404)
+    response = jsonify(job_to_dict(job))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
@@ -0,0 +1,105 @@
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    jsonify,
+    request,
+    stream_with_context,
+    current_app as app
+)
+
+from flask_login import current_user, login_required
+
+from family_tree import db
+
+from family_tree.models import User
+
+from family_tree.cursor import Cursor
+
+from family_tree.services.tree import (
+    can_view_tree,
+    find_relation_path,
+    get_display_names,
+    get_tree_etag,
+    iter_tree_elements,
+    iter_tree_json,
+    iter_tree_ndjson
+)
+
+cursor = Cursor()
+
+bp = Blueprint('tree', __name__, url_prefix='/tree')
+
+
+def _get_hops():
+    hops = request.args.get('hops', default=app.config['TREE_DEFAULT_HOPS'], type=int)
+    return max(0, min(hops, app.config['TREE_MAX_HOPS']))
+
+
+def _check_viewable(user_id):
+    user = cursor.query(db, User, User.deleted_at.is_(None), id=user_id).first()
+    if not user:
+        abort(404)
+    if not can_view_tree(current_user, user):
+        app.logger.warning(f'User {current_user.get_id()} may not view the tree of user {user_id}')
+        abort(403)
+
+
+def _stream_tree(user_id, serialise, mimetype):
+    """
+    Stream the tree around a user, answering with 304 if the client
+    already holds the current version.
+    """
+    _check_viewable(user_id)
+    hops = _get_hops()
+    etag = get_tree_etag(db, user_id, hops)
+    if request.if_none_match.contains_weak(etag):
+        app.logger.info(f'Tree of user {user_id} not modified for user {current_user.get_id()}')
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    app.logger.info(f'Streaming tree of user {user_id} ({hops} hops) to user {current_user.get_id()}')
+    elements = iter_tree_elements(db, user_id, hops, app.config['TREE_BATCH_SIZE'])
+    response = Response(stream_with_context(serialise(elements, user_id, hops)), mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@bp.route('/<int:user_id>.json')
+@login_required
+def tree_json(user_id):
+    """
+    Return the nodes and edges around a user as one JSON document.
+    """
+    return _stream_tree(user_id, iter_tree_json, 'application/json')
+
+
+@bp.route('/<int:user_id>.ndjson')
+@login_required
+def tree_ndjson(user_id):
+    """
+    Stream the nodes and edges around a user as newline delimited JSON.
+    """
+    return _stream_tree(
+        user_id,
+        lambda elements, user_id, hops: iter_tree_ndjson(elements),
+        'application/x-ndjson')
+
+
+@bp.route('/path/<int:user_id>/<int:other_id>.json')
+@login_required
+def relation_path(user_id, other_id):
+    """
+    Return the shortest chain of relations between two users.
+    """
+    for path_user_id in (user_id, other_id):
+        _check_viewable(path_user_id)
+    path = find_relation_path(db, user_id, other_id, app.config['TREE_MAX_PATH_HOPS'],
+                              app.config['TREE_BATCH_SIZE'])
+    if path is not None:
+        names = get_display_names(db, [step['user_id'] for step in path])
+        for step in path:
+            step['name'] = names.get(step['user_id'])
+    return jsonify({'source': user_id, 'target': other_id, 'path': path})
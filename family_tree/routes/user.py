@@ -1,4 +1,8 @@
 # Add Contact Details
+import hashlib
+from datetime import timezone
+from functools import wraps
+
 from flask import (
     Blueprint,
     render_template,
@@ -6,6 +10,10 @@ from flask import (
     redirect,
     url_for,
     request,
+    session,
+    make_response,
+    Response,
+    stream_with_context,
     current_app as app
 )
 
@@ -19,15 +27,27 @@ from family_tree.services.user import (
     update_person,
     prefill_address_form,
     fill_address_from_form,
-    get_relative_details,
     check_relative_constraints,
     check_validity_relation,
     add_relative_to_database,
     prefill_upsert_relative_form,
     delete_relative_from_database
 )
+from family_tree.services.layout import (
+    get_component_layout,
+    order_relative_details
+)
+from family_tree.services.tree import get_display_names, picture_url
+from family_tree.services.snapshot import get_user_snapshot
+from family_tree.services.family import get_family_id
+from family_tree.services.derived import get_derived_relatives
+from family_tree.services.versions import USER_SCOPE, get_version_info, get_versions
+from family_tree.templating import template_modified_at, template_version
+from family_tree.jobs import enqueue
+from family_tree.services.events import get_upcoming_events
 from family_tree.models import (
     User,
+    Family,
     GenderEnum,
     Person,
     Picture,
@@ -54,6 +74,58 @@ cursor = Cursor()
 bp = Blueprint('user', __name__)
 
 
+def _family_version():
+    # Relatives and tree pages also change with the layout of the family
+    family_id = get_family_id(db, current_user.id)
+    if family_id is None:
+        return 'none'
+    return f'{family_id}.{db.session.get(Family, family_id).version}'
+
+
+def conditional_page(extra=None):
+    """
+    Answer GET requests for a read-only page with 304 Not Modified when
+    the user's data version (and the templates) have not changed since the
+    client's copy, without loading any data or rendering.
+
+    `extra` returns more state the page depends on. Pages are always
+    rendered while flashed messages are waiting to be shown.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            version, updated_at = get_version_info(db, USER_SCOPE, current_user.id)
+            if updated_at:
+                # A deploy changing the templates is a modification too
+                updated_at = max(updated_at.replace(microsecond=0, tzinfo=timezone.utc),
+                                 template_modified_at(app))
+            parts = [request.endpoint, current_user.id, version, template_version(app)]
+            parts += [f'{key}={value}' for key, value in sorted(kwargs.items())]
+            if extra:
+                parts.append(extra())
+            etag = hashlib.md5('-'.join(map(str, parts)).encode()).hexdigest()
+
+            if request.if_none_match.contains_weak(etag) or (
+                    not request.if_none_match and updated_at and request.if_modified_since
+                    and request.if_modified_since >= updated_at and not extra):
+                app.logger.info(f'{request.endpoint} not modified for user {current_user.username}.')
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if updated_at:
+                    response.last_modified = updated_at
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
 @bp.before_request
 def restrict_access_to_user():
     if not current_user.is_authenticated or current_user.is_admin:
@@ -70,7 +142,11 @@ def dashboard():
     Render the user dashboard page.
     """
     app.logger.info(f"Rendering dashboard for user {current_user.get_id()}.")
-    return render_template('user/dashboard.html')
+    events = get_upcoming_events(
+        db, current_user.id,
+        days=app.config['UPCOMING_EVENTS_DAYS'],
+        limit=app.config['UPCOMING_EVENTS_LIMIT'])
+    return render_template('user/dashboard.html', events=events)
 
 
 @bp.route('/display_profile', methods=['GET', 'POST'])
@@ -82,15 +158,16 @@ def display_profile():
     if form.validate_on_submit():
         picture_filename = save_picture(form.picture_filename.data)
         update_profile_picture(db, Picture, current_user, picture_filename)
+        enqueue(db, 'resize_picture', user_id=current_user.id, picture_filename=picture_filename)
         flash('Profile Picture Updated!', 'success')
 
-    if current_user.profile_picture:
-        profile_image_url = url_for(
-            'static', filename=f'profile_pictures/{current_user.profile_picture.picture_filename}')
+    user = get_user_snapshot(db, current_user.id)
+    if user['picture_filename']:
+        profile_image_url = picture_url(user['picture_filename'])
     else:
         profile_image_url = None
 
-    return render_template('user/display_profile.html', form=form, user=current_user, profile_image_url=profile_image_url)
+    return render_template('user/display_profile.html', form=form, user=user, profile_image_url=profile_image_url)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -140,6 +217,7 @@ def edit_profile():
 
 @bp.route('/address', methods=['GET', 'POST'])
 @login_required
+@conditional_page()
 def address():
     """
     Render and process the user's address form.
@@ -149,7 +227,7 @@ def address():
 
     return render_template(
         'user/address.html',
-        addresses=current_user.addresses
+        addresses=get_user_snapshot(db, current_user.id)['addresses']
     )
 
 
@@ -247,6 +325,7 @@ def edit_address(address_id):
 
 @bp.route('/display_address/<int:address_id>')
 @login_required
+@conditional_page()
 def display_address(address_id):
     """
     Render the display address page for a specific address.
@@ -293,6 +372,7 @@ def delete_address(address_id):
 
 @bp.route('/display_important_dates')
 @login_required
+@conditional_page()
 def display_important_dates():
     """
     Render the important dates page for the user.
@@ -302,7 +382,7 @@ def display_important_dates():
 
     return render_template(
         'user/display_important_dates.html',
-        important_dates=current_user.important_dates
+        important_dates=get_user_snapshot(db, current_user.id)['important_dates']
     )
 
 
@@ -398,6 +478,7 @@ def delete_important_date(date_id):
 
 @bp.route('/display_contact_details')
 @login_required
+@conditional_page()
 def display_contact_details():
     """
     Render the contact details page for the user.
@@ -407,7 +488,7 @@ def display_contact_details():
 
     return render_template(
         'user/display_contact_details.html',
-        contact_details=current_user.contact_details
+        contact_details=get_user_snapshot(db, current_user.id)['contact_details']
     )
 
 
@@ -500,18 +581,43 @@ def delete_contact_details(contact_id):
 
 @bp.route('/display_relatives')
 @login_required
+@conditional_page(extra=_family_version)
 def display_relatives():
     """
     Render the relatives page for the user.
     """
     app.logger.info(
         f"Rendering relatives page for user {current_user.username}.")
-    relatives = cursor.query(
-        db, Relatives, filter_by=True, user_id=current_user.id).all()
-    relative_details = get_relative_details(db, User, relatives)
+    relative_details = get_user_snapshot(db, current_user.id)['relatives']
+    for detail in relative_details:
+        detail['profile_picture_url'] = picture_url(detail['picture_filename'])
+    layout = get_component_layout(db, current_user.id)
+    order_relative_details(layout, current_user.id, relative_details)
+    versions = get_versions(
+        db, USER_SCOPE, [detail['relative_user_id'] for detail in relative_details])
     return render_template(
         'user/display_relatives.html',
-        relative_details=relative_details
+        relative_details=relative_details,
+        extended_family=get_derived_relatives(db, current_user.id),
+        versions=versions
+    )
+
+
+@bp.route('/display_tree')
+@login_required
+@conditional_page(extra=_family_version)
+def display_tree():
+    """
+    Render the family tree of the user from the cached layout.
+    """
+    app.logger.info(
+        f"Rendering family tree page for user {current_user.username}.")
+    layout = get_component_layout(db, current_user.id)
+    names = get_display_names(db, layout['nodes'])
+    return render_template(
+        'user/display_tree.html',
+        layout=layout,
+        names=names
     )
 
 
@@ -562,3 +668,26 @@ def delete_relative(relative_user_id):
     return redirect(url_for('user.display_relatives'))
 
 
+@bp.route('/export_record.<any(csv, json):file_format>')
+@login_required
+def export_record(file_format):
+    """
+    Download everything stored about the user as CSV or JSON.
+    """
+    from family_tree.services.export import (
+        iter_user_record,
+        iter_user_record_csv,
+        iter_user_record_json
+    )
+
+    app.logger.info(
+        f"Exporting record of user {current_user.username} as {file_format}.")
+    items = iter_user_record(db, current_user.id)
+    if file_format == 'csv':
+        chunks, mimetype = iter_user_record_csv(items), 'text/csv'
+    else:
+        chunks, mimetype = iter_user_record_json(items), 'application/json'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename={current_user.username}.{file_format}'
+    return response
@@ -0,0 +1,207 @@
+"""
+Whole-graph statistics for the admin analytics page.
+
+The Relatives edge list is read once, in user id order, into compressed
+sparse row (CSR) arrays: int32 user indexes and uint8 relation codes
+from the array module, a few bytes per edge instead of an ORM object.
+With numpy installed the statistics are computed with vectorized
+operations on views of those arrays, otherwise with plain loops over
+them. Results are cached per tree version and computed on the first
+view after the graph has changed, never on the write itself, so a burst
+of edits costs one recompute.
+"""
+from array import array
+
+from sqlalchemy import select
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+from family_tree.cache import cached
+from family_tree.graph_index import RELATION_CODES
+from family_tree.models import (
+    User,
+    Relatives,
+    RelativesTypeEnum
+)
+from family_tree.services.versions import TREE_SCOPE, get_version
+from family_tree.utils import BATCH_SIZE
+
+PARENT_CODE = RELATION_CODES[RelativesTypeEnum.PARENT]
+
+LARGEST_FAMILIES = 10
+ORPHAN_SAMPLE = 20
+
+
+class CSRGraph:
+    """
+    The relatives of user_ids[i] are user_ids[indices[k]] for k in
+    range(indptr[i], indptr[i + 1]), related as RelativesTypeEnum number
+    codes[k]. family_ids[i] is 0 for users without a family.
+    """
+
+    def __init__(self, user_ids, family_ids, indptr, indices, codes):
+        self.user_ids = user_ids
+        self.family_ids = family_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.user_ids)
+
+
+def load_graph(db):
+    """
+    Read the users (without admins and deleted users) and their relations
+    into a CSRGraph with two streamed queries.
+    """
+    user_ids = array('i')
+    family_ids = array('i')
+    position = {}
+    users = db.session.execute(
+        select(User.id, User.family_id)
+        .filter(User.is_admin == False, User.deleted_at.is_(None)).order_by(User.id)
+        .execution_options(yield_per=BATCH_SIZE))
+    for user_id, family_id in users:
+        position[user_id] = len(user_ids)
+        user_ids.append(user_id)
+        family_ids.append(family_id or 0)
+
+    indptr = array('i', [0] * (len(user_ids) + 1))
+    indices = array('i')
+    codes = array('B')
+    edges = db.session.execute(
+        select(Relatives.user_id, Relatives.relative_user_id, Relatives.relation_type)
+        .order_by(Relatives.user_id, Relatives.relative_user_id)
+        .execution_options(yield_per=BATCH_SIZE))
+    for user_id, relative_user_id, relation_type in edges:
+        if user_id not in position or relative_user_id not in position:
+            continue
+        indptr[position[user_id] + 1] += 1
+        indices.append(position[relative_user_id])
+        codes.append(RELATION_CODES[relation_type])
+    for index in range(len(user_ids)):
+        indptr[index + 1] += indptr[index]
+    return CSRGraph(user_ids, family_ids, indptr, indices, codes)
+
+
+def _histogram(counts):
+    return [(value, int(count)) for value, count in enumerate(counts) if count]
+
+
+def _numpy_stats(graph):
+    user_ids = np.frombuffer(graph.user_ids, dtype=np.int32)
+    family_ids = np.frombuffer(graph.family_ids, dtype=np.int32)
+    indices = np.frombuffer(graph.indices, dtype=np.int32)
+    codes = np.frombuffer(graph.codes, dtype=np.uint8)
+    degree = np.diff(np.frombuffer(graph.indptr, dtype=np.int32))
+
+    # Depth = generations above a user, relaxed once per generation
+    sources = np.repeat(np.arange(len(graph), dtype=np.int32), degree)
+    is_parent = codes == PARENT_CODE
+    children, parents = sources[is_parent], indices[is_parent]
+    depth = np.zeros(len(graph), dtype=np.int32)
+    for _ in range(len(graph)):
+        relaxed = depth.copy()
+        np.maximum.at(relaxed, children, depth[parents] + 1)
+        if np.array_equal(relaxed, depth):
+            break
+        depth = relaxed
+
+    in_family = family_ids > 0
+    family_keys, family_index, sizes = np.unique(
+        family_ids[in_family], return_inverse=True, return_counts=True)
+    generations = np.zeros(len(family_keys), dtype=np.int32)
+    np.maximum.at(generations, family_index, depth[in_family] + 1)
+
+    return {
+        'degrees': np.bincount(degree).tolist() if len(graph) else [],
+        'orphan_ids': user_ids[degree == 0].tolist(),
+        'generation_counts': np.bincount(depth[in_family]).tolist() if in_family.any() else [],
+        'families': list(zip(family_keys.tolist(), sizes.tolist(), generations.tolist()))
+    }
+
+
+def _python_stats(graph):
+    count = len(graph)
+    degree = [graph.indptr[index + 1] - graph.indptr[index] for index in range(count)]
+
+    edges = []
+    for index in range(count):
+        for position in range(graph.indptr[index], graph.indptr[index + 1]):
+            if graph.codes[position] == PARENT_CODE:
+                edges.append((index, graph.indices[position]))
+    depth = array('i', [0] * count)
+    for _ in range(count):
+        changed = False
+        for child, parent in edges:
+            if depth[parent] + 1 > depth[child]:
+                depth[child] = depth[parent] + 1
+                changed = True
+        if not changed:
+            break
+
+    degrees = [0] * (max(degree, default=-1) + 1)
+    for value in degree:
+        degrees[value] += 1
+    generation_counts = []
+    families = {}
+    for index in range(count):
+        family_id = graph.family_ids[index]
+        if not family_id:
+            continue
+        generation_counts.extend([0] * (depth[index] + 1 - len(generation_counts)))
+        generation_counts[depth[index]] += 1
+        size, generations = families.get(family_id, (0, 0))
+        families[family_id] = (size + 1, max(generations, depth[index] + 1))
+
+    return {
+        'degrees': degrees,
+        'orphan_ids': [graph.user_ids[index] for index in range(count) if not degree[index]],
+        'generation_counts': generation_counts,
+        'families': [(family_id, size, generations)
+                     for family_id, (size, generations) in sorted(families.items())]
+    }
+
+
+def compute_graph_stats(graph):
+    """
+    Degree distribution, generations, family sizes and users without
+    relatives of a CSRGraph, as plain data.
+    """
+    stats = _numpy_stats(graph) if np is not None else _python_stats(graph)
+    families = sorted(stats['families'], key=lambda family: (-family[1], family[0]))
+    return {
+        'users': len(graph),
+        # Every relation is stored in both directions
+        'relations': len(graph.indices) // 2,
+        'families': len(families),
+        'max_degree': len(stats['degrees']) - 1 if stats['degrees'] else 0,
+        'degree_histogram': _histogram(stats['degrees']),
+        'generation_histogram': [(depth + 1, count) for depth, count
+                                 in _histogram(stats['generation_counts'])],
+        'max_generations': max((family[2] for family in families), default=0),
+        'largest_families': [
+            {'family_id': family_id, 'size': size, 'generations': generations}
+            for family_id, size, generations in families[:LARGEST_FAMILIES]
+        ],
+        'orphans': len(stats['orphan_ids']),
+        'orphan_ids': stats['orphan_ids'][:ORPHAN_SAMPLE],
+        'backend': 'numpy' if np is not None else 'array'
+    }
+
+
+@cached(ttl=3600)
+def _graph_stats(db, version):
+    return compute_graph_stats(load_graph(db))
+
+
+def get_graph_stats(db):
+    """
+    Return the graph statistics, recomputed only when the tree version
+    has changed since they were last cached.
+    """
+    return _graph_stats(db, get_version(db, TREE_SCOPE))
@@ -0,0 +1,302 @@
+from sqlalchemy import delete, func, insert, or_
+from sqlalchemy.orm import aliased
+
+from flask import current_app as app
+
+from family_tree.models import (
+    Ancestry,
+    Relatives,
+    RelativesTypeEnum
+)
+from family_tree.utils import batched
+
+
+def get_parent_child(user_id, relative_user_id, relation_type):
+    """
+    Normalise a Relatives row into a (parent_id, child_id) pair.
+
+    Returns None if the relation is not a PARENT/CHILD edge.
+    """
+    relation_type = getattr(relation_type, 'value', relation_type)
+    if relation_type == RelativesTypeEnum.PARENT.value:
+        return relative_user_id, user_id
+    if relation_type == RelativesTypeEnum.CHILD.value:
+        return user_id, relative_user_id
+    return None
+
+
+def get_ancestors(db, user_id, max_distance=None):
+    """
+    Return [(ancestor_id, distance), ...] of a user, nearest first.
+    """
+    query = db.session.query(Ancestry.ancestor_id, Ancestry.distance).filter(
+        Ancestry.descendant_id == user_id)
+    if max_distance is not None:
+        query = query.filter(Ancestry.distance <= max_distance)
+    return query.order_by(Ancestry.distance, Ancestry.ancestor_id).all()
+
+
+def get_descendants(db, user_id, max_distance=None):
+    """
+    Return [(descendant_id, distance), ...] of a user, nearest first.
+    """
+    query = db.session.query(Ancestry.descendant_id, Ancestry.distance).filter(
+        Ancestry.ancestor_id == user_id)
+    if max_distance is not None:
+        query = query.filter(Ancestry.distance <= max_distance)
+    return query.order_by(Ancestry.distance, Ancestry.descendant_id).all()
+
+
+def is_ancestor(db, ancestor_id, descendant_id):
+    return db.session.get(Ancestry, (ancestor_id, descendant_id)) is not None
+
+
+def count_generations(db, user_id):
+    """
+    Number of generations in the line running through a user, counting
+    the user's own generation.
+    """
+    up = db.session.query(func.max(Ancestry.distance)).filter(
+        Ancestry.descendant_id == user_id).scalar() or 0
+    down = db.session.query(func.max(Ancestry.distance)).filter(
+        Ancestry.ancestor_id == user_id).scalar() or 0
+    return up + down + 1
+
+
+def get_common_ancestors(db, user_id, other_user_id):
+    """
+    Return [(ancestor_id, distance_from_user, distance_from_other), ...]
+    ordered so that the closest common ancestor comes first.
+    """
+    left = aliased(Ancestry)
+    right = aliased(Ancestry)
+    return (
+        db.session.query(left.ancestor_id, left.distance, right.distance)
+        .join(right, right.ancestor_id == left.ancestor_id)
+        .filter(left.descendant_id == user_id, right.descendant_id == other_user_id)
+        .order_by(left.distance + right.distance, left.ancestor_id)
+        .all()
+    )
+
+
+def _ancestor_map(db, user_ids):
+    """
+    Return {user_id: {ancestor_id: distance}} read from the closure table.
+    """
+    result = {user_id: {} for user_id in user_ids}
+    for batch in batched(user_ids):
+        rows = db.session.query(
+            Ancestry.descendant_id, Ancestry.ancestor_id, Ancestry.distance
+        ).filter(Ancestry.descendant_id.in_(batch))
+        for descendant_id, ancestor_id, distance in rows:
+            result[descendant_id][ancestor_id] = distance
+    return result
+
+
+def _parent_map(db, user_ids=None, excluded_ids=()):
+    """
+    Return {child_id: set(parent_ids)} built from the Relatives table.
+
+    If user_ids is given only the parents of those users are loaded.
+    Both directions of an edge are read so a missing reverse row does
+    not lose the relation.
+    """
+    parents = {}
+
+    def load(query):
+        for user_id, relative_user_id, relation_type in query:
+            edge = get_parent_child(user_id, relative_user_id, relation_type)
+            if edge is None or edge[0] in excluded_ids or edge[1] in excluded_ids:
+                continue
+            parents.setdefault(edge[1], set()).add(edge[0])
+
+    columns = (Relatives.user_id, Relatives.relative_user_id, Relatives.relation_type)
+    if user_ids is None:
+        load(db.session.query(*columns).filter(Relatives.relation_type.in_(
+            [RelativesTypeEnum.PARENT, RelativesTypeEnum.CHILD])))
+        return parents
+
+    for batch in batched(user_ids):
+        load(db.session.query(*columns).filter(
+            Relatives.user_id.in_(batch),
+            Relatives.relation_type == RelativesTypeEnum.PARENT))
+        load(db.session.query(*columns).filter(
+            Relatives.relative_user_id.in_(batch),
+            Relatives.relation_type == RelativesTypeEnum.CHILD))
+    return parents
+
+
+def _compute_closure(nodes, parents, external):
+    """
+    Compute {node: {ancestor_id: distance}} for every node in `nodes`.
+
+    `parents` maps a child to its parents; `external` holds the already
+    known closure of parents that are not part of `nodes`.
+    """
+    nodes = set(nodes)
+    children = {}
+    pending = {}
+    for node in nodes:
+        inside = [p for p in parents.get(node, ()) if p in nodes]
+        pending[node] = len(inside)
+        for parent_id in inside:
+            children.setdefault(parent_id, []).append(node)
+
+    # Kahn's algorithm so every parent is resolved before its children
+    ready = [node for node, count in pending.items() if count == 0]
+    order = []
+    while ready:
+        node = ready.pop()
+        order.append(node)
+        for child_id in children.get(node, ()):
+            pending[child_id] -= 1
+            if pending[child_id] == 0:
+                ready.append(child_id)
+    if len(order) < len(nodes):
+        app.logger.warning('Cycle detected in parent relations while building ancestry')
+        order.extend(node for node in nodes if pending[node] > 0)
+
+    closure = {}
+    for node in order:
+        ancestors = {}
+        for parent_id in parents.get(node, ()):
+            ancestors[parent_id] = 1
+            parent_ancestors = closure.get(parent_id)
+            if parent_ancestors is None:
+                parent_ancestors = external.get(parent_id, {})
+            for ancestor_id, distance in parent_ancestors.items():
+                if ancestor_id == node:
+                    continue
+                if distance + 1 < ancestors.get(ancestor_id, distance + 2):
+                    ancestors[ancestor_id] = distance + 1
+        closure[node] = ancestors
+    return closure
+
+
+def _insert_closure(db, closure):
+    rows = [
+        {'ancestor_id': ancestor_id, 'descendant_id': descendant_id, 'distance': distance}
+        for descendant_id, ancestors in closure.items()
+        for ancestor_id, distance in ancestors.items()
+    ]
+    for batch in batched(rows):
+        db.session.execute(insert(Ancestry), batch)
+    return len(rows)
+
+
+def add_parent_edge(db, parent_id, child_id):
+    """
+    Incrementally add a parent -> child edge to the closure table.
+
+    Every ancestor of the parent (and the parent itself) becomes an
+    ancestor of every descendant of the child (and the child itself).
+    The caller is responsible for committing.
+    """
+    if parent_id == child_id or is_ancestor(db, child_id, parent_id):
+        raise ValueError(
+            f'Adding {parent_id} as parent of {child_id} would create a cycle')
+
+    ancestors = dict(get_ancestors(db, parent_id))
+    ancestors[parent_id] = 0
+    descendants = dict(get_descendants(db, child_id))
+    descendants[child_id] = 0
+
+    existing = {}
+    for batch in batched(ancestors):
+        rows = db.session.query(Ancestry).filter(
+            Ancestry.ancestor_id.in_(batch),
+            Ancestry.descendant_id.in_(list(descendants)))
+        for row in rows:
+            existing[(row.ancestor_id, row.descendant_id)] = row
+
+    new_rows = []
+    for ancestor_id, up in ancestors.items():
+        for descendant_id, down in descendants.items():
+            distance = up + 1 + down
+            row = existing.get((ancestor_id, descendant_id))
+            if row is None:
+                new_rows.append({
+                    'ancestor_id': ancestor_id,
+                    'descendant_id': descendant_id,
+                    'distance': distance
+                })
+            elif distance < row.distance:
+                row.distance = distance
+    for batch in batched(new_rows):
+        db.session.execute(insert(Ancestry), batch)
+    db.session.flush()
+    app.logger.info(
+        f'Ancestry updated for parent {parent_id} -> child {child_id}: {len(new_rows)} new rows')
+
+
+def rebuild_ancestry_subtree(db, root_ids, excluded_ids=()):
+    """
+    Recompute the closure rows of the given users and all their descendants.
+
+    Used after a parent edge is removed, since the distances (or existence)
+    of ancestors below the removed edge can only be found again by looking
+    at the remaining parents. Users in excluded_ids are treated as if they
+    had no edges at all. The caller is responsible for committing.
+    """
+    excluded_ids = set(excluded_ids)
+    affected = set(root_ids) - excluded_ids
+    for batch in batched(list(affected)):
+        rows = db.session.query(Ancestry.descendant_id).filter(
+            Ancestry.ancestor_id.in_(batch))
+        affected.update(descendant_id for (descendant_id,) in rows)
+    affected -= excluded_ids
+    if not affected:
+        return 0
+
+    parents = _parent_map(db, affected, excluded_ids)
+    outside = {p for node in affected for p in parents.get(node, ()) if p not in affected}
+    external = _ancestor_map(db, outside)
+    for ancestors in external.values():
+        for excluded_id in excluded_ids:
+            ancestors.pop(excluded_id, None)
+    closure = _compute_closure(affected, parents, external)
+
+    for batch in batched(list(affected)):
+        db.session.execute(delete(Ancestry).where(Ancestry.descendant_id.in_(batch)))
+    count = _insert_closure(db, closure)
+    db.session.flush()
+    app.logger.info(f'Rebuilt ancestry of {len(affected)} users ({count} rows)')
+    return count
+
+
+def remove_parent_edge(db, parent_id, child_id):
+    """
+    Remove a parent -> child edge from the closure table. Must be called
+    after the Relatives rows are gone. The caller is responsible for committing.
+    """
+    return rebuild_ancestry_subtree(db, [child_id])
+
+
+def detach_user_from_ancestry(db, user_id):
+    """
+    Drop a user from the closure table before the user is deleted, and
+    recompute the ancestry of everyone who descends from them.
+    """
+    child_ids = [child_id for child_id, _ in get_descendants(db, user_id, max_distance=1)]
+    db.session.execute(delete(Ancestry).where(or_(
+        Ancestry.ancestor_id == user_id, Ancestry.descendant_id == user_id)))
+    rebuild_ancestry_subtree(db, child_ids, excluded_ids={user_id})
+
+
+def rebuild_ancestry(db):
+    """
+    Rebuild the whole closure table from the Relatives table in bulk.
+
+    Returns the number of rows written.
+    """
+    parents = _parent_map(db)
+    nodes = set(parents)
+    for parent_ids in parents.values():
+        nodes.update(parent_ids)
+    closure = _compute_closure(nodes, parents, {})
+
+    db.session.execute(delete(Ancestry))
+    count = _insert_closure(db, closure)
+    db.session.commit()
+    app.logger.info(f'Rebuilt ancestry table with {count} rows')
+    return count
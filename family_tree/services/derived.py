@@ -0,0 +1,272 @@
+from sqlalchemy import delete, insert, or_
+
+from flask import current_app as app
+
+from family_tree.models import (
+    User,
+    Ancestry,
+    DerivedRelationEnum,
+    DerivedRelative,
+    Person,
+    Relatives,
+    RelativesTypeEnum
+)
+from family_tree.utils import batched
+
+# Every derived relation is a path of at most four PARENT/CHILD/SPOUSE
+# edges (cousins: up, up, down, down), so a changed edge can only change
+# the relations of users within three edges of its ends.
+DERIVED_RADIUS = 3
+
+# A pair gets the first relation that applies
+DERIVED_ORDER = [
+    DerivedRelationEnum.GRANDPARENT,
+    DerivedRelationEnum.GRANDCHILD,
+    DerivedRelationEnum.SIBLING,
+    DerivedRelationEnum.HALFSIBLING,
+    DerivedRelationEnum.AUNT_UNCLE,
+    DerivedRelationEnum.NIECE_NEPHEW,
+    DerivedRelationEnum.COUSIN,
+    DerivedRelationEnum.PARENT_IN_LAW,
+    DerivedRelationEnum.CHILD_IN_LAW,
+    DerivedRelationEnum.SIBLING_IN_LAW
+]
+
+DERIVED_LABELS = {
+    DerivedRelationEnum.GRANDPARENT: 'Grandparent',
+    DerivedRelationEnum.GRANDCHILD: 'Grandchild',
+    DerivedRelationEnum.SIBLING: 'Sibling',
+    DerivedRelationEnum.HALFSIBLING: 'Half sibling',
+    DerivedRelationEnum.AUNT_UNCLE: 'Aunt/uncle',
+    DerivedRelationEnum.NIECE_NEPHEW: 'Niece/nephew',
+    DerivedRelationEnum.COUSIN: 'Cousin',
+    DerivedRelationEnum.PARENT_IN_LAW: 'Parent-in-law',
+    DerivedRelationEnum.CHILD_IN_LAW: 'Child-in-law',
+    DerivedRelationEnum.SIBLING_IN_LAW: 'Sibling-in-law'
+}
+
+
+class _Graph:
+    """
+    The part of the family graph needed to derive relations, loaded in
+    batches as it is reached: ancestors and descendants up to two
+    generations away from the closure table, and spouses from Relatives.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.up = {}
+        self.down = {}
+        self.spouses = {}
+        self.direct = {}
+
+    def load(self, user_ids):
+        user_ids = [user_id for user_id in set(user_ids) if user_id not in self.up]
+        for user_id in user_ids:
+            self.up[user_id], self.down[user_id] = {}, {}
+            self.spouses[user_id], self.direct[user_id] = set(), set()
+        for batch in batched(user_ids):
+            rows = self.db.session.query(
+                Ancestry.ancestor_id, Ancestry.descendant_id, Ancestry.distance
+            ).filter(or_(Ancestry.ancestor_id.in_(batch), Ancestry.descendant_id.in_(batch)),
+                     Ancestry.distance <= 2)
+            for ancestor_id, descendant_id, distance in rows:
+                if descendant_id in self.up:
+                    self.up[descendant_id][ancestor_id] = distance
+                if ancestor_id in self.down:
+                    self.down[ancestor_id][descendant_id] = distance
+            rows = self.db.session.query(
+                Relatives.user_id, Relatives.relative_user_id, Relatives.relation_type
+            ).filter(Relatives.user_id.in_(batch))
+            for user_id, relative_user_id, relation_type in rows:
+                self.direct[user_id].add(relative_user_id)
+                if relation_type == RelativesTypeEnum.SPOUSE:
+                    self.spouses[user_id].add(relative_user_id)
+
+    def parents(self, user_id):
+        return {other for other, distance in self.up[user_id].items() if distance == 1}
+
+    def grandparents(self, user_id):
+        return {other for other, distance in self.up[user_id].items() if distance == 2}
+
+    def children(self, user_id):
+        return {other for other, distance in self.down[user_id].items() if distance == 1}
+
+    def grandchildren(self, user_id):
+        return {other for other, distance in self.down[user_id].items() if distance == 2}
+
+    def siblings(self, user_id):
+        return {child_id for parent_id in self.parents(user_id)
+                for child_id in self.children(parent_id)} - {user_id}
+
+
+def _load_neighbourhood(graph, user_ids):
+    """
+    Load everything the relations of user_ids depend on, three rounds of
+    batched queries in all.
+    """
+    graph.load(user_ids)
+    graph.load({other for user_id in user_ids
+                for other in (*graph.up[user_id], *graph.spouses[user_id])})
+    graph.load({other for user_id in user_ids
+                for other in (*graph.siblings(user_id), *graph.children(user_id),
+                              *(parent_id for spouse_id in graph.spouses[user_id]
+                                for parent_id in graph.parents(spouse_id)))})
+
+
+def _derive(graph, user_id):
+    """
+    Return {relative_user_id: DerivedRelationEnum} for one loaded user.
+    """
+    parents = graph.parents(user_id)
+    grandparents = graph.grandparents(user_id)
+    children = graph.children(user_id)
+    spouses = graph.spouses[user_id]
+    siblings = graph.siblings(user_id)
+
+    candidates = {
+        DerivedRelationEnum.GRANDPARENT: grandparents,
+        DerivedRelationEnum.GRANDCHILD: graph.grandchildren(user_id),
+        # Half siblings each have a parent the other does not
+        DerivedRelationEnum.SIBLING: {
+            sibling_id for sibling_id in siblings
+            if parents <= graph.parents(sibling_id) or graph.parents(sibling_id) <= parents},
+        DerivedRelationEnum.HALFSIBLING: siblings,
+        DerivedRelationEnum.AUNT_UNCLE: {
+            child_id for grandparent_id in grandparents
+            for child_id in graph.children(grandparent_id)},
+        DerivedRelationEnum.NIECE_NEPHEW: {
+            grandchild_id for parent_id in parents
+            for grandchild_id in graph.grandchildren(parent_id)},
+        DerivedRelationEnum.COUSIN: {
+            grandchild_id for grandparent_id in grandparents
+            for grandchild_id in graph.grandchildren(grandparent_id)},
+        DerivedRelationEnum.PARENT_IN_LAW: {
+            parent_id for spouse_id in spouses for parent_id in graph.parents(spouse_id)},
+        DerivedRelationEnum.CHILD_IN_LAW: {
+            spouse_id for child_id in children for spouse_id in graph.spouses[child_id]},
+        DerivedRelationEnum.SIBLING_IN_LAW: {
+            *(sibling_id for spouse_id in spouses for sibling_id in graph.siblings(spouse_id)),
+            *(spouse_id for sibling_id in siblings for spouse_id in graph.spouses[sibling_id])}
+    }
+
+    # Direct relatives, ancestors and descendants are shown as such already
+    skip = {user_id} | graph.direct[user_id] | parents | children
+    relations = {}
+    for relation in DERIVED_ORDER:
+        for other_id in candidates[relation]:
+            if other_id not in skip and other_id not in relations:
+                relations[other_id] = relation
+    return relations
+
+
+def _write_derived(db, user_ids):
+    graph = _Graph(db)
+    _load_neighbourhood(graph, user_ids)
+    rows = [
+        {'user_id': user_id, 'relative_user_id': other_id, 'relation': relation}
+        for user_id in user_ids
+        for other_id, relation in _derive(graph, user_id).items()
+    ]
+    for batch in batched(rows):
+        db.session.execute(insert(DerivedRelative), batch)
+    return len(rows)
+
+
+def derived_neighbourhood(db, user_ids, radius=DERIVED_RADIUS):
+    """
+    Users within `radius` relations of user_ids, including themselves.
+    """
+    seen = set(user_ids)
+    frontier = list(seen)
+    for _ in range(radius):
+        next_frontier = []
+        for batch in batched(frontier):
+            rows = db.session.query(Relatives.relative_user_id).filter(
+                Relatives.user_id.in_(batch))
+            for (relative_user_id,) in rows:
+                if relative_user_id not in seen:
+                    seen.add(relative_user_id)
+                    next_frontier.append(relative_user_id)
+        if not next_frontier:
+            break
+        frontier = next_frontier
+    return seen
+
+
+def refresh_derived_relatives(db, user_ids):
+    """
+    Recompute the derived relations of the given users. The caller is
+    responsible for committing.
+    """
+    user_ids = list(set(user_ids))
+    for batch in batched(user_ids):
+        db.session.execute(delete(DerivedRelative).where(DerivedRelative.user_id.in_(batch)))
+    count = _write_derived(db, user_ids)
+    db.session.flush()
+    app.logger.info(f'Derived {count} relations for {len(user_ids)} users')
+    return count
+
+
+def update_derived_relatives(db, user_ids):
+    """
+    Bring the derived relations up to date after relations between the
+    given users were added or removed. Must be called after the Relatives
+    and Ancestry rows are updated. The caller is responsible for committing.
+    """
+    return refresh_derived_relatives(db, derived_neighbourhood(db, user_ids))
+
+
+def detach_user_from_derived(db, user_id):
+    """
+    Drop a user's derived relations before the user is deleted. Returns the
+    users whose relations must be refreshed once the user is gone.
+    """
+    affected = derived_neighbourhood(db, [user_id])
+    db.session.execute(delete(DerivedRelative).where(or_(
+        DerivedRelative.user_id == user_id, DerivedRelative.relative_user_id == user_id)))
+    affected.discard(user_id)
+    return affected
+
+
+def rebuild_derived_relatives(db):
+    """
+    Rebuild the whole derived relations table in bulk.
+
+    Returns the number of rows written.
+    """
+    user_ids = [user_id for (user_id,) in db.session.query(Relatives.user_id).distinct()]
+    db.session.execute(delete(DerivedRelative))
+    count = 0
+    for batch in batched(user_ids):
+        count += _write_derived(db, batch)
+    db.session.commit()
+    app.logger.info(f'Rebuilt derived relations table with {count} rows')
+    return count
+
+
+def get_derived_relatives(db, user_id):
+    """
+    Return the extended family of a user, closest relations first, with a
+    single query on the derived relations table.
+    """
+    order = {relation: index for index, relation in enumerate(DERIVED_ORDER)}
+    rows = (
+        db.session.query(DerivedRelative.relative_user_id, DerivedRelative.relation,
+                         Person.first_name, Person.last_name)
+        .join(Person, Person.user_id == DerivedRelative.relative_user_id)
+        .join(User, User.id == DerivedRelative.relative_user_id)
+        .filter(DerivedRelative.user_id == user_id, User.deleted_at.is_(None))
+        .all()
+    )
+    return [
+        {
+            'relative_user_id': relative_user_id,
+            'relationship': relation.value,
+            'label': DERIVED_LABELS[relation],
+            'first_name': first_name,
+            'last_name': last_name
+        }
+        for relative_user_id, relation, first_name, last_name
+        in sorted(rows, key=lambda row: (order[row[1]], row[3] or '', row[2] or '', row[0]))
+    ]
@@ -0,0 +1,173 @@
+"""
+Detection of users that describe the same person.
+
+Every Person carries a phonetic key (Soundex of the last and first name,
+kept up to date by the model), indexed so that only people whose names
+sound alike are compared: each block of people sharing a key is scored
+pair by pair, which stays far from comparing everyone with everyone.
+Pairs are scored on name similarity, gender and birth date in the
+find_duplicates job and stored as DuplicateCandidate rows for an admin
+to merge or dismiss.
+"""
+from datetime import datetime
+from difflib import SequenceMatcher
+from itertools import combinations
+
+from sqlalchemy import delete, func, insert, update
+
+from flask import current_app as app
+
+from family_tree.jobs import job
+from family_tree.models import (
+    DuplicateCandidate,
+    ImportantDates,
+    ImportantDateTypeEnum,
+    Person,
+    Relatives
+)
+from family_tree.services.tree import get_display_names
+from family_tree.utils import batched, name_key
+
+
+def _full_name(person):
+    names = (person['first_name'], person['middle_name'], person['last_name'])
+    return ' '.join(' '.join(name.lower().split()) for name in names if name)
+
+
+def score_pair(person, other):
+    """
+    Likelihood between 0 and 1 that two people are the same, from their
+    names, genders and birth dates.
+    """
+    score = SequenceMatcher(None, _full_name(person), _full_name(other)).ratio()
+    if person['gender'] != other['gender']:
+        score -= 0.2
+    birth, other_birth = person['birth'], other['birth']
+    if birth and other_birth:
+        if birth == other_birth:
+            score += 0.15
+        elif birth.year == other_birth.year:
+            score += 0.05
+        else:
+            score -= 0.3
+    return max(0.0, min(score, 1.0))
+
+
+def backfill_name_keys(db):
+    """
+    Set the phonetic key of people saved before it existed.
+    """
+    rows = db.session.query(Person.id, Person.first_name, Person.last_name).filter(
+        Person.name_key.is_(None)).all()
+    for batch in batched(rows):
+        db.session.execute(update(Person), [
+            {'id': person_id, 'name_key': name_key(first_name, last_name)}
+            for person_id, first_name, last_name in batch])
+    return len(rows)
+
+
+def _load_block_people(db, keys):
+    people = {}
+    rows = db.session.query(
+        Person.user_id, Person.first_name, Person.middle_name, Person.last_name,
+        Person.gender, Person.name_key
+    ).filter(Person.name_key.in_(keys))
+    for user_id, first_name, middle_name, last_name, gender, key in rows:
+        people[user_id] = {
+            'first_name': first_name, 'middle_name': middle_name, 'last_name': last_name,
+            'gender': gender, 'key': key, 'birth': None
+        }
+    for batch in batched(people):
+        births = db.session.query(ImportantDates.user_id, ImportantDates.date).filter(
+            ImportantDates.user_id.in_(batch),
+            ImportantDates.date_type == ImportantDateTypeEnum.BIRTH)
+        for user_id, birth in births:
+            people[user_id]['birth'] = birth
+    related = set()
+    for batch in batched(people):
+        related.update(db.session.query(Relatives.user_id, Relatives.relative_user_id).filter(
+            Relatives.user_id.in_(batch), Relatives.relative_user_id.in_(list(people))))
+    return people, related
+
+
+@job('find_duplicates')
+def find_duplicates(db, progress, min_score=None, max_block=None):
+    """
+    Score every pair of people sharing a phonetic key and replace the
+    open duplicate candidates with the pairs scoring at least min_score.
+    Dismissed pairs are kept and not suggested again.
+    """
+    min_score = app.config['DUPLICATES_MIN_SCORE'] if min_score is None else min_score
+    max_block = max_block or app.config['DUPLICATES_MAX_BLOCK']
+    backfill_name_keys(db)
+
+    blocks = db.session.query(Person.name_key, func.count(Person.id)).filter(
+        Person.name_key.isnot(None)).group_by(Person.name_key).having(func.count(Person.id) > 1).all()
+    keys = [key for key, size in blocks if size <= max_block]
+    if len(keys) < len(blocks):
+        app.logger.warning(f'Skipped {len(blocks) - len(keys)} name blocks larger than {max_block}')
+    dismissed = set(db.session.query(DuplicateCandidate.user_id, DuplicateCandidate.other_user_id)
+                    .filter(DuplicateCandidate.dismissed == True))
+    db.session.execute(delete(DuplicateCandidate).where(DuplicateCandidate.dismissed == False))
+
+    candidates = []
+    compared = 0
+    key_batches = list(batched(keys, 100))
+    for number, key_batch in enumerate(key_batches, start=1):
+        people, related = _load_block_people(db, key_batch)
+        by_key = {}
+        for user_id in sorted(people):
+            by_key.setdefault(people[user_id]['key'], []).append(user_id)
+        for user_ids in by_key.values():
+            for user_id, other_user_id in combinations(user_ids, 2):
+                compared += 1
+                # Relatives of each other are different people
+                if (user_id, other_user_id) in related or (user_id, other_user_id) in dismissed:
+                    continue
+                score = score_pair(people[user_id], people[other_user_id])
+                if score >= min_score:
+                    candidates.append({'user_id': user_id, 'other_user_id': other_user_id,
+                                       'score': score, 'dismissed': False,
+                                       'created_at': datetime.utcnow()})
+        progress(number / len(key_batches) * 0.9, f'Compared {compared} pairs')
+
+    for batch in batched(candidates):
+        db.session.execute(insert(DuplicateCandidate), batch)
+    db.session.commit()
+    app.logger.info(f'Found {len(candidates)} duplicate candidates in {compared} pairs')
+    return {'blocks': len(keys), 'compared': compared, 'candidates': len(candidates)}
+
+
+def get_duplicate_candidates(db, limit=100):
+    """
+    Return the open candidates, most likely first, with both names.
+    """
+    rows = (
+        db.session.query(DuplicateCandidate)
+        .filter(DuplicateCandidate.dismissed == False)
+        .order_by(DuplicateCandidate.score.desc(), DuplicateCandidate.user_id)
+        .limit(limit)
+        .all()
+    )
+    names = get_display_names(
+        db, {user_id for row in rows for user_id in (row.user_id, row.other_user_id)})
+    return [
+        {
+            'user_id': row.user_id,
+            'other_user_id': row.other_user_id,
+            'name': names.get(row.user_id),
+            'other_name': names.get(row.other_user_id),
+            'score': row.score
+        }
+        for row in rows
+    ]
+
+
+def dismiss_duplicate(db, user_id, other_user_id):
+    candidate = db.session.get(DuplicateCandidate, (min(user_id, other_user_id),
+                                                    max(user_id, other_user_id)))
+    if candidate is None:
+        return False
+    candidate.dismissed = True
+    db.session.commit()
+    return True
@@ -0,0 +1,107 @@
+from datetime import date, timedelta
+
+from sqlalchemy import Integer, and_, cast, func, or_, true, update
+
+from family_tree.models import (
+    Person,
+    ImportantDates,
+    Relatives
+)
+from family_tree.services.tree import not_deleted
+
+EVENT_LABELS = {
+    'BIRTH': 'Birthday',
+    'MARRIAGE': 'Anniversary',
+    'DEATH': 'Remembrance'
+}
+
+
+def month_day(value):
+    return value.month * 100 + value.day
+
+
+def _window_filter(column, today, days):
+    end = today + timedelta(days=days)
+    if end.year == today.year:
+        return column.between(month_day(today), month_day(end))
+    return or_(column >= month_day(today), column <= month_day(end))
+
+
+def month_day_filter(today, days):
+    """
+    Filter on ImportantDates.month_day matching the next `days` days,
+    wrapping around the end of the year, as a range on its index.
+    """
+    if days >= 365:
+        return true()
+    return _window_filter(ImportantDates.month_day, today, days)
+
+
+def backfill_month_days(db):
+    """
+    Set month_day on dates written by bulk statements that skip the
+    model, which the upcoming events filter would not find. Returns the
+    number of rows updated.
+    """
+    computed = (cast(func.strftime('%m', ImportantDates.date), Integer) * 100
+                + cast(func.strftime('%d', ImportantDates.date), Integer))
+    count = db.session.execute(
+        update(ImportantDates).where(ImportantDates.month_day.is_(None)).values(month_day=computed)
+    ).rowcount
+    db.session.commit()
+    return count
+
+
+def next_occurrence(value, today):
+    """
+    Next anniversary of a date on or after today. 29 February is
+    celebrated on 1 March in non leap years.
+    """
+    for year in (today.year, today.year + 1):
+        try:
+            occurrence = date(year, value.month, value.day)
+        except ValueError:
+            occurrence = date(year, 3, 1)
+        if occurrence >= today:
+            return occurrence
+
+
+def get_upcoming_events(db, user_id, today=None, days=30, limit=None):
+    """
+    Return the birthdays, anniversaries and remembrance days of a user and
+    their relatives in the next `days` days, soonest first.
+
+    The date window is matched against the indexed month_day column and
+    joined to the user's relations in SQL, so only matching events are
+    loaded.
+    """
+    today = today or date.today()
+    rows = (
+        db.session.query(
+            ImportantDates.user_id, ImportantDates.date_type, ImportantDates.date,
+            Person.first_name, Person.last_name, Relatives.relation_type)
+        .outerjoin(Relatives, and_(Relatives.relative_user_id == ImportantDates.user_id,
+                                   Relatives.user_id == user_id))
+        .outerjoin(Person, Person.user_id == ImportantDates.user_id)
+        .filter(month_day_filter(today, days))
+        .filter(or_(ImportantDates.user_id == user_id, Relatives.id.isnot(None)))
+        .filter(not_deleted(ImportantDates.user_id))
+        .all()
+    )
+
+    events = []
+    for event_user_id, date_type, event_date, first_name, last_name, relation_type in rows:
+        occurrence = next_occurrence(event_date, today)
+        events.append({
+            'user_id': event_user_id,
+            'name': f'{first_name} {last_name}' if first_name else None,
+            'relation': relation_type.value if relation_type else None,
+            'date_type': date_type.value,
+            'label': EVENT_LABELS[date_type.value],
+            'date': event_date,
+            'next_date': occurrence,
+            'days_until': (occurrence - today).days,
+            'years': occurrence.year - event_date.year
+        })
+    events.sort(key=lambda event: (event['days_until'], event['name'] or ''))
+    return events[:limit] if limit else events
@@ -0,0 +1,169 @@
+import csv
+import io
+import json
+from itertools import groupby
+
+from sqlalchemy.orm import aliased
+
+from family_tree.models import (
+    User,
+    Person,
+    Address,
+    ImportantDates,
+    ContactDetails,
+    Relatives
+)
+from family_tree.utils import BATCH_SIZE
+
+USER_COLUMNS = ('id', 'username', 'email', 'first_name', 'middle_name', 'last_name', 'gender')
+CONTACT_COLUMNS = ('country_code', 'mobile_no', 'contact_email')
+USER_TABLE_COLUMNS = USER_COLUMNS + CONTACT_COLUMNS
+
+RECORD_COLUMNS = ('section', 'item', 'field', 'value')
+
+
+def _plain(value):
+    """
+    Make enum and date values JSON/CSV friendly.
+    """
+    if hasattr(value, 'value'):
+        return value.value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def _rows(query, columns, batch_size):
+    for values in query.yield_per(batch_size):
+        yield dict(zip(columns, map(_plain, values)))
+
+
+def iter_csv(columns, rows, batch_size=BATCH_SIZE):
+    """
+    Serialise dict rows as CSV, one chunk per batch of rows.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    for index, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if index % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# Admin user table
+
+def iter_user_table(db, batch_size=BATCH_SIZE):
+    """
+    Yield one row per user and contact (or one row for a user without
+    contacts), read with a server side cursor so memory stays flat.
+    """
+    query = (
+        db.session.query(
+            User.id, User.username, User.email,
+            Person.first_name, Person.middle_name, Person.last_name, Person.gender,
+            ContactDetails.country_code, ContactDetails.mobile_no, ContactDetails.email)
+        .outerjoin(Person, Person.user_id == User.id)
+        .outerjoin(ContactDetails, ContactDetails.user_id == User.id)
+        .filter(User.is_admin == False, User.deleted_at.is_(None))
+        .order_by(User.id, ContactDetails.id)
+    )
+    return _rows(query, USER_TABLE_COLUMNS, batch_size)
+
+
+def iter_user_table_json(rows):
+    """
+    Serialise user table rows as a JSON list with one object per user and
+    their contacts nested, relying on the rows being ordered by user.
+    """
+    yield '['
+    for index, (_, user_rows) in enumerate(groupby(rows, key=lambda row: row['id'])):
+        user_rows = list(user_rows)
+        user = {column: user_rows[0][column] for column in USER_COLUMNS}
+        user['contacts'] = [
+            {column: row[column] for column in CONTACT_COLUMNS}
+            for row in user_rows
+            if any(row[column] is not None for column in CONTACT_COLUMNS)
+        ]
+        yield (', ' if index else '') + json.dumps(user)
+    yield ']'
+
+
+# A user's own record
+
+def iter_user_record(db, user_id, batch_size=BATCH_SIZE):
+    """
+    Yield (section, item) pairs for everything stored about a user:
+    profile, addresses, important dates, contact details and relatives.
+    """
+    profile = (
+        db.session.query(User.id, User.username, User.email, Person.first_name,
+                         Person.middle_name, Person.last_name, Person.gender)
+        .outerjoin(Person, Person.user_id == User.id)
+        .filter(User.id == user_id)
+    )
+    for row in _rows(profile, USER_COLUMNS, batch_size):
+        yield 'profile', row
+
+    sections = (
+        ('addresses', Address, ('id', 'is_permanent', 'first_line', 'second_line',
+                                'landmark', 'pin_code', 'state', 'country')),
+        ('important_dates', ImportantDates, ('id', 'date_type', 'date')),
+        ('contact_details', ContactDetails, ('id', 'country_code', 'mobile_no', 'email'))
+    )
+    for section, model, columns in sections:
+        query = (
+            db.session.query(*[getattr(model, column) for column in columns])
+            .filter(model.user_id == user_id)
+            .order_by(model.id)
+        )
+        for row in _rows(query, columns, batch_size):
+            yield section, row
+
+    relative = aliased(Person)
+    relatives = (
+        db.session.query(Relatives.relative_user_id, Relatives.relation_type,
+                         relative.first_name, relative.last_name)
+        .outerjoin(relative, relative.user_id == Relatives.relative_user_id)
+        .filter(Relatives.user_id == user_id)
+        .order_by(Relatives.id)
+    )
+    columns = ('relative_user_id', 'relation_type', 'first_name', 'last_name')
+    for row in _rows(relatives, columns, batch_size):
+        yield 'relatives', row
+
+
+def iter_user_record_csv(items, batch_size=BATCH_SIZE):
+    """
+    Flatten a user's record into section, item, field, value rows.
+    """
+    def rows():
+        counts = {}
+        for section, item in items:
+            counts[section] = counts.get(section, 0) + 1
+            for field, value in item.items():
+                yield {'section': section, 'item': counts[section], 'field': field, 'value': value}
+    return iter_csv(RECORD_COLUMNS, rows(), batch_size)
+
+
+def iter_user_record_json(items):
+    """
+    Serialise a user's record as one JSON object with the profile and a
+    list per section.
+    """
+    yield '{'
+    first = True
+    for section, section_items in groupby(items, key=lambda item: item[0]):
+        prefix = '' if first else ', '
+        first = False
+        if section == 'profile':
+            yield prefix + f'"profile": {json.dumps(next(section_items)[1])}'
+            continue
+        yield prefix + f'{json.dumps(section)}: ['
+        for index, (_, item) in enumerate(section_items):
+            yield (', ' if index else '') + json.dumps(item)
+        yield ']'
+    yield '}'
@@ -0,0 +1,246 @@
+from sqlalchemy import delete, update
+
+from flask import current_app as app
+
+from family_tree.models import (
+    User,
+    Family,
+    Relatives,
+    TreeLayout
+)
+from family_tree.jobs import job
+from family_tree.utils import batched
+
+
+def get_family_id(db, user_id):
+    return db.session.query(User.family_id).filter(User.id == user_id).scalar()
+
+
+def get_family_member_ids(db, family_id):
+    return [
+        user_id for (user_id,) in
+        db.session.query(User.id).filter(User.family_id == family_id).order_by(User.id)
+    ]
+
+
+def get_families(db, limit=None):
+    """
+    Return families ordered from largest to smallest.
+    """
+    query = db.session.query(Family).order_by(Family.size.desc(), Family.id)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def _neighbour_ids(db, user_ids):
+    for batch in batched(user_ids):
+        rows = db.session.query(Relatives.relative_user_id).filter(
+            Relatives.user_id.in_(batch))
+        for (relative_user_id,) in rows:
+            yield relative_user_id
+
+
+def _set_family(db, user_ids, family_id):
+    for batch in batched(user_ids):
+        db.session.execute(
+            update(User).where(User.id.in_(batch)).values(family_id=family_id))
+
+
+def _delete_family(db, family_id):
+    db.session.execute(delete(TreeLayout).where(TreeLayout.component_id == family_id))
+    db.session.execute(delete(Family).where(Family.id == family_id))
+
+
+def _new_family(db, user_ids):
+    family = Family(size=len(user_ids), version=1)
+    db.session.add(family)
+    db.session.flush()
+    _set_family(db, user_ids, family.id)
+    return family
+
+
+def union_families(db, user_id, relative_user_id):
+    """
+    Join the families of two users after a relation between them is added.
+
+    This is a union-find where every member points straight at its root
+    (the Family row): the smaller family is relabelled into the larger one
+    with a single UPDATE, so lookups stay O(1). The caller is responsible
+    for committing.
+    """
+    family_id = get_family_id(db, user_id)
+    relative_family_id = get_family_id(db, relative_user_id)
+
+    if family_id is None and relative_family_id is None:
+        family = _new_family(db, [user_id, relative_user_id])
+    elif family_id == relative_family_id:
+        family = db.session.get(Family, family_id)
+        family.version += 1
+    elif family_id is None or relative_family_id is None:
+        family = db.session.get(Family, family_id or relative_family_id)
+        _set_family(db, [user_id if family_id is None else relative_user_id], family.id)
+        family.size += 1
+        family.version += 1
+    else:
+        family, other = db.session.get(Family, family_id), db.session.get(Family, relative_family_id)
+        if family.size < other.size:
+            family, other = other, family
+        db.session.execute(
+            update(User).where(User.family_id == other.id).values(family_id=family.id))
+        family.size += other.size
+        family.version += 1
+        app.logger.info(f'Merged family {other.id} into family {family.id}')
+        _delete_family(db, other.id)
+    db.session.flush()
+    return family.id
+
+
+def _find_separated_side(db, user_id, relative_user_id):
+    """
+    Search outwards from both users at once, always expanding the smaller
+    frontier. Returns None if they are still connected, otherwise the full
+    set of users on the side that ran out first (the smaller side).
+    """
+    sides = [{user_id}, {relative_user_id}]
+    frontiers = [[user_id], [relative_user_id]]
+    while True:
+        index = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+        if not frontiers[index]:
+            return sides[index]
+        next_frontier = []
+        for neighbour_id in _neighbour_ids(db, frontiers[index]):
+            if neighbour_id in sides[1 - index]:
+                return None
+            if neighbour_id not in sides[index]:
+                sides[index].add(neighbour_id)
+                next_frontier.append(neighbour_id)
+        frontiers[index] = next_frontier
+
+
+def _split_off(db, family, user_ids):
+    """
+    Move a component that is no longer connected to the rest of the family
+    into its own family (or none if it is a single unconnected user).
+    """
+    family.size -= len(user_ids)
+    family.version += 1
+    if len(user_ids) > 1:
+        new_family = _new_family(db, user_ids)
+        app.logger.info(f'Split family {new_family.id} off family {family.id}')
+    else:
+        _set_family(db, user_ids, None)
+
+    if family.size <= 1:
+        _set_family(db, get_family_member_ids(db, family.id), None)
+        _delete_family(db, family.id)
+
+
+def split_families(db, user_id, relative_user_id):
+    """
+    Detect whether removing the relation between two users split their
+    family, and if so give the separated side a family of its own. Must
+    be called after the Relatives rows are gone. The caller is
+    responsible for committing.
+    """
+    family_id = get_family_id(db, user_id)
+    if family_id is None:
+        return
+    family = db.session.get(Family, family_id)
+    separated = _find_separated_side(db, user_id, relative_user_id)
+    if separated is None:
+        family.version += 1
+    else:
+        _split_off(db, family, separated)
+    db.session.flush()
+
+
+def refresh_family(db, family_id):
+    """
+    Recompute the components of a family from scratch, e.g. after one of
+    its members was deleted together with all of their relations.
+    """
+    members = set(get_family_member_ids(db, family_id))
+    family = db.session.get(Family, family_id)
+    if family is None:
+        return
+    if not members:
+        _delete_family(db, family_id)
+        return
+
+    components = []
+    remaining = set(members)
+    while remaining:
+        start = remaining.pop()
+        component = {start}
+        frontier = [start]
+        while frontier:
+            frontier = [n for n in set(_neighbour_ids(db, frontier)) if n not in component]
+            component.update(frontier)
+        components.append(component)
+        remaining -= component
+
+    components.sort(key=len, reverse=True)
+    family.size = len(members)
+    family.version += 1
+    for component in components[1:]:
+        _split_off(db, family, component)
+    if family.size <= 1 and len(components) == 1:
+        _set_family(db, members, None)
+        _delete_family(db, family_id)
+    db.session.flush()
+
+
+def rebuild_families(db):
+    """
+    Recompute every family from the Relatives table in bulk.
+
+    Returns the number of families.
+    """
+    parent = {}
+
+    def find(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    rows = db.session.query(Relatives.user_id, Relatives.relative_user_id).yield_per(1000)
+    for user_id, relative_user_id in rows:
+        root, other = find(user_id), find(relative_user_id)
+        if root != other:
+            parent[max(root, other)] = min(root, other)
+
+    components = {}
+    for node in parent:
+        components.setdefault(find(node), []).append(node)
+
+    db.session.execute(update(User).values(family_id=None))
+    db.session.execute(delete(TreeLayout))
+    db.session.execute(delete(Family))
+    for member_ids in components.values():
+        _new_family(db, member_ids)
+    db.session.commit()
+    app.logger.info(f'Rebuilt {len(components)} families')
+    return len(components)
+
+
+@job('rebuild_graph')
+def rebuild_graph(db, progress):
+    """
+    Rebuild the ancestry closure, the families, the derived relations and
+    the graph index from the Relatives table.
+    """
+    from family_tree.graph_index import rebuild_graph_index
+    from family_tree.services.ancestry import rebuild_ancestry
+    from family_tree.services.derived import rebuild_derived_relatives
+
+    ancestry_rows = rebuild_ancestry(db)
+    progress(0.4, f'Rebuilt {ancestry_rows} ancestry rows')
+    families = rebuild_families(db)
+    progress(0.6, f'Rebuilt {families} families')
+    derived_rows = rebuild_derived_relatives(db)
+    progress(0.9, f'Rebuilt {derived_rows} derived relations')
+    rebuild_graph_index(db)
+    return {'ancestry_rows': ancestry_rows, 'families': families, 'derived_rows': derived_rows}
@@ -0,0 +1,441 @@
+import io
+import re
+import secrets
+from datetime import date
+
+from sqlalchemy import insert, or_, select
+from sqlalchemy.orm import selectinload
+
+from flask import current_app as app
+
+from family_tree import bcrypt
+from family_tree.models import (
+    User,
+    GenderEnum,
+    Person,
+    Address,
+    ImportantDates,
+    ImportantDateTypeEnum,
+    Relatives,
+    RelativesTypeEnum
+)
+from family_tree.services.ancestry import rebuild_ancestry
+from family_tree.graph_index import rebuild_graph_index
+from family_tree.services.derived import rebuild_derived_relatives
+from family_tree.services.family import rebuild_families
+from family_tree.services.imports import ImportState, validate_relation
+from family_tree.services.versions import TREE_SCOPE, bump_version
+from family_tree.utils import BATCH_SIZE, batched
+
+MONTHS = ('JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+          'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC')
+
+GEDCOM_SEX = {GenderEnum.MALE: 'M', GenderEnum.FEMALE: 'F', GenderEnum.OTHER: 'U'}
+SEX_GENDER = {'M': GenderEnum.MALE, 'F': GenderEnum.FEMALE}
+
+EVENT_TAGS = {'BIRT': ImportantDateTypeEnum.BIRTH, 'DEAT': ImportantDateTypeEnum.DEATH}
+DATE_EVENTS = {value: tag for tag, value in EVENT_TAGS.items()}
+
+LINE_PATTERN = re.compile(r'^\s*(\d+)\s+(?:(@[^@\s]+@)\s+)?(\S+)(?: (.*))?$')
+DATE_PATTERN = re.compile(r'^(?:(?:ABT|CAL|EST)\s+)?(\d{1,2})\s+([A-Z]{3})\s+(\d{3,4})$')
+
+
+# Parsing
+
+def iter_gedcom_lines(stream):
+    """
+    Yield (level, xref, tag, value) for every line of a GEDCOM file.
+
+    Binary streams are decoded as UTF-8, which covers GEDCOM 7 and the
+    UTF-8/ASCII variants of 5.5.1. Blank and malformed lines are skipped.
+    """
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace')
+    for number, line in enumerate(stream, start=1):
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+        match = LINE_PATTERN.match(line)
+        if match is None:
+            app.logger.warning(f'Skipping malformed GEDCOM line {number}')
+            continue
+        level, xref, tag, value = match.groups()
+        yield int(level), xref, tag.upper(), value or ''
+
+
+def iter_gedcom_records(lines):
+    """
+    Group GEDCOM lines into level 0 records.
+
+    Each record is a nested {'tag', 'xref', 'value', 'children'} dict. Only
+    the record being read is held in memory, and CONT/CONC lines are folded
+    into the value of the line they continue.
+    """
+    record = None
+    stack = []
+    for level, xref, tag, value in lines:
+        if level == 0:
+            if record is not None:
+                yield record
+            record = {'tag': tag, 'xref': xref, 'value': value, 'children': []}
+            stack = [record]
+            continue
+        if record is None:
+            continue
+        del stack[level:]
+        parent = stack[-1]
+        if tag == 'CONT':
+            parent['value'] += '\n' + value
+        elif tag == 'CONC':
+            parent['value'] += value
+        else:
+            node = {'tag': tag, 'xref': xref, 'value': value, 'children': []}
+            parent['children'].append(node)
+            stack.append(node)
+    if record is not None:
+        yield record
+
+
+def _find(node, tag):
+    return next((child for child in node['children'] if child['tag'] == tag), None)
+
+
+def _find_all(node, tag):
+    return [child for child in node['children'] if child['tag'] == tag]
+
+
+def _value(node, tag):
+    child = _find(node, tag) if node else None
+    return child['value'].strip() if child else ''
+
+
+def parse_gedcom_date(value):
+    """
+    Parse an exact (or ABT/CAL/EST qualified) GEDCOM date such as
+    '12 JAN 1990'. Partial dates and ranges return None.
+    """
+    match = DATE_PATTERN.match(value.strip().upper())
+    if match is None or match.group(2) not in MONTHS:
+        return None
+    day, month, year = match.groups()
+    try:
+        return date(int(year), MONTHS.index(month) + 1, int(day))
+    except ValueError:
+        return None
+
+
+def format_gedcom_date(value):
+    return f'{value.day} {MONTHS[value.month - 1]} {value.year}'
+
+
+def _parse_name(record):
+    """
+    Return (first_name, middle_name, last_name) of an INDI record.
+    """
+    name = _find(record, 'NAME')
+    if name is None:
+        return '', None, ''
+    given = _value(name, 'GIVN')
+    surname = _value(name, 'SURN')
+    if not given and not surname:
+        parts = name['value'].split('/')
+        given = parts[0].strip()
+        surname = parts[1].strip() if len(parts) > 1 else ''
+    first_name, _, middle_name = given.partition(' ')
+    return first_name[:100], middle_name.strip()[:100] or None, surname[:100]
+
+
+def _parse_address(node):
+    address = _find(node, 'ADDR')
+    if address is None:
+        return None
+    lines = address['value'].split('\n')
+    first_line = _value(address, 'ADR1') or lines[0].strip() or _value(address, 'CITY')
+    state = _value(address, 'STAE') or _value(address, 'CITY')
+    country = _value(address, 'CTRY')
+    pin_code = re.sub(r'\D', '', _value(address, 'POST'))
+    if not (first_line and state and country and pin_code):
+        return None
+    return {
+        'first_line': first_line[:255],
+        'second_line': (_value(address, 'ADR2') or (lines[1].strip() if len(lines) > 1 else ''))[:255] or None,
+        'landmark': _value(address, 'ADR3')[:255] or None,
+        'pin_code': int(pin_code),
+        'state': state[:100],
+        'country': country[:100]
+    }
+
+
+def _build_user(record, username, password_hash):
+    """
+    Turn an INDI record into an unsaved User with its profile, dates and
+    addresses attached.
+    """
+    first_name, middle_name, last_name = _parse_name(record)
+    user = User(username=username, email=f'{username}@gedcom.invalid',
+                password_hash=password_hash, is_admin=False)
+    user.person = Person(
+        first_name=first_name, middle_name=middle_name, last_name=last_name,
+        gender=SEX_GENDER.get(_value(record, 'SEX').upper(), GenderEnum.OTHER))
+
+    for tag, date_type in EVENT_TAGS.items():
+        event_date = parse_gedcom_date(_value(_find(record, tag), 'DATE'))
+        if event_date:
+            user.important_dates.append(ImportantDates(date_type=date_type, date=event_date))
+
+    # The app keeps at most one permanent and one current address
+    addresses = [address for address in map(_parse_address, _find_all(record, 'RESI')) if address]
+    for is_permanent, address in zip((True, False), addresses):
+        user.addresses.append(Address(is_permanent=is_permanent, **address))
+    return user
+
+
+def _parse_family(record):
+    """
+    Return (partner_xrefs, child_xrefs, marriage_date) of a FAM record.
+    """
+    partners = [_value(record, tag) for tag in ('HUSB', 'WIFE')]
+    partners = [xref for xref in partners if xref and xref != '@VOID@']
+    children = [child['value'].strip() for child in _find_all(record, 'CHIL')
+                if child['value'].strip() != '@VOID@']
+    return partners, children, parse_gedcom_date(_value(_find(record, 'MARR'), 'DATE'))
+
+
+def _family_relations(partner_ids, child_ids):
+    """
+    Yield (user_id, relative_user_id, relation_type) for every relation
+    implied by a family, in one direction; the reverse rows are added when
+    the relation is saved.
+    """
+    if len(partner_ids) == 2:
+        yield partner_ids[0], partner_ids[1], 'SPOUSE'
+    for index, child_id in enumerate(child_ids):
+        for parent_id in partner_ids:
+            yield child_id, parent_id, 'PARENT'
+        for sibling_id in child_ids[index + 1:]:
+            yield child_id, sibling_id, 'SIBLING'
+
+
+def import_gedcom(db, stream, batch_size=BATCH_SIZE):
+    """
+    Import the individuals and families of a GEDCOM 5.5.1 or 7 file.
+
+    Records are parsed one at a time. Every INDI becomes a User with a
+    Person, BIRT/DEAT dates and up to two RESI addresses, written in
+    batches; imported accounts get a random, unknown password. FAM records
+    are reduced to id tuples and turned into Relatives rows (spouses,
+    parents/children and siblings) once every individual has an id, after
+    which the ancestry and family tables are rebuilt. Every relation is
+    checked with the same rules as import_relatives, relations breaking
+    them are skipped, and the accepted ones are written in batches with
+    their reverse rows.
+
+    Returns {'individuals': int, 'families': int, 'relations': int,
+    'skipped': int}, where relations counts the rows written.
+    """
+    prefix = f'gedcom_{secrets.token_hex(3)}_'
+    password_hash = bcrypt.generate_password_hash(secrets.token_urlsafe(32)).decode('utf-8')
+    user_ids = {}
+    families = []
+    pending = []
+
+    def save_users():
+        db.session.add_all(user for _, user in pending)
+        db.session.flush()
+        for xref, user in pending:
+            user_ids[xref] = user.id
+        db.session.commit()
+        db.session.expunge_all()
+        pending.clear()
+
+    for record in iter_gedcom_records(iter_gedcom_lines(stream)):
+        if record['tag'] == 'INDI' and record['xref']:
+            username = prefix + record['xref'].strip('@').lower()
+            pending.append((record['xref'], _build_user(record, username[:100], password_hash)))
+            if len(pending) >= batch_size:
+                save_users()
+        elif record['tag'] == 'FAM':
+            families.append(_parse_family(record))
+    if pending:
+        save_users()
+
+    state = ImportState(db, user_ids.values())
+    relations = []
+    marriages = []
+    counts = {'relations': 0, 'skipped': 0}
+
+    def save_relations():
+        db.session.execute(insert(Relatives), relations)
+        counts['relations'] += len(relations)
+        relations.clear()
+
+    for partners, children, marriage_date in families:
+        partner_ids = [user_ids[xref] for xref in partners if xref in user_ids]
+        child_ids = [user_ids[xref] for xref in children if xref in user_ids]
+        for user_id, relative_user_id, relation_type in _family_relations(partner_ids, child_ids):
+            error = validate_relation(db, state, user_id, relative_user_id, relation_type)
+            if error:
+                # Families listing a relation twice are common, only log real conflicts
+                if error != 'This relationship already exists':
+                    app.logger.warning(f'Skipping GEDCOM relation {user_id}-{relative_user_id}: {error}')
+                counts['skipped'] += 1
+                continue
+            reverse_type = Relatives.get_reverse_relation(relation_type)
+            relations.append({'user_id': user_id, 'relative_user_id': relative_user_id,
+                              'relation_type': RelativesTypeEnum(relation_type)})
+            relations.append({'user_id': relative_user_id, 'relative_user_id': user_id,
+                              'relation_type': RelativesTypeEnum(reverse_type)})
+            state.accept(user_id, relative_user_id, relation_type)
+            state.accept(relative_user_id, user_id, reverse_type)
+            if len(relations) >= batch_size:
+                save_relations()
+        if marriage_date and len(partner_ids) == 2:
+            marriages.extend(
+                ImportantDates(user_id=user_id, date_type=ImportantDateTypeEnum.MARRIAGE,
+                               date=marriage_date)
+                for user_id in partner_ids)
+    if relations:
+        save_relations()
+
+    for batch in batched(marriages, batch_size):
+        db.session.add_all(batch)
+        db.session.flush()
+    # Core inserts skip the flush listener, so bump the tree version here
+    bump_version(db.session, TREE_SCOPE)
+    db.session.commit()
+
+    rebuild_ancestry(db)
+    rebuild_families(db)
+    rebuild_derived_relatives(db)
+    rebuild_graph_index(db)
+    app.logger.info(
+        f'Imported {len(user_ids)} individuals, {len(families)} families and '
+        f'{counts["relations"]} relations from GEDCOM, skipped {counts["skipped"]}')
+    return {'individuals': len(user_ids), 'families': len(families), **counts}
+
+
+# Export
+
+def _load_export_families(db):
+    """
+    Group parent relations into GEDCOM families keyed by the sorted tuple of
+    partner ids, plus childless couples. Only ids are held in memory, and
+    relations of admins and deleted users are left out with them.
+    """
+    hidden = set(db.session.scalars(select(User.id).where(
+        or_(User.is_admin == True, User.deleted_at.isnot(None)))))
+    parents_of = {}
+    rows = db.session.query(Relatives.user_id, Relatives.relative_user_id).filter(
+        Relatives.relation_type == RelativesTypeEnum.PARENT).yield_per(BATCH_SIZE)
+    for child_id, parent_id in rows:
+        if child_id not in hidden and parent_id not in hidden:
+            parents_of.setdefault(child_id, []).append(parent_id)
+
+    families = {}
+    rows = db.session.query(Relatives.user_id, Relatives.relative_user_id).filter(
+        Relatives.relation_type == RelativesTypeEnum.SPOUSE,
+        Relatives.user_id < Relatives.relative_user_id).yield_per(BATCH_SIZE)
+    for user_id, relative_user_id in rows:
+        if user_id not in hidden and relative_user_id not in hidden:
+            families.setdefault((user_id, relative_user_id), [])
+    for child_id, parent_ids in parents_of.items():
+        families.setdefault(tuple(sorted(parent_ids)), []).append(child_id)
+
+    partner_ids = {partner_id for partners in families for partner_id in partners}
+    genders = {}
+    for batch in batched(partner_ids):
+        genders.update(db.session.query(Person.user_id, Person.gender).filter(
+            Person.user_id.in_(batch)))
+    return families, genders
+
+
+def _family_roles(partners, genders):
+    """
+    Return [('HUSB', id), ('WIFE', id)] for a family's partners.
+    """
+    if len(partners) == 1:
+        return [('WIFE' if genders.get(partners[0]) == GenderEnum.FEMALE else 'HUSB', partners[0])]
+    ordered = sorted(partners, key=lambda partner_id: genders.get(partner_id) == GenderEnum.FEMALE)
+    return list(zip(('HUSB', 'WIFE'), ordered))
+
+
+def _individual_lines(user, fams, famc):
+    person = user.person
+    lines = [f'0 @I{user.id}@ INDI']
+    if person:
+        given = ' '.join(filter(None, (person.first_name, person.middle_name)))
+        lines += [f'1 NAME {given} /{person.last_name}/',
+                  f'2 GIVN {given}',
+                  f'2 SURN {person.last_name}',
+                  f'1 SEX {GEDCOM_SEX[person.gender]}']
+    for important_date in sorted(user.important_dates, key=lambda d: d.id):
+        tag = DATE_EVENTS.get(important_date.date_type)
+        if tag:
+            lines += [f'1 {tag}', f'2 DATE {format_gedcom_date(important_date.date)}']
+    for address in sorted(user.addresses, key=lambda a: not a.is_permanent):
+        lines += ['1 RESI', f'2 ADDR {address.first_line}', f'3 ADR1 {address.first_line}']
+        if address.second_line:
+            lines.append(f'3 ADR2 {address.second_line}')
+        if address.landmark:
+            lines.append(f'3 ADR3 {address.landmark}')
+        lines += [f'3 STAE {address.state}', f'3 POST {address.pin_code}',
+                  f'3 CTRY {address.country}']
+    lines += [f'1 FAMS @F{family_id}@' for family_id in fams.get(user.id, ())]
+    lines += [f'1 FAMC @F{family_id}@' for family_id in famc.get(user.id, ())]
+    return lines
+
+
+def iter_gedcom(db, batch_size=BATCH_SIZE):
+    """
+    Stream every user and family as a GEDCOM 5.5.1 file, chunk by chunk.
+    Admin accounts and deleted users are left out, as in the CSV export.
+
+    Users are read with a server side cursor (yield_per) and their profile,
+    dates and addresses are loaded per batch with selectinload.
+    """
+    families, genders = _load_export_families(db)
+    family_ids = {}
+    fams = {}
+    famc = {}
+    for family_id, (partners, children) in enumerate(sorted(families.items()), start=1):
+        family_ids[partners] = family_id
+        for partner_id in partners:
+            fams.setdefault(partner_id, []).append(family_id)
+        for child_id in children:
+            famc.setdefault(child_id, []).append(family_id)
+
+    yield '\n'.join([
+        '0 HEAD',
+        '1 SOUR FAMILY_TREE',
+        '1 GEDC',
+        '2 VERS 5.5.1',
+        '2 FORM LINEAGE-LINKED',
+        '1 CHAR UTF-8'
+    ]) + '\n'
+
+    marriages = {}
+    users = db.session.execute(
+        select(User)
+        .where(User.is_admin == False, User.deleted_at.is_(None))
+        .options(selectinload(User.person), selectinload(User.addresses),
+                 selectinload(User.important_dates))
+        .order_by(User.id)
+        .execution_options(yield_per=batch_size)
+    ).scalars()
+    for user in users:
+        if user.id in fams:
+            marriage = next((d.date for d in user.important_dates
+                             if d.date_type == ImportantDateTypeEnum.MARRIAGE), None)
+            if marriage:
+                marriages[user.id] = marriage
+        yield '\n'.join(_individual_lines(user, fams, famc)) + '\n'
+
+    for partners, children in sorted(families.items()):
+        lines = [f'0 @F{family_ids[partners]}@ FAM']
+        lines += [f'1 {role} @I{partner_id}@' for role, partner_id in _family_roles(partners, genders)]
+        marriage = next((marriages[p] for p in partners if p in marriages), None)
+        if len(partners) == 2 and marriage:
+            lines += ['1 MARR', f'2 DATE {format_gedcom_date(marriage)}']
+        lines += [f'1 CHIL @I{child_id}@' for child_id in sorted(children)]
+        yield '\n'.join(lines) + '\n'
+    yield '0 TRLR\n'
@@ -0,0 +1,239 @@
+import csv
+import io
+import json
+import os
+
+from flask import current_app as app
+
+from family_tree.models import (
+    User,
+    GenderEnum,
+    Person,
+    Relatives,
+    RelativesTypeEnum
+)
+from family_tree.services.ancestry import (
+    add_parent_edge,
+    get_parent_child,
+    is_ancestor
+)
+from family_tree.services.derived import update_derived_relatives
+from family_tree.services.family import union_families
+from family_tree.services.tree import not_deleted
+from family_tree.graph_index import update_graph_index
+from family_tree.jobs import job
+from family_tree.utils import batched
+
+IMPORT_FIELDS = ('user_id', 'relative_user_id', 'relation_type')
+
+
+def read_relative_rows(stream, filename):
+    """
+    Read relation rows from an uploaded or local CSV/JSON file.
+
+    CSV files need a header with user_id, relative_user_id and
+    relation_type; JSON files hold a list of objects with the same keys.
+    """
+    _, extension = os.path.splitext(filename.lower())
+    if isinstance(stream, io.TextIOBase):
+        text = stream
+    else:
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig')
+    if extension == '.csv':
+        return list(csv.DictReader(text))
+    if extension == '.json':
+        rows = json.load(text)
+        if not isinstance(rows, list):
+            raise ValueError('JSON import must be a list of relations')
+        return rows
+    raise ValueError(f'Unsupported import format {extension}')
+
+
+def _parse_row(row):
+    if not isinstance(row, dict) or any(field not in row for field in IMPORT_FIELDS):
+        raise ValueError(f'Row must have the fields {", ".join(IMPORT_FIELDS)}')
+    try:
+        user_id = int(row['user_id'])
+        relative_user_id = int(row['relative_user_id'])
+    except (TypeError, ValueError):
+        raise ValueError('user_id and relative_user_id must be integers')
+    relation_type = str(row['relation_type']).strip().upper()
+    if relation_type not in RelativesTypeEnum.__members__:
+        raise ValueError(f'Unknown relation type {row["relation_type"]}')
+    return user_id, relative_user_id, relation_type
+
+
+class ImportState:
+    """
+    Everything the validation rules need, loaded for all rows at once and
+    kept up to date in memory as rows are accepted. Soft deleted users are
+    left out, so rows naming them are reported as unknown users.
+    """
+
+    def __init__(self, db, user_ids):
+        self.genders = {}
+        self.has_person = set()
+        self.existing = set()
+        self.parents = {}
+        self.spouses = set()
+        for batch in batched(user_ids):
+            rows = (
+                db.session.query(User.id, Person.gender)
+                .outerjoin(Person, Person.user_id == User.id)
+                .filter(User.id.in_(batch), User.deleted_at.is_(None))
+            )
+            for user_id, gender in rows:
+                self.genders[user_id] = gender
+                if gender is not None:
+                    self.has_person.add(user_id)
+            relations = db.session.query(
+                Relatives.user_id, Relatives.relative_user_id, Relatives.relation_type
+            ).filter(Relatives.user_id.in_(batch), not_deleted(Relatives.relative_user_id))
+            for user_id, relative_user_id, relation_type in relations:
+                self.accept(user_id, relative_user_id, relation_type.value)
+
+    def accept(self, user_id, relative_user_id, relation_type):
+        self.existing.add((user_id, relative_user_id))
+        if relation_type == 'PARENT':
+            self.parents.setdefault(user_id, []).append(relative_user_id)
+        elif relation_type == 'SPOUSE':
+            self.spouses.add(user_id)
+
+    def is_ancestor(self, ancestor_id, descendant_id):
+        """
+        Whether the parent relations held in memory lead from
+        descendant_id up to ancestor_id.
+        """
+        seen = set()
+        stack = [descendant_id]
+        while stack:
+            for parent_id in self.parents.get(stack.pop(), ()):
+                if parent_id == ancestor_id:
+                    return True
+                if parent_id not in seen:
+                    seen.add(parent_id)
+                    stack.append(parent_id)
+        return False
+
+
+def _check_side(state, user_id, relative_user_id, relation_type):
+    """
+    The rules of check_validity_relation seen from one side of the relation.
+    """
+    if relation_type == 'PARENT':
+        parents = state.parents.get(user_id, [])
+        if len(parents) >= 2:
+            return f'User {user_id} already has two parents'
+        if parents:
+            gender = state.genders.get(relative_user_id)
+            if state.genders.get(parents[0]) == gender and gender in (GenderEnum.MALE, GenderEnum.FEMALE):
+                return 'Cannot add parent as parent of the same gender already exists'
+    elif relation_type == 'SPOUSE' and user_id in state.spouses:
+        return f'User {user_id} already has a spouse'
+    return None
+
+
+def validate_relation(db, state, user_id, relative_user_id, relation_type):
+    """
+    Apply the rules of check_relative_constraints and check_validity_relation
+    to one row, from the point of view of both users. Returns the error
+    message, or None when the relation may be added.
+    """
+    if user_id not in state.genders:
+        return f'User {user_id} does not exist'
+    if relative_user_id not in state.genders:
+        return f'Relative {relative_user_id} does not exist'
+    if user_id == relative_user_id:
+        return 'A user cannot be their own relative'
+    if (user_id, relative_user_id) in state.existing or (relative_user_id, user_id) in state.existing:
+        return 'This relationship already exists'
+    if user_id not in state.has_person or relative_user_id not in state.has_person:
+        return 'Both users must have complete profiles to establish a relationship'
+
+    reverse_type = Relatives.get_reverse_relation(relation_type)
+    error = (_check_side(state, user_id, relative_user_id, relation_type)
+             or _check_side(state, relative_user_id, user_id, reverse_type))
+    if error:
+        return error
+
+    edge = get_parent_child(user_id, relative_user_id, relation_type)
+    if edge and (is_ancestor(db, edge[1], edge[0]) or state.is_ancestor(edge[1], edge[0])):
+        return 'This relation would make a person their own ancestor'
+    return None
+
+
+def import_relatives(db, rows, dry_run=False):
+    """
+    Validate and insert many relations in a single transaction.
+
+    Every row is checked against the same rules as the /add_relative form,
+    using state preloaded for all rows in a few batched queries, then the
+    forward and reverse Relatives rows are inserted and the ancestry and
+    family and derived relation tables are updated without intermediate
+    commits. Invalid rows
+    are skipped and reported.
+
+    Returns {'imported': int, 'errors': [{'row': int, 'error': str}, ...]}
+    where row numbers start at 1.
+    """
+    parsed = []
+    errors = []
+    for number, row in enumerate(rows, start=1):
+        try:
+            parsed.append((number,) + _parse_row(row))
+        except ValueError as error:
+            errors.append({'row': number, 'error': str(error)})
+
+    user_ids = {user_id for _, user_id, _, _ in parsed} | {
+        relative_user_id for _, _, relative_user_id, _ in parsed}
+    state = ImportState(db, user_ids)
+
+    imported = 0
+    touched_ids = set()
+    try:
+        for number, user_id, relative_user_id, relation_type in parsed:
+            error = validate_relation(db, state, user_id, relative_user_id, relation_type)
+            if error:
+                errors.append({'row': number, 'error': error})
+                continue
+
+            reverse_type = Relatives.get_reverse_relation(relation_type)
+            db.session.add_all([
+                Relatives(user_id=user_id, relative_user_id=relative_user_id,
+                          relation_type=RelativesTypeEnum(relation_type)),
+                Relatives(user_id=relative_user_id, relative_user_id=user_id,
+                          relation_type=RelativesTypeEnum(reverse_type))
+            ])
+            state.accept(user_id, relative_user_id, relation_type)
+            state.accept(relative_user_id, user_id, reverse_type)
+
+            edge = get_parent_child(user_id, relative_user_id, relation_type)
+            if edge:
+                add_parent_edge(db, *edge)
+            union_families(db, user_id, relative_user_id)
+            touched_ids.update((user_id, relative_user_id))
+            imported += 1
+
+        if touched_ids:
+            update_derived_relatives(db, touched_ids)
+
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if touched_ids and not dry_run:
+        update_graph_index(db, touched_ids)
+
+    errors.sort(key=lambda error: error['row'])
+    app.logger.info(
+        f'Imported {imported} relations with {len(errors)} errors{" (dry run)" if dry_run else ""}')
+    return {'imported': imported, 'errors': errors}
+
+
+@job('import_relatives')
+def import_relatives_job(db, progress, rows, filename=None):
+    progress(0.0, f'Importing {len(rows)} rows from {filename or "upload"}')
+    return import_relatives(db, rows)
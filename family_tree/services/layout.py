@@ -0,0 +1,241 @@
+import json
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from flask import current_app as app
+
+from family_tree.models import (
+    User,
+    Family,
+    Relatives,
+    RelativesTypeEnum,
+    TreeLayout
+)
+from family_tree.services.family import get_family_id, get_family_member_ids
+from family_tree.services.tree import get_component_ids, not_deleted
+from family_tree.utils import batched
+
+# The relative is one generation above the user
+UP_RELATIONS = {RelativesTypeEnum.PARENT, RelativesTypeEnum.STEPPARENT}
+# The relative is one generation below the user
+DOWN_RELATIONS = {RelativesTypeEnum.CHILD, RelativesTypeEnum.STEPCHILD}
+
+# Number of barycenter sweeps used to reduce edge crossings
+SWEEPS = 4
+
+
+def load_component_edges(db, member_ids):
+    """
+    Split the relations inside a component into (parent, child) edges and
+    same-generation (spouse, sibling) pairs.
+    """
+    parent_edges = set()
+    peer_edges = set()
+    for batch in batched(member_ids):
+        rows = db.session.query(
+            Relatives.user_id, Relatives.relative_user_id, Relatives.relation_type
+        ).filter(Relatives.user_id.in_(batch), not_deleted(Relatives.relative_user_id))
+        for user_id, relative_user_id, relation_type in rows:
+            if relation_type in UP_RELATIONS:
+                parent_edges.add((relative_user_id, user_id))
+            elif relation_type in DOWN_RELATIONS:
+                parent_edges.add((user_id, relative_user_id))
+            else:
+                peer_edges.add((min(user_id, relative_user_id), max(user_id, relative_user_id)))
+    return parent_edges, peer_edges
+
+
+def _group_peers(member_ids, peer_edges):
+    """
+    Union spouses and siblings into groups that must share a generation.
+    Returns {member_id: group_id}.
+    """
+    parent = {member_id: member_id for member_id in member_ids}
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for left, right in peer_edges:
+        if left in parent and right in parent:
+            left_root, right_root = find(left), find(right)
+            if left_root != right_root:
+                parent[max(left_root, right_root)] = min(left_root, right_root)
+    return {member_id: find(member_id) for member_id in member_ids}
+
+
+def _assign_layers(groups, parent_edges, group_of):
+    """
+    Longest-path layering of the group graph, with parentless groups pulled
+    down to sit just above their highest child.
+    """
+    children = {group: set() for group in groups}
+    parents = {group: set() for group in groups}
+    for parent_id, child_id in parent_edges:
+        if parent_id not in group_of or child_id not in group_of:
+            continue
+        parent_group, child_group = group_of[parent_id], group_of[child_id]
+        if parent_group != child_group:
+            children[parent_group].add(child_group)
+            parents[child_group].add(parent_group)
+
+    pending = {group: len(parents[group]) for group in groups}
+    layer = {group: 0 for group in groups}
+    ready = sorted(group for group in groups if pending[group] == 0)
+    order = []
+    while ready:
+        group = ready.pop(0)
+        order.append(group)
+        for child_group in sorted(children[group]):
+            layer[child_group] = max(layer[child_group], layer[group] + 1)
+            pending[child_group] -= 1
+            if pending[child_group] == 0:
+                ready.append(child_group)
+    if len(order) < len(groups):
+        app.logger.warning('Cycle detected in parent relations while computing layout')
+
+    for group in reversed(order):
+        if not parents[group] and children[group]:
+            layer[group] = min(layer[child_group] for child_group in children[group]) - 1
+
+    lowest = min(layer.values())
+    return {group: value - lowest for group, value in layer.items()}, parents, children
+
+
+def _order_layers(layers, parents, children, sweeps=SWEEPS):
+    """
+    Order groups within each layer with alternating barycenter sweeps.
+    """
+    position = {}
+    for groups in layers:
+        groups.sort()
+        for index, group in enumerate(groups):
+            position[group] = index / max(len(groups), 1)
+
+    def sweep(layer_order, neighbours):
+        for groups in layer_order:
+            def barycenter(group):
+                linked = [position[other] for other in neighbours[group]]
+                return sum(linked) / len(linked) if linked else position[group]
+            groups.sort(key=barycenter)
+            for index, group in enumerate(groups):
+                position[group] = index / max(len(groups), 1)
+
+    for iteration in range(sweeps):
+        if iteration % 2 == 0:
+            sweep(layers[1:], parents)
+        else:
+            sweep(list(reversed(layers[:-1])), children)
+    return layers
+
+
+def compute_layout(member_ids, parent_edges, peer_edges, sweeps=SWEEPS):
+    """
+    Compute a layered (Sugiyama style) layout of a component.
+
+    Generations come from a longest-path layering of the parent edges,
+    spouses and siblings share a generation, and the order within each
+    generation is refined with barycenter sweeps to reduce crossings.
+
+    Returns {'generations': int, 'width': int, 'nodes': {user_id: {'generation', 'x'}}}.
+    """
+    member_ids = sorted(member_ids)
+    if not member_ids:
+        return {'generations': 0, 'width': 0, 'nodes': {}}
+    group_of = _group_peers(member_ids, peer_edges)
+    members = {}
+    for member_id in member_ids:
+        members.setdefault(group_of[member_id], []).append(member_id)
+
+    layer, parents, children = _assign_layers(list(members), parent_edges, group_of)
+    layers = [[] for _ in range(max(layer.values()) + 1)]
+    for group, value in layer.items():
+        layers[value].append(group)
+    layers = _order_layers(layers, parents, children, sweeps)
+
+    width = max(sum(len(members[group]) for group in groups) for groups in layers)
+    nodes = {}
+    for generation, groups in enumerate(layers):
+        row = [member_id for group in groups for member_id in members[group]]
+        offset = (width - len(row)) / 2
+        for index, member_id in enumerate(row):
+            nodes[member_id] = {'generation': generation, 'x': index + offset}
+    return {'generations': len(layers), 'width': width, 'nodes': nodes}
+
+
+def _decode_layout(data):
+    layout = json.loads(data)
+    layout['nodes'] = {int(user_id): node for user_id, node in layout['nodes'].items()}
+    return layout
+
+
+def _build_layout(db, member_ids):
+    # Soft deleted users keep their family until they are purged
+    deleted_ids = set(db.session.scalars(select(User.id).where(User.deleted_at.isnot(None))))
+    member_ids = [user_id for user_id in member_ids if user_id not in deleted_ids]
+    parent_edges, peer_edges = load_component_edges(db, member_ids)
+    layout = compute_layout(member_ids, parent_edges, peer_edges)
+    layout['parent_edges'] = sorted(parent_edges)
+    layout['peer_edges'] = sorted(peer_edges)
+    return layout
+
+
+def get_component_layout(db, user_id):
+    """
+    Return the layout of the family containing a user.
+
+    Layouts are cached per family in the TreeLayout table and reused until
+    a relation write or a deletion bumps the family's version.
+    """
+    family_id = get_family_id(db, user_id)
+    if family_id is None:
+        # Unconnected user, or relations written without maintaining
+        # families (see 'flask rebuild-families'); nothing to cache.
+        layout = _build_layout(db, get_component_ids(db, user_id))
+        layout['component_id'] = None
+        layout['version'] = 0
+        return layout
+
+    version = db.session.get(Family, family_id).version
+    cached = db.session.get(TreeLayout, family_id)
+    if cached and cached.version == version:
+        app.logger.info(f'Layout cache hit for family {family_id} (version {version})')
+        return _decode_layout(cached.layout)
+
+    app.logger.info(f'Computing layout for family {family_id} (version {version})')
+    layout = _build_layout(db, get_family_member_ids(db, family_id))
+    layout['component_id'] = family_id
+    layout['version'] = version
+
+    # Concurrent misses for the same family may both get here; an upsert
+    # lets the last one win instead of failing on the primary key, and
+    # never replaces a layout of a newer version
+    values = {'component_id': family_id, 'version': version, 'layout': json.dumps(layout),
+              'updated_at': datetime.utcnow()}
+    statement = sqlite_insert(TreeLayout).values(**values)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[TreeLayout.component_id],
+        set_={key: statement.excluded[key] for key in ('version', 'layout', 'updated_at')},
+        where=TreeLayout.version <= statement.excluded.version))
+    db.session.commit()
+    return layout
+
+
+def order_relative_details(layout, user_id, relative_details):
+    """
+    Annotate relative cards with their generation relative to the user and
+    sort them in tree order, using the cached layout coordinates.
+    """
+    nodes = layout['nodes']
+    own_generation = nodes[user_id]['generation'] if user_id in nodes else 0
+    for detail in relative_details:
+        node = nodes.get(detail['relative_user_id'])
+        detail['generation'] = node['generation'] - own_generation if node else None
+        detail['x'] = node['x'] if node else 0
+    relative_details.sort(key=lambda detail: (
+        detail['generation'] if detail['generation'] is not None else 0, detail['x']))
+    return relative_details
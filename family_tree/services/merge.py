@@ -0,0 +1,259 @@
+from sqlalchemy import and_, delete, exists, or_, select, update
+from sqlalchemy.orm import aliased
+
+from flask import current_app as app
+
+from family_tree.graph_index import update_graph_index
+from family_tree.models import (
+    User,
+    GenderEnum,
+    Address,
+    Ancestry,
+    ContactDetails,
+    ImportantDates,
+    ImportantDateTypeEnum,
+    Person,
+    Picture,
+    Relatives,
+    RelativesTypeEnum
+)
+from family_tree.services.ancestry import (
+    get_descendants,
+    is_ancestor,
+    rebuild_ancestry_subtree
+)
+from family_tree.services.derived import (
+    derived_neighbourhood,
+    detach_user_from_derived,
+    refresh_derived_relatives
+)
+from family_tree.services.family import (
+    get_family_id,
+    refresh_family,
+    union_families
+)
+from family_tree.services.snapshot import invalidate_user_snapshots
+from family_tree.services.user import remove_picture_file
+from family_tree.services.versions import (
+    TREE_SCOPE,
+    USER_SCOPE,
+    bump_version,
+    bump_versions
+)
+
+
+def _check_parents_and_spouses(db, relations, subject):
+    """
+    Raise ValueError when {relative_user_id: relation_type} holds more
+    than two parents, two parents of the same gender or more than one
+    spouse.
+    """
+    parent_ids = [relative_user_id for relative_user_id, relation_type in relations.items()
+                  if relation_type == RelativesTypeEnum.PARENT]
+    if len(parent_ids) > 2:
+        raise ValueError(f'{subject} would have more than two parents')
+    if len(parent_ids) == 2:
+        genders = db.session.scalars(
+            select(Person.gender).where(Person.user_id.in_(parent_ids))).all()
+        if len(genders) == 2 and genders[0] == genders[1] \
+                and genders[0] in (GenderEnum.MALE, GenderEnum.FEMALE):
+            raise ValueError(f'{subject} would have two parents of the same gender')
+    if list(relations.values()).count(RelativesTypeEnum.SPOUSE) > 1:
+        raise ValueError(f'{subject} would have more than one spouse')
+
+
+def _check_relations(db, survivor_id, duplicate_id):
+    """
+    Raise ValueError when the survivor, or a relative of the duplicate
+    once pointed at the survivor, would end up with relations that
+    add_relative refuses: a relative reached through two different
+    relations, more than two parents, two parents of the same gender or
+    more than one spouse. Relations the two records share are merged.
+    """
+    rows = db.session.query(
+        Relatives.user_id, Relatives.relative_user_id, Relatives.relation_type
+    ).filter(Relatives.user_id.in_([survivor_id, duplicate_id]),
+             Relatives.relative_user_id.notin_([survivor_id, duplicate_id])).all()
+    relations = {relative_user_id: relation_type
+                 for user_id, relative_user_id, relation_type in rows if user_id == survivor_id}
+    for user_id, relative_user_id, relation_type in rows:
+        if user_id != duplicate_id:
+            continue
+        kept = relations.setdefault(relative_user_id, relation_type)
+        if kept != relation_type:
+            raise ValueError(f'User {relative_user_id} is the {kept.value.lower()} of one record '
+                             f'and the {relation_type.value.lower()} of the other')
+    _check_parents_and_spouses(db, relations, 'The merged user')
+
+    # The relatives of the duplicate see the survivor in its place
+    relative_ids = db.session.scalars(
+        select(Relatives.user_id).where(Relatives.relative_user_id == duplicate_id,
+                                        Relatives.user_id != survivor_id)).all()
+    relative_relations = {}
+    for user_id, relative_user_id, relation_type in db.session.query(
+            Relatives.user_id, Relatives.relative_user_id, Relatives.relation_type
+    ).filter(Relatives.user_id.in_(relative_ids)):
+        if relative_user_id == duplicate_id:
+            relative_user_id = survivor_id
+        kept = relative_relations.setdefault(user_id, {}).setdefault(relative_user_id, relation_type)
+        if kept != relation_type:
+            raise ValueError(f'The merged user would be the {kept.value.lower()} and the '
+                             f'{relation_type.value.lower()} of user {user_id}')
+    for user_id, user_relations in relative_relations.items():
+        _check_parents_and_spouses(db, user_relations, f'User {user_id}')
+
+
+def _move_relatives(db, survivor_id, duplicate_id):
+    """
+    Point every relation of the duplicate at the survivor with set-based
+    statements. Relations equal to one of the survivor's are dropped, so
+    _check_relations must have passed. Returns the number of relations
+    moved.
+    """
+    # Relations between the two records describe one person
+    db.session.execute(delete(Relatives).where(or_(
+        and_(Relatives.user_id == survivor_id, Relatives.relative_user_id == duplicate_id),
+        and_(Relatives.user_id == duplicate_id, Relatives.relative_user_id == survivor_id))))
+    # Both records related to the same user, in the same way
+    db.session.execute(delete(Relatives).where(
+        Relatives.user_id == duplicate_id,
+        Relatives.relative_user_id.in_(
+            select(Relatives.relative_user_id).where(Relatives.user_id == survivor_id))))
+    db.session.execute(delete(Relatives).where(
+        Relatives.relative_user_id == duplicate_id,
+        Relatives.user_id.in_(
+            select(Relatives.user_id).where(Relatives.relative_user_id == survivor_id))))
+
+    moved = db.session.execute(
+        update(Relatives).where(Relatives.user_id == duplicate_id).values(user_id=survivor_id)
+    ).rowcount
+    db.session.execute(
+        update(Relatives).where(Relatives.relative_user_id == duplicate_id)
+        .values(relative_user_id=survivor_id))
+    return moved
+
+
+# Rows of the duplicate equal to one of the survivor's in these columns
+# are dropped instead of moved
+DETAIL_COLUMNS = {
+    Address: ('is_permanent', 'first_line', 'second_line', 'pin_code', 'state', 'country',
+              'landmark'),
+    ImportantDates: ('date_type', 'date'),
+    ContactDetails: ('country_code', 'mobile_no', 'email')
+}
+
+# A user has at most one row per value of these columns (one permanent
+# and one current address, one birth and one death date); where both
+# have one, the survivor's is kept. None stands for every value.
+UNIQUE_KINDS = {
+    Address: ('is_permanent', None),
+    ImportantDates: ('date_type', (ImportantDateTypeEnum.BIRTH, ImportantDateTypeEnum.DEATH))
+}
+
+
+def _move_details(db, survivor_id, duplicate_id):
+    """
+    Point the duplicate's addresses, dates and contact details at the
+    survivor, one statement per table. Rows equal to one of the survivor's,
+    or of a kind the survivor already has, are dropped instead. Returns
+    {table name: rows moved}.
+    """
+    moved = {}
+    for model, columns in DETAIL_COLUMNS.items():
+        kept = aliased(model)
+        db.session.execute(delete(model).where(
+            model.user_id == duplicate_id,
+            exists().where(kept.user_id == survivor_id, *[
+                getattr(kept, column).is_not_distinct_from(getattr(model, column))
+                for column in columns])))
+        if model in UNIQUE_KINDS:
+            column, values = UNIQUE_KINDS[model]
+            conditions = [model.user_id == duplicate_id, exists().where(
+                kept.user_id == survivor_id, getattr(kept, column) == getattr(model, column))]
+            if values is not None:
+                conditions.append(getattr(model, column).in_(values))
+            db.session.execute(delete(model).where(*conditions))
+        moved[model.__tablename__] = db.session.execute(
+            update(model).where(model.user_id == duplicate_id).values(user_id=survivor_id)
+        ).rowcount
+    return moved
+
+
+def _move_picture(db, survivor_id, duplicate_id):
+    """
+    Give the survivor the duplicate's picture when it has none. Returns the
+    file name of a picture that is no longer used, if any.
+    """
+    if db.session.query(Picture.id).filter(Picture.user_id == survivor_id).first() is None:
+        db.session.execute(
+            update(Picture).where(Picture.user_id == duplicate_id).values(user_id=survivor_id))
+        return None
+    return db.session.scalar(
+        select(Picture.picture_filename).where(Picture.user_id == duplicate_id))
+
+
+def _fill_person(db, survivor_id, duplicate_id):
+    # The survivor keeps its own name, only a missing middle name is taken over
+    middle_name = db.session.scalar(
+        select(Person.middle_name).where(Person.user_id == duplicate_id))
+    if middle_name:
+        db.session.execute(
+            update(Person).where(Person.user_id == survivor_id, Person.middle_name.is_(None))
+            .values(middle_name=middle_name))
+
+
+def merge_users(db, survivor_id, duplicate_id):
+    """
+    Merge a user that duplicates another into the survivor and delete it,
+    in one transaction. The duplicate's relations, addresses, dates,
+    contact details and picture are moved to the survivor with set-based
+    statements, and the ancestry, family and derived relation tables are
+    brought up to date. Returns the number of rows moved per table.
+    """
+    if survivor_id == duplicate_id:
+        raise ValueError('Cannot merge a user into itself')
+    users = [db.session.get(User, survivor_id), db.session.get(User, duplicate_id)]
+    if any(user is None or user.deleted_at is not None for user in users):
+        raise ValueError('Unknown user')
+    if is_ancestor(db, survivor_id, duplicate_id) or is_ancestor(db, duplicate_id, survivor_id):
+        raise ValueError('Cannot merge a user with their own ancestor or descendant')
+    _check_relations(db, survivor_id, duplicate_id)
+
+    try:
+        affected_ids = derived_neighbourhood(db, [survivor_id, duplicate_id])
+        child_ids = [child_id for child_id, _ in get_descendants(db, duplicate_id, max_distance=1)]
+        if get_family_id(db, duplicate_id) is not None:
+            union_families(db, survivor_id, duplicate_id)
+
+        moved = {'relatives': _move_relatives(db, survivor_id, duplicate_id)}
+        moved.update(_move_details(db, survivor_id, duplicate_id))
+        unused_picture = _move_picture(db, survivor_id, duplicate_id)
+        _fill_person(db, survivor_id, duplicate_id)
+        db.session.execute(delete(Ancestry).where(or_(
+            Ancestry.ancestor_id == duplicate_id, Ancestry.descendant_id == duplicate_id)))
+        rebuild_ancestry_subtree(db, [survivor_id] + child_ids, excluded_ids={duplicate_id})
+        detach_user_from_derived(db, duplicate_id)
+
+        # The statements above bypass the ORM; reload before the delete cascades
+        db.session.expire_all()
+        db.session.delete(db.session.get(User, duplicate_id))
+        db.session.flush()
+
+        family_id = get_family_id(db, survivor_id)
+        if family_id is not None:
+            refresh_family(db, family_id)
+        affected_ids.discard(duplicate_id)
+        refresh_derived_relatives(db, affected_ids)
+        bump_version(db.session, TREE_SCOPE)
+        bump_versions(db.session, USER_SCOPE, affected_ids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    invalidate_user_snapshots(affected_ids)
+    update_graph_index(db, affected_ids | {duplicate_id})
+    if unused_picture:
+        remove_picture_file(unused_picture)
+    app.logger.info(f'Merged user {duplicate_id} into user {survivor_id}: {moved}')
+    return moved
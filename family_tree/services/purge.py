@@ -0,0 +1,139 @@
+"""
+Deletion of users in two steps.
+
+An admin's delete only marks the user as deleted, which hides them
+everywhere at once, and queues the purge_user job. The job removes the
+user's relations together with the ancestry, family and derived
+relation rows that depend on them, then deletes the remaining rows in
+batches of set-based statements, each committed on its own so no
+request waits on a long write lock, and finally the picture files.
+"""
+from datetime import datetime
+
+from sqlalchemy import delete, or_, select, update
+
+from flask import current_app as app
+
+from family_tree.graph_index import update_graph_index
+from family_tree.jobs import enqueue, job
+from family_tree.models import (
+    User,
+    Address,
+    Family,
+    ContactDetails,
+    DuplicateCandidate,
+    ImportantDates,
+    Person,
+    Picture,
+    Relatives
+)
+from family_tree.services.ancestry import detach_user_from_ancestry
+from family_tree.services.derived import (
+    detach_user_from_derived,
+    refresh_derived_relatives
+)
+from family_tree.services.family import get_family_id, refresh_family
+from family_tree.services.snapshot import invalidate_user_snapshots
+from family_tree.services.user import remove_picture_file
+from family_tree.services.versions import (
+    TREE_SCOPE,
+    USER_SCOPE,
+    bump_version,
+    bump_versions
+)
+from family_tree.utils import BATCH_SIZE
+
+# Purged after the relations, in this order
+DETAIL_TABLES = (Address, ImportantDates, ContactDetails, Picture, Person)
+
+
+def soft_delete_user(db, user_id, admin_id=None):
+    """
+    Hide a user, take them out of the graph index and queue the purge of
+    their rows. Returns the job, or None when there is no such user or it
+    is being deleted already.
+    """
+    user = db.session.get(User, user_id)
+    if user is None or user.deleted_at is not None:
+        return None
+    user.deleted_at = datetime.utcnow()
+    if user.family_id is not None:
+        # Drops the family's cached layout, which still shows the user
+        db.session.get(Family, user.family_id).version += 1
+    relative_ids = set(db.session.scalars(
+        select(Relatives.relative_user_id).where(Relatives.user_id == user_id)))
+    db.session.commit()
+    update_graph_index(db, relative_ids | {user_id})
+    app.logger.info(f'Marked user {user_id} as deleted')
+    return enqueue(db, 'purge_user', user_id=admin_id, purged_user_id=user_id)
+
+
+def _delete_in_batches(db, model, condition, commit=True):
+    """
+    Delete the rows matching condition BATCH_SIZE at a time. Returns the
+    number of rows deleted.
+    """
+    total = 0
+    while True:
+        batch = select(model.id).where(condition).limit(BATCH_SIZE).scalar_subquery()
+        count = db.session.execute(delete(model).where(model.id.in_(batch))).rowcount
+        if commit:
+            db.session.commit()
+        total += count
+        if count < BATCH_SIZE:
+            return total
+
+
+def _purge_relations(db, user_id):
+    """
+    Delete the user's relations and bring the graph tables up to date, in
+    one transaction. Returns the number of relations deleted.
+    """
+    family_id = get_family_id(db, user_id)
+    detach_user_from_ancestry(db, user_id)
+    affected_ids = detach_user_from_derived(db, user_id)
+    count = _delete_in_batches(db, Relatives, or_(
+        Relatives.user_id == user_id, Relatives.relative_user_id == user_id), commit=False)
+    db.session.execute(update(User).where(User.id == user_id).values(family_id=None))
+    if family_id is not None:
+        refresh_family(db, family_id)
+    refresh_derived_relatives(db, affected_ids)
+    bump_version(db.session, TREE_SCOPE)
+    bump_versions(db.session, USER_SCOPE, affected_ids)
+    db.session.commit()
+
+    invalidate_user_snapshots(affected_ids)
+    update_graph_index(db, affected_ids | {user_id})
+    return count
+
+
+@job('purge_user')
+def purge_user(db, progress, purged_user_id):
+    """
+    Remove a soft deleted user and everything that belongs to them. Safe
+    to run again after a failure, every step skips what is already gone.
+    """
+    user = db.session.get(User, purged_user_id)
+    if user is None or user.deleted_at is None:
+        # Already purged, or restored before the job ran
+        return {'purged': False}
+
+    picture_filenames = db.session.scalars(
+        select(Picture.picture_filename).where(Picture.user_id == purged_user_id)).all()
+    counts = {'relatives': _purge_relations(db, purged_user_id)}
+    progress(0.5, f'Deleted {counts["relatives"]} relations')
+
+    for model in DETAIL_TABLES:
+        counts[model.__tablename__] = _delete_in_batches(
+            db, model, model.user_id == purged_user_id)
+    db.session.execute(delete(DuplicateCandidate).where(or_(
+        DuplicateCandidate.user_id == purged_user_id,
+        DuplicateCandidate.other_user_id == purged_user_id)))
+    db.session.execute(delete(User).where(User.id == purged_user_id))
+    db.session.commit()
+    invalidate_user_snapshots([purged_user_id])
+
+    for picture_filename in picture_filenames:
+        remove_picture_file(picture_filename)
+    app.logger.info(f'Purged user {purged_user_id}: {counts}')
+    return {'purged': True, **counts}
@@ -0,0 +1,157 @@
+import json
+from datetime import date
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, selectinload
+
+from flask import current_app as app, has_app_context
+
+from family_tree.cache import cache, invalidate_tags
+from family_tree.models import (
+    User,
+    GenderEnum,
+    Person,
+    ImportantDateTypeEnum,
+    Relatives
+)
+from family_tree.services.versions import affected_user_ids, changed_objects
+
+# Session.info keys holding what the next commit invalidates
+PENDING_KEY = 'stale_user_snapshots'
+PENDING_TAGS_KEY = 'stale_cache_tags'
+
+# Cache tag of results built from every user's profile
+PEOPLE_TAG = 'people'
+
+
+def _snapshot_key(user_id):
+    return f'snapshot:{user_id}'
+
+
+def _columns(obj, names):
+    return {name: getattr(obj, name) for name in names}
+
+
+def build_user_snapshot(db, user_id):
+    """
+    Load everything the user pages show in a single query with one
+    selectinload per relationship, as a JSON serialisable dict.
+    """
+    relative = selectinload(User.relatives).selectinload(Relatives.relative_user)
+    user = db.session.execute(
+        select(User)
+        .options(
+            selectinload(User.person),
+            selectinload(User.profile_picture),
+            selectinload(User.addresses),
+            selectinload(User.important_dates),
+            selectinload(User.contact_details),
+            relative.selectinload(User.person),
+            relative.selectinload(User.profile_picture))
+        .filter(User.id == user_id)
+    ).scalar_one_or_none()
+    if user is None:
+        return None
+
+    person = user.person
+    return {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'person': {
+            'first_name': person.first_name,
+            'middle_name': person.middle_name,
+            'last_name': person.last_name,
+            'gender': person.gender.value
+        } if person else None,
+        'picture_filename': user.profile_picture.picture_filename if user.profile_picture else None,
+        'addresses': [
+            _columns(address, ('id', 'is_permanent', 'first_line', 'second_line',
+                               'landmark', 'pin_code', 'state', 'country'))
+            for address in sorted(user.addresses, key=lambda address: address.id)
+        ],
+        'important_dates': [
+            {'id': important_date.id, 'date_type': important_date.date_type.value,
+             'date': important_date.date.isoformat()}
+            for important_date in sorted(user.important_dates, key=lambda d: d.id)
+        ],
+        'contact_details': [
+            _columns(contact, ('id', 'country_code', 'mobile_no', 'email'))
+            for contact in sorted(user.contact_details, key=lambda contact: contact.id)
+        ],
+        'relatives': [
+            {
+                'relative_user_id': rel.relative_user_id,
+                'relationship': rel.relation_type.value,
+                'first_name': rel.relative_user.person.first_name,
+                'middle_name': rel.relative_user.person.middle_name,
+                'last_name': rel.relative_user.person.last_name,
+                'picture_filename': (rel.relative_user.profile_picture.picture_filename
+                                     if rel.relative_user.profile_picture else None)
+            }
+            for rel in sorted(user.relatives, key=lambda rel: rel.id)
+            if rel.relative_user.person and rel.relative_user.deleted_at is None
+        ]
+    }
+
+
+def _hydrate(snapshot):
+    """
+    Restore the enum and date values the templates expect.
+    """
+    if snapshot['person']:
+        snapshot['person']['gender'] = GenderEnum(snapshot['person']['gender'])
+    for important_date in snapshot['important_dates']:
+        important_date['date_type'] = ImportantDateTypeEnum(important_date['date_type'])
+        important_date['date'] = date.fromisoformat(important_date['date'])
+    return snapshot
+
+
+def get_user_snapshot(db, user_id):
+    """
+    Return the cached snapshot of a user, building it on a miss.
+
+    Snapshots are stored as JSON in the shared cache and deleted when a
+    commit touches the user's rows (see _evict_after_commit), so a hit
+    needs no queries.
+    """
+    data = cache.get(_snapshot_key(user_id))
+    if data is None:
+        app.logger.info(f'Building snapshot of user {user_id}')
+        snapshot = build_user_snapshot(db, user_id)
+        if snapshot is None:
+            return None
+        data = json.dumps(snapshot)
+        cache.set(_snapshot_key(user_id), data)
+    return _hydrate(json.loads(data))
+
+
+def invalidate_user_snapshots(user_ids):
+    if not has_app_context():
+        return
+    for user_id in user_ids:
+        cache.delete(_snapshot_key(user_id))
+
+
+@event.listens_for(Session, 'before_flush')
+def _collect_stale_snapshots(session, flush_context, instances):
+    pending = session.info.setdefault(PENDING_KEY, set())
+    pending_tags = session.info.setdefault(PENDING_TAGS_KEY, set())
+    for obj in changed_objects(session):
+        pending.update(user_id for user_id in affected_user_ids(session, obj) if user_id)
+        if isinstance(obj, (User, Person)):
+            pending_tags.add(PEOPLE_TAG)
+
+
+@event.listens_for(Session, 'after_commit')
+def _evict_after_commit(session):
+    invalidate_user_snapshots(session.info.pop(PENDING_KEY, ()))
+    tags = session.info.pop(PENDING_TAGS_KEY, ())
+    if tags and has_app_context():
+        invalidate_tags(*tags)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _clear_after_rollback(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
+    session.info.pop(PENDING_TAGS_KEY, None)
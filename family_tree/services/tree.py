@@ -0,0 +1,232 @@
+import json
+
+from sqlalchemy import select
+
+from flask import url_for
+
+from family_tree.graph_index import get_graph_index
+from family_tree.models import (
+    User,
+    Person,
+    Picture,
+    Relatives
+)
+from family_tree.services.versions import TREE_SCOPE, get_version
+from family_tree.utils import BATCH_SIZE, batched
+
+
+def get_tree_etag(db, user_id, hops):
+    """
+    ETag of the tree around a user. The tree version changes on every write
+    to people, pictures or relations, so no traversal is needed to build it.
+    """
+    return f'tree-{user_id}-{hops}-{get_version(db, TREE_SCOPE)}'
+
+
+def not_deleted(column):
+    """
+    Filter on a user id column leaving out soft deleted users, whose rows
+    stay until the purge_user job has run. Deleted users are few, so the
+    subquery is a short scan of the deleted_at index.
+    """
+    return column.not_in(select(User.id).where(User.deleted_at.isnot(None)))
+
+
+def picture_url(picture_filename):
+    return url_for('static', filename=f'profile_pictures/{picture_filename or "default.jpg"}')
+
+
+def _node_elements(db, user_ids, depths, batch_size=BATCH_SIZE):
+    """
+    Yield one node element per user id that is not soft deleted, loading
+    people and pictures in batches.
+    """
+    for batch in batched(user_ids, batch_size):
+        live_ids = set(db.session.scalars(
+            select(User.id).where(User.id.in_(batch), User.deleted_at.is_(None))))
+        batch = [user_id for user_id in batch if user_id in live_ids]
+        persons = {
+            person.user_id: person
+            for person in db.session.query(Person).filter(Person.user_id.in_(batch))
+        }
+        pictures = dict(
+            db.session.query(Picture.user_id, Picture.picture_filename)
+            .filter(Picture.user_id.in_(batch))
+        )
+        for user_id in batch:
+            person = persons.get(user_id)
+            yield {
+                'group': 'nodes',
+                'data': {
+                    'id': user_id,
+                    'first_name': person.first_name if person else None,
+                    'middle_name': person.middle_name if person else None,
+                    'last_name': person.last_name if person else None,
+                    'gender': person.gender.value if person else None,
+                    'depth': depths[user_id],
+                    'picture_url': picture_url(pictures.get(user_id))
+                }
+            }
+
+
+def _relation_rows(db, user_ids):
+    """
+    Return [(user_id, relative_user_id, relation_type), ...] of a batch of
+    users, from the graph index when there is one. Relations to soft
+    deleted users are left out; the index drops them when the user is
+    deleted.
+    """
+    index = get_graph_index()
+    if index is not None:
+        return [(user_id, relative_user_id, relation_type)
+                for user_id in user_ids
+                for relative_user_id, relation_type in index.relatives(user_id)]
+    return (
+        db.session.query(
+            Relatives.user_id, Relatives.relative_user_id, Relatives.relation_type)
+        .filter(Relatives.user_id.in_(user_ids), not_deleted(Relatives.relative_user_id))
+        .all()
+    )
+
+
+def iter_tree_elements(db, user_id, hops=2, batch_size=BATCH_SIZE):
+    """
+    Lazily yield the nodes and edges within `hops` relations of a user.
+
+    The graph is walked breadth first, one batch of frontier users per
+    query, so memory holds only the visited ids and the current batch.
+    Every node is yielded before any edge that references it. Each pair of
+    relatives produces one edge whose relation says what the target is to
+    the source, e.g. {'source': 2, 'target': 1, 'relation': 'PARENT'}.
+    """
+    depths = {user_id: 0}
+    emitted = set()
+    yield from _node_elements(db, [user_id], depths, batch_size)
+
+    frontier = [user_id]
+    depth = 0
+    while frontier:
+        next_frontier = []
+        for batch in batched(frontier, batch_size):
+            rows = _relation_rows(db, batch)
+            new_ids = []
+            if depth < hops:
+                for _, relative_user_id, _ in rows:
+                    if relative_user_id not in depths:
+                        depths[relative_user_id] = depth + 1
+                        new_ids.append(relative_user_id)
+            yield from _node_elements(db, new_ids, depths, batch_size)
+
+            for source_id, target_id, relation_type in rows:
+                # Both directions are normally stored; emit each pair once,
+                # from whichever row is reached first
+                pair = (min(source_id, target_id), max(source_id, target_id))
+                if target_id in depths and pair not in emitted:
+                    emitted.add(pair)
+                    yield {
+                        'group': 'edges',
+                        'data': {
+                            'id': f'{pair[0]}-{pair[1]}',
+                            'source': source_id,
+                            'target': target_id,
+                            'relation': relation_type.value
+                        }
+                    }
+            next_frontier.extend(new_ids)
+        frontier = next_frontier
+        depth += 1
+
+
+def iter_tree_json(elements, user_id, hops):
+    """
+    Serialise tree elements as a single JSON document, chunk by chunk.
+    """
+    yield json.dumps({'root': user_id, 'hops': hops})[:-1] + ', "elements": ['
+    for index, element in enumerate(elements):
+        yield (', ' if index else '') + json.dumps(element)
+    yield ']}'
+
+
+def iter_tree_ndjson(elements):
+    """
+    Serialise tree elements as newline delimited JSON, one element per line.
+    """
+    for element in elements:
+        yield json.dumps(element) + '\n'
+
+
+def can_view_tree(viewer, user):
+    """
+    Users may see the trees of their own family; admins see every tree.
+    """
+    if viewer.is_admin or viewer.id == user.id:
+        return True
+    return viewer.family_id is not None and viewer.family_id == user.family_id
+
+
+def get_component_ids(db, user_id, batch_size=BATCH_SIZE):
+    """
+    Return the ids of everyone connected to a user through any relation,
+    including the user.
+    """
+    index = get_graph_index()
+    if index is not None:
+        return index.component_ids(user_id)
+
+    seen = {user_id}
+    frontier = [user_id]
+    while frontier:
+        next_frontier = []
+        for batch in batched(frontier, batch_size):
+            rows = db.session.query(Relatives.relative_user_id).filter(
+                Relatives.user_id.in_(batch), not_deleted(Relatives.relative_user_id))
+            for (relative_user_id,) in rows:
+                if relative_user_id not in seen:
+                    seen.add(relative_user_id)
+                    next_frontier.append(relative_user_id)
+        frontier = next_frontier
+    return seen
+
+
+def find_relation_path(db, user_id, other_id, max_hops, batch_size=BATCH_SIZE):
+    """
+    Return the shortest chain of relations from one user to another as
+    [{'user_id': user_id, 'relation': None}, {'user_id': ..., 'relation':
+    'PARENT'}, ...], where each relation says what that user is to the one
+    before, or None if they are not related within max_hops.
+    """
+    previous = {user_id: None}
+    frontier = [user_id]
+    hops = 0
+    while frontier and other_id not in previous and hops < max_hops:
+        next_frontier = []
+        for batch in batched(frontier, batch_size):
+            for source_id, target_id, relation_type in _relation_rows(db, batch):
+                if target_id not in previous:
+                    previous[target_id] = (source_id, relation_type.value)
+                    next_frontier.append(target_id)
+        frontier = next_frontier
+        hops += 1
+    if other_id not in previous:
+        return None
+
+    path = []
+    node = other_id
+    while node is not None:
+        node_before, relation = previous[node] or (None, None)
+        path.append({'user_id': node, 'relation': relation})
+        node = node_before
+    return path[::-1]
+
+
+def get_display_names(db, user_ids, batch_size=BATCH_SIZE):
+    """
+    Return {user_id: 'First Last'} for the users that have a profile.
+    """
+    names = {}
+    for batch in batched(user_ids, batch_size):
+        rows = db.session.query(Person.user_id, Person.first_name, Person.last_name).filter(
+            Person.user_id.in_(batch))
+        for user_id, first_name, last_name in rows:
+            names[user_id] = f'{first_name} {last_name}'
+    return names
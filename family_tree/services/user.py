@@ -1,38 +1,78 @@
 import secrets
 import os
 
-from PIL import Image
-
 from flask import (
     flash,
     url_for,
     current_app as app
 )
 
+from family_tree.cache import cached
 from family_tree.cursor import Cursor
+from family_tree.graph_index import update_graph_index
+from family_tree.jobs import job
+
+from family_tree.services.ancestry import (
+    get_parent_child,
+    is_ancestor,
+    add_parent_edge,
+    remove_parent_edge
+)
+from family_tree.services.derived import update_derived_relatives
+from family_tree.services.family import (
+    union_families,
+    split_families
+)
+from family_tree.services.snapshot import PEOPLE_TAG
 
 cursor = Cursor()
 
 
+def _picture_path(picture_filename):
+    return os.path.join(app.root_path, 'static/profile_pictures', picture_filename)
+
+
+def remove_picture_file(picture_filename):
+    """
+    Delete a stored picture, if it is still there.
+    """
+    try:
+        os.remove(_picture_path(picture_filename))
+    except FileNotFoundError:
+        return False
+    app.logger.info(f'Removed picture {picture_filename}')
+    return True
+
+
 def save_picture(form_picture):
+    """
+    Store the upload as is; the resize_picture job shrinks it afterwards.
+    """
     random_hex = secrets.token_hex(8)
     _, f_ext = os.path.splitext(form_picture.filename)
     picture_filename = random_hex + f_ext
-    picture_path = os.path.join(
-        app.root_path, 'static/profile_pictures', picture_filename)
-
-    # Resize image before saving
-    output_size = (125, 125)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-
-    # Save the picture
-    i.save(picture_path)
+    form_picture.save(_picture_path(picture_filename))
 
     app.logger.info(f'Save picture to static/profile_pictures')
     return picture_filename
 
 
+@job('resize_picture')
+def resize_picture(db, progress, picture_filename, size=125):
+    # Pillow is slow to import and only needed for uploads
+    from PIL import Image
+
+    picture_path = _picture_path(picture_filename)
+    if not os.path.exists(picture_path):
+        # Replaced by a newer upload before the job ran
+        return {'picture_filename': picture_filename, 'resized': False}
+    image = Image.open(picture_path)
+    image.thumbnail((size, size))
+    image.save(picture_path)
+    app.logger.info(f'Resized picture {picture_filename}')
+    return {'picture_filename': picture_filename, 'resized': True}
+
+
 def get_profile_picture(db, picture_table, user_id):
     picture_filename = cursor.query(
         db, picture_table, filter_by=True, user_id=user_id).first()
@@ -116,12 +156,24 @@ def get_relative_details(db, user_table, relatives):
     return relative_details
 
 
-def prefill_upsert_relative_form(db, user_table, user_id, form):
+@cached(tags=(PEOPLE_TAG,))
+def get_person_choices(db, user_table):
+    """
+    Return [(user_id, 'First Last'), ...] for every user with a profile.
+    Cached until a user or profile changes.
+    """
     all_users = cursor.query(db, user_table, filter_by=False).all()
-    form.relative_user_id.choices = [
+    return [
         (u.id, f'{u.person.first_name} {u.person.last_name}')
         for u in all_users
-        if u.id != user_id and u.person is not None
+        if u.person is not None and u.deleted_at is None
+    ]
+
+
+def prefill_upsert_relative_form(db, user_table, user_id, form):
+    form.relative_user_id.choices = [
+        choice for choice in get_person_choices(db, user_table)
+        if choice[0] != user_id
     ]
     form.relation_type.choices = [
         ('PARENT', 'PARENT'),
@@ -190,6 +242,14 @@ def check_validity_relation(db, user_table, relatives_table, user, relative_user
             f'relative user id {relative_user_id} does not exist')
         return False
 
+    # A person cannot become their own ancestor
+    if ((relation_type == 'PARENT' and is_ancestor(db, user.id, relative_user_id))
+            or (relation_type == 'CHILD' and is_ancestor(db, relative_user_id, user.id))):
+        app.logger.warning(
+            f'user {user.id} tried to add relative {relative_user_id} as {relation_type} which creates a cycle')
+        flash('This relation would make a person their own ancestor', 'danger')
+        return False
+
     # Checks for relation_type PARENT
     if relation_type == 'PARENT':
         parents = cursor.query(db, relatives_table, filter_by=True,
@@ -253,6 +313,14 @@ def add_relative_to_database(db, relative_table, relative_enum, user, form):
             relative_table.get_reverse_relation(form.relation_type.data)
         )
     )
+    edge = get_parent_child(
+        user.id, int(form.relative_user_id.data), form.relation_type.data)
+    if edge:
+        add_parent_edge(db, *edge)
+    union_families(db, user.id, int(form.relative_user_id.data))
+    update_derived_relatives(db, [user.id, int(form.relative_user_id.data)])
+    db.session.commit()
+    update_graph_index(db, [user.id, int(form.relative_user_id.data)])
     app.logger.info(f"Relative added for user {user.username}.")
 
 
@@ -268,6 +336,8 @@ def delete_relative_from_database(db, user_table, relatives_table, user, relativ
             f'Could not find relation with relative user id {relative_user_id}')
         return False
     else:
+        edge = get_parent_child(
+            user.id, relative_user_id, relation.relation_type)
         reverse_relation = cursor.query(
             db, relatives_table, filter_by=True, user_id=relative_user_id, relative_user_id=user.id).first()
         if not reverse_relation:
@@ -282,4 +352,10 @@ def delete_relative_from_database(db, user_table, relatives_table, user, relativ
                       relative_user_id=relative_user_id)
         app.logger.info(
             f'Successfully deleled relation from user {user.id} to relative {relative_user_id}')
+        if edge:
+            remove_parent_edge(db, *edge)
+        split_families(db, user.id, relative_user_id)
+        update_derived_relatives(db, [user.id, relative_user_id])
+        db.session.commit()
+        update_graph_index(db, [user.id, relative_user_id])
         return True
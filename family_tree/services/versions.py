@@ -0,0 +1,139 @@
+from itertools import chain
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from family_tree.models import (
+    DataVersion,
+    DerivedRelative,
+    User,
+    Person,
+    Picture,
+    Address,
+    ImportantDates,
+    ContactDetails,
+    Relatives
+)
+from family_tree.utils import batched
+
+# Version of the whole family graph: nodes (people, pictures) and edges
+TREE_SCOPE = 'tree'
+# Version of everything shown on one user's pages, keyed by user id
+USER_SCOPE = 'user'
+
+
+def get_version(db, scope, key=0):
+    value = db.session.query(DataVersion.value).filter_by(
+        scope=scope, key=key).scalar()
+    return value or 0
+
+
+def get_version_info(db, scope, key=0):
+    """
+    Return (value, updated_at) of a version counter with a single primary
+    key lookup, or (0, None) if it was never bumped.
+    """
+    row = db.session.execute(
+        select(DataVersion.value, DataVersion.updated_at).filter_by(scope=scope, key=key)
+    ).first()
+    return tuple(row) if row else (0, None)
+
+
+def get_versions(db, scope, keys):
+    """
+    Return {key: value} for many counters of one scope; missing keys are 0.
+    """
+    versions = dict.fromkeys(keys, 0)
+    for batch in batched(versions):
+        versions.update(db.session.query(DataVersion.key, DataVersion.value).filter(
+            DataVersion.scope == scope, DataVersion.key.in_(batch)))
+    return versions
+
+
+def bump_version(session, scope, key=0):
+    """
+    Increment a version counter inside the given session. The new value is
+    written with the session's next flush.
+    """
+    version = session.get(DataVersion, (scope, key))
+    if version is None:
+        version = DataVersion(scope=scope, key=key, value=0)
+        session.add(version)
+    version.value += 1
+    return version.value
+
+
+def bump_versions(session, scope, keys):
+    """
+    Increment many counters of one scope, loading the existing rows in
+    batches instead of one lookup per key.
+    """
+    keys = set(keys)
+    with session.no_autoflush:
+        for batch in batched(keys):
+            # Loading puts the rows in the identity map for bump_version
+            session.execute(select(DataVersion).filter(
+                DataVersion.scope == scope, DataVersion.key.in_(batch))).scalars().all()
+        for key in keys:
+            bump_version(session, scope, key)
+
+
+def _changes_tree(session, obj):
+    if isinstance(obj, User):
+        # A soft deleted user disappears from the tree straight away
+        return (obj in session.new or obj in session.deleted
+                or inspect(obj).attrs.deleted_at.history.has_changes())
+    if isinstance(obj, (Person, Picture, Relatives)):
+        return obj in session.new or obj in session.deleted or session.is_modified(obj)
+    return False
+
+
+def _relatives_of(session, user_id):
+    # Includes the extended family, whose pages list the user as well
+    with session.no_autoflush:
+        return session.execute(
+            select(Relatives.user_id).filter(Relatives.relative_user_id == user_id)
+            .union(select(DerivedRelative.user_id).filter(
+                DerivedRelative.relative_user_id == user_id))
+        ).scalars().all()
+
+
+def affected_user_ids(session, obj):
+    """
+    Users whose pages show data from a new, changed or deleted object.
+    """
+    if isinstance(obj, User):
+        return [obj.id] + _relatives_of(session, obj.id) if obj.id else []
+    if isinstance(obj, Relatives):
+        return [obj.user_id, obj.relative_user_id]
+    if isinstance(obj, (Person, Picture)):
+        # Names and pictures also appear on the relatives' pages
+        return [obj.user_id] + _relatives_of(session, obj.user_id) if obj.user_id else []
+    if isinstance(obj, (Address, ImportantDates, ContactDetails)):
+        return [obj.user_id]
+    return []
+
+
+def changed_objects(session):
+    """
+    Objects the coming flush will insert, update or delete.
+    """
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if obj in session.dirty and not session.is_modified(obj):
+            continue
+        yield obj
+
+
+@event.listens_for(Session, 'before_flush')
+def _bump_versions_before_flush(session, flush_context, instances):
+    """
+    Bump versions for every flush that touches versioned rows, so both the
+    Cursor helpers and direct db.session.commit() edits are covered.
+    """
+    objects = [obj for obj in changed_objects(session) if not isinstance(obj, DataVersion)]
+    if any(_changes_tree(session, obj) for obj in objects):
+        bump_version(session, TREE_SCOPE)
+
+    user_ids = {user_id for obj in objects for user_id in affected_user_ids(session, obj) if user_id}
+    if user_ids:
+        bump_versions(session, USER_SCOPE, user_ids)
@@ -0,0 +1,105 @@
+"""
+Template compilation and fragment caching.
+
+- A FileSystemBytecodeCache keeps compiled templates on disk so a new
+  worker loads them instead of compiling them again.
+- `{% cache 'name', id, version %}...{% endcache %}` stores a rendered
+  fragment in the shared cache under its key parts and the template
+  version, so a card is rendered once per version of its entity.
+"""
+import hashlib
+import os
+from datetime import datetime, timezone
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from flask import current_app
+
+from family_tree.cache import cache
+
+
+def _scan_templates(app):
+    digest = hashlib.md5()
+    modified = 0
+    for root, dirs, files in os.walk(os.path.join(app.root_path, app.template_folder)):
+        dirs.sort()
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            modified = max(modified, os.path.getmtime(path))
+            with open(path, 'rb') as template:
+                digest.update(filename.encode() + template.read())
+    app.extensions['template_modified_at'] = datetime.fromtimestamp(
+        int(modified), timezone.utc)
+    app.extensions['template_version'] = digest.hexdigest()[:12]
+
+
+def template_version(app):
+    """
+    Hash of every template, computed once per process, so a deploy that
+    changes a template also changes every ETag and fragment key.
+    """
+    if 'template_version' not in app.extensions:
+        _scan_templates(app)
+    return app.extensions['template_version']
+
+
+def template_modified_at(app):
+    """
+    Time the newest template was written, in UTC and whole seconds, for
+    Last-Modified headers that must also move on a deploy.
+    """
+    if 'template_modified_at' not in app.extensions:
+        _scan_templates(app)
+    return app.extensions['template_modified_at']
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_render_fragment', [nodes.List(parts)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render_fragment(self, parts, caller):
+        app = current_app._get_current_object()
+        if not app.config.get('FRAGMENT_CACHE_ENABLED', True):
+            return caller()
+        key = 'fragment:' + ':'.join(map(str, [template_version(app)] + parts))
+        fragment = cache.get(key)
+        if fragment is None:
+            fragment = str(caller())
+            cache.set(key, fragment, app.config.get('FRAGMENT_CACHE_TTL'))
+        return Markup(fragment)
+
+
+def init_templating(app):
+    """
+    Must run before app.jinja_env is first used.
+    """
+    options = dict(app.jinja_options)
+    options['extensions'] = list(options.get('extensions', ())) + [FragmentCacheExtension]
+    cache_dir = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(cache_dir)
+    app.jinja_options = options
+
+
+def precompile_templates(app):
+    """
+    Compile every template once so the bytecode cache is warm before the
+    first request. Returns the number of templates compiled.
+    """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    app.logger.info(f'Precompiled {len(names)} templates')
+    return len(names)
@@ -0,0 +1,48 @@
+# Keep IN (...) lists well below SQLite's bound parameter limit
+BATCH_SIZE = 500
+
+
+def batched(items, size=BATCH_SIZE):
+    """
+    Split an iterable into lists of at most `size` items.
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+SOUNDEX_CODES = {
+    letter: str(code)
+    for code, letters in enumerate(('aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r'))
+    for letter in letters
+}
+
+
+def soundex(name):
+    """
+    American Soundex code of a name, e.g. 'Robert' and 'Rupert' -> 'R163',
+    or '' if it has no latin letters.
+    """
+    letters = [letter for letter in (name or '').lower() if letter in SOUNDEX_CODES]
+    if not letters:
+        return ''
+    key = letters[0].upper()
+    previous = SOUNDEX_CODES[letters[0]]
+    for letter in letters[1:]:
+        # h and w do not separate letters with the same code, vowels do
+        if letter in 'hw':
+            continue
+        code = SOUNDEX_CODES[letter]
+        if code != '0' and code != previous:
+            key += code
+        previous = code
+    return (key + '000')[:4]
+
+
+def name_key(first_name, last_name):
+    """
+    Phonetic blocking key of a person: similar sounding names share it.
+    """
+    if not soundex(last_name) and not soundex(first_name):
+        return None
+    return f'{soundex(last_name) or "-"}{soundex(first_name) or "-"}'
@@ -0,0 +1,165 @@
+"""
+Serialized write queue for SQLite.
+
+Cursor.add/update/delete hand their change to a writer thread as a
+mutation, a callable taking the writer's session. The thread takes every
+mutation waiting in the queue, applies them in one transaction and
+commits once (group commit), then hands each caller its result or error.
+
+- A mutation that fails only fails its own caller: the batch is rolled
+  back and replayed one mutation per commit.
+- A commit that still finds the database locked after busy_timeout
+  (another worker process is writing) is retried with backoff.
+- Counters for batches, commits, retries and lock errors are kept in
+  WriteQueue.stats and logged when a retry happens.
+- A caller that stops waiting (WRITE_QUEUE_TIMEOUT) cancels its write,
+  which the writer then skips, and gets a WriteTimeout, answered with a
+  503. A write the writer had already started on may still be committed.
+
+The queue needs the separate writer engine of family_tree/database.py, so
+it is only set up when read/write routing is on.
+"""
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+
+from family_tree.database import READ_BIND
+
+
+def _is_locked(error):
+    message = str(error.orig).lower()
+    return 'locked' in message or 'busy' in message
+
+
+class WriteTimeout(Exception):
+    """
+    The database did not take a write in time.
+    """
+
+
+class _Write:
+    def __init__(self, mutation):
+        self.mutation = mutation
+        self.future = Future()
+
+
+class WriteQueue:
+    def __init__(self, app, db, max_batch=100, linger=0.0, retries=5, backoff=0.05):
+        self.app = app
+        self.db = db
+        self.max_batch = max_batch
+        self.linger = linger
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = Counter()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, mutation):
+        """
+        Queue a mutation and return a Future for its result.
+        """
+        self._ensure_started()
+        write = _Write(mutation)
+        self._queue.put(write)
+        self.stats['writes'] += 1
+        return write.future
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so each worker starts its own. The
+        # queue is only replaced after a fork: the writes in the parent's
+        # belong to the parent, while a writer that died in this process
+        # is restarted on the same queue so the writes waiting are applied.
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                             if self.linger else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # Writes whose caller gave up waiting are dropped
+            batch = [write for write in self._next_batch()
+                     if write.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            with self.app.app_context():
+                self._apply(batch)
+
+    def _apply(self, batch):
+        session = self.db.session
+        self.stats['batches'] += 1
+        for attempt in range(self.retries + 1):
+            try:
+                results = []
+                for write in batch:
+                    results.append(write.mutation(session))
+                    session.flush()
+                session.commit()
+            except OperationalError as error:
+                session.rollback()
+                if not _is_locked(error):
+                    return self._fail(batch, error)
+                self.stats['locked'] += 1
+                if attempt == self.retries:
+                    self.app.logger.error(f'Gave up writing {len(batch)} changes: {error}')
+                    return self._fail(batch, error)
+                self.stats['retries'] += 1
+                self.app.logger.warning(
+                    f'Database locked, retry {attempt + 1} of {self.retries} for {len(batch)} changes')
+                time.sleep(self.backoff * 2 ** attempt)
+            except Exception as error:
+                session.rollback()
+                return self._fail(batch, error)
+            else:
+                self.stats['commits'] += 1
+                for write, result in zip(batch, results):
+                    write.future.set_result(result)
+                return
+
+    def _fail(self, batch, error):
+        if len(batch) == 1:
+            self.stats['errors'] += 1
+            batch[0].future.set_exception(error)
+            return
+        # Find the failing change by committing each one on its own
+        for write in batch:
+            self._apply([write])
+
+
+def init_write_queue(app, db):
+    # Writes outside Cursor wait for the writer connection in the pool
+    @app.errorhandler(PoolTimeoutError)
+    @app.errorhandler(WriteTimeout)
+    def write_timeout(error):
+        app.logger.error(f'Answering 503: {error}')
+        return 'The database is busy, please try again in a moment.', 503, {'Retry-After': '5'}
+
+    with app.app_context():
+        routed = READ_BIND in db.engines
+    if app.config.get('WRITE_QUEUE_ENABLED') and routed:
+        app.extensions['write_queue'] = WriteQueue(
+            app, db,
+            max_batch=app.config['WRITE_QUEUE_MAX_BATCH'],
+            linger=app.config['WRITE_QUEUE_LINGER'],
+            retries=app.config['WRITE_QUEUE_RETRIES'])
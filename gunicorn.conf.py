@@ -0,0 +1,78 @@
+"""
+Gunicorn settings for production, e.g. `gunicorn -c gunicorn.conf.py`.
+
+The app is preloaded in the master so workers share its memory copy on
+write; post_fork then gives every worker its own database connections.
+"""
+import multiprocessing
+import os
+
+from family_tree.config import Config
+
+wsgi_app = 'app:app'
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+preload_app = True
+
+worker_class = Config.GUNICORN_WORKER_CLASS
+if worker_class == 'gevent':
+    try:
+        import gevent  # noqa: F401
+    except ImportError:
+        worker_class = 'gthread'
+
+workers = Config.GUNICORN_WORKERS or min(multiprocessing.cpu_count() * 2 + 1,
+                                         Config.GUNICORN_MAX_WORKERS)
+if worker_class == 'gevent':
+    worker_connections = Config.GUNICORN_WORKER_CONNECTIONS
+else:
+    threads = Config.GUNICORN_THREADS
+
+timeout = Config.GUNICORN_TIMEOUT
+graceful_timeout = Config.GUNICORN_TIMEOUT
+keepalive = 5
+
+# Recycle workers so slow leaks stay bounded; the jitter stops them all
+# restarting at once
+max_requests = Config.GUNICORN_MAX_REQUESTS
+max_requests_jitter = Config.GUNICORN_MAX_REQUESTS_JITTER
+
+accesslog = '-'
+errorlog = '-'
+
+
+def when_ready(server):
+    """
+    Warm the template bytecode cache and precompressed static files once
+    in the master before any worker serves a request, and build the graph
+    index every worker maps.
+    """
+    from family_tree import db
+    from family_tree.compression import compress_static
+    from family_tree.graph_index import rebuild_graph_index
+    from family_tree.templating import precompile_templates
+
+    app = server.app.wsgi()
+    precompile_templates(app)
+    count = compress_static(app.static_folder)
+    server.log.info(f'Compressed {count} static files')
+    with app.app_context():
+        count = rebuild_graph_index(db)
+        db.session.remove()
+    if count is not None:
+        server.log.info(f'Built graph index with {count} edges')
+
+
+def post_fork(server, worker):
+    from family_tree import db, reset_after_fork
+    from family_tree.jobs import start_job_workers
+
+    app = worker.app.wsgi()
+    reset_after_fork(app)
+    start_job_workers(app, db)
+    # No threads in the master, whose locks every fork would copy; one
+    # worker at a time holds the backup scheduler's lock file
+    if app.config['BACKUP_INTERVAL']:
+        from family_tree.backup import BackupScheduler
+        if BackupScheduler(app.config, server.log).start():
+            server.log.info(f'Worker {worker.pid} runs the backup scheduler')
+    server.log.info(f'Worker {worker.pid} ready')
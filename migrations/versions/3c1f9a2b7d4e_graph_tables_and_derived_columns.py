@@ -0,0 +1,258 @@
+"""Graph tables, derived columns and background jobs
+
+Adds the tables and columns introduced since the original schema
+(family, ancestry closure, derived relatives, duplicate candidates, data
+versions, cached layouts, jobs; user.family_id, user.deleted_at,
+person.name_key and important_dates.month_day) and fills them in from
+the existing rows: month_day from the dates, name_key from the names,
+the families by a union-find over the relations and the ancestry
+closure from the parent relations.
+
+Databases created with db.create_all() already have the new schema, so
+every step is skipped when its table or column exists. The derived
+relations are left to 'flask rebuild-derived'.
+
+Revision ID: 3c1f9a2b7d4e
+Revises:
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from collections import deque
+
+from alembic import op
+import sqlalchemy as sa
+
+from family_tree.utils import name_key
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f9a2b7d4e'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+DERIVED_RELATIONS = ('GRANDPARENT', 'GRANDCHILD', 'SIBLING', 'HALFSIBLING', 'AUNT_UNCLE',
+                     'NIECE_NEPHEW', 'COUSIN', 'PARENT_IN_LAW', 'CHILD_IN_LAW', 'SIBLING_IN_LAW')
+JOB_STATUSES = ('QUEUED', 'RUNNING', 'SUCCEEDED', 'FAILED')
+BATCH_SIZE = 500
+
+
+def _tables():
+    return set(sa.inspect(op.get_bind()).get_table_names())
+
+
+def _columns(table):
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def _create_tables(existing):
+    if 'family' not in existing:
+        op.create_table(
+            'family',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('size', sa.Integer(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sqlite_autoincrement=True)
+    if 'ancestry' not in existing:
+        op.create_table(
+            'ancestry',
+            sa.Column('ancestor_id', sa.Integer(), nullable=False),
+            sa.Column('descendant_id', sa.Integer(), nullable=False),
+            sa.Column('distance', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['ancestor_id'], ['user.id'], ondelete='CASCADE'),
+            sa.ForeignKeyConstraint(['descendant_id'], ['user.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('ancestor_id', 'descendant_id'))
+        op.create_index('ix_ancestry_descendant_distance', 'ancestry',
+                        ['descendant_id', 'distance'])
+    if 'derived_relative' not in existing:
+        op.create_table(
+            'derived_relative',
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('relative_user_id', sa.Integer(), nullable=False),
+            sa.Column('relation', sa.Enum(*DERIVED_RELATIONS, name='derivedrelationenum'),
+                      nullable=False),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+            sa.ForeignKeyConstraint(['relative_user_id'], ['user.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('user_id', 'relative_user_id'))
+        op.create_index('ix_derived_relative_relative_user_id', 'derived_relative',
+                        ['relative_user_id'])
+    if 'duplicate_candidate' not in existing:
+        op.create_table(
+            'duplicate_candidate',
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('other_user_id', sa.Integer(), nullable=False),
+            sa.Column('score', sa.Float(), nullable=False),
+            sa.Column('dismissed', sa.Boolean(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+            sa.ForeignKeyConstraint(['other_user_id'], ['user.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('user_id', 'other_user_id'))
+        op.create_index('ix_duplicate_candidate_other_user_id', 'duplicate_candidate',
+                        ['other_user_id'])
+        op.create_index('ix_duplicate_candidate_dismissed_score', 'duplicate_candidate',
+                        ['dismissed', 'score'])
+    if 'data_version' not in existing:
+        op.create_table(
+            'data_version',
+            sa.Column('scope', sa.String(length=50), nullable=False),
+            sa.Column('key', sa.Integer(), nullable=False),
+            sa.Column('value', sa.Integer(), nullable=False),
+            sa.Column('updated_at', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('scope', 'key'))
+    if 'tree_layout' not in existing:
+        op.create_table(
+            'tree_layout',
+            sa.Column('component_id', sa.Integer(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.Column('layout', sa.Text(), nullable=False),
+            sa.Column('updated_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('component_id'))
+    if 'job' not in existing:
+        op.create_table(
+            'job',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(length=100), nullable=False),
+            sa.Column('payload', sa.Text(), nullable=False),
+            sa.Column('status', sa.Enum(*JOB_STATUSES, name='jobstatusenum'), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=True),
+            sa.Column('progress', sa.Float(), nullable=False),
+            sa.Column('message', sa.String(length=255), nullable=True),
+            sa.Column('result', sa.Text(), nullable=True),
+            sa.Column('error', sa.Text(), nullable=True),
+            sa.Column('attempts', sa.Integer(), nullable=False),
+            sa.Column('max_attempts', sa.Integer(), nullable=False),
+            sa.Column('worker', sa.String(length=100), nullable=True),
+            sa.Column('run_after', sa.DateTime(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('started_at', sa.DateTime(), nullable=True),
+            sa.Column('finished_at', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id'))
+        op.create_index('ix_job_status', 'job', ['status'])
+        op.create_index('ix_job_user_id', 'job', ['user_id'])
+
+
+def _add_columns():
+    user_columns = _columns('user')
+    with op.batch_alter_table('user') as batch_op:
+        if 'family_id' not in user_columns:
+            batch_op.add_column(sa.Column('family_id', sa.Integer(), nullable=True))
+            batch_op.create_index('ix_user_family_id', ['family_id'])
+            batch_op.create_foreign_key('fk_user_family_id_family', 'family', ['family_id'], ['id'])
+        if 'deleted_at' not in user_columns:
+            batch_op.add_column(sa.Column('deleted_at', sa.DateTime(), nullable=True))
+            batch_op.create_index('ix_user_deleted_at', ['deleted_at'])
+    if 'name_key' not in _columns('person'):
+        with op.batch_alter_table('person') as batch_op:
+            batch_op.add_column(sa.Column('name_key', sa.String(length=8), nullable=True))
+            batch_op.create_index('ix_person_name_key', ['name_key'])
+    if 'month_day' not in _columns('important_dates'):
+        with op.batch_alter_table('important_dates') as batch_op:
+            batch_op.add_column(sa.Column('month_day', sa.Integer(), nullable=True))
+            batch_op.create_index('ix_important_dates_month_day', ['month_day'])
+    return user_columns
+
+
+def _backfill_month_day(connection):
+    connection.execute(sa.text(
+        "UPDATE important_dates SET month_day = "
+        "CAST(strftime('%m', date) AS INTEGER) * 100 + CAST(strftime('%d', date) AS INTEGER) "
+        "WHERE month_day IS NULL"))
+
+
+def _backfill_name_keys(connection):
+    rows = connection.execute(sa.text(
+        'SELECT id, first_name, last_name FROM person WHERE name_key IS NULL')).all()
+    updates = [{'id': person_id, 'name_key': name_key(first_name, last_name)}
+               for person_id, first_name, last_name in rows]
+    for start in range(0, len(updates), BATCH_SIZE):
+        connection.execute(sa.text('UPDATE person SET name_key = :name_key WHERE id = :id'),
+                           updates[start:start + BATCH_SIZE])
+
+
+def _backfill_families(connection):
+    parent = {}
+
+    def find(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for user_id, relative_user_id in connection.execute(sa.text(
+            'SELECT user_id, relative_user_id FROM relatives')):
+        root, other = find(user_id), find(relative_user_id)
+        if root != other:
+            parent[max(root, other)] = min(root, other)
+
+    components = {}
+    for node in list(parent):
+        components.setdefault(find(node), []).append(node)
+    for member_ids in components.values():
+        family_id = connection.execute(
+            sa.text('INSERT INTO family (size, version) VALUES (:size, 1)'),
+            {'size': len(member_ids)}).lastrowid
+        connection.execute(sa.text('UPDATE user SET family_id = :family_id WHERE id = :id'),
+                           [{'family_id': family_id, 'id': user_id} for user_id in member_ids])
+
+
+def _backfill_ancestry(connection):
+    parents = {}
+    for user_id, relative_user_id, relation_type in connection.execute(sa.text(
+            "SELECT user_id, relative_user_id, relation_type FROM relatives "
+            "WHERE relation_type IN ('PARENT', 'CHILD')")):
+        parent_id, child_id = ((relative_user_id, user_id) if relation_type == 'PARENT'
+                               else (user_id, relative_user_id))
+        parents.setdefault(child_id, set()).add(parent_id)
+
+    rows = []
+    for descendant_id in parents:
+        # Breadth first, so each ancestor is met at its shortest distance
+        distances = {}
+        queue = deque((parent_id, 1) for parent_id in parents[descendant_id])
+        while queue:
+            ancestor_id, distance = queue.popleft()
+            if ancestor_id in distances or ancestor_id == descendant_id:
+                continue
+            distances[ancestor_id] = distance
+            queue.extend((grandparent_id, distance + 1)
+                         for grandparent_id in parents.get(ancestor_id, ()))
+        rows.extend({'ancestor_id': ancestor_id, 'descendant_id': descendant_id,
+                     'distance': distance} for ancestor_id, distance in distances.items())
+    for start in range(0, len(rows), BATCH_SIZE):
+        connection.execute(sa.text(
+            'INSERT INTO ancestry (ancestor_id, descendant_id, distance) '
+            'VALUES (:ancestor_id, :descendant_id, :distance)'), rows[start:start + BATCH_SIZE])
+
+
+def upgrade():
+    existing = _tables()
+    _create_tables(existing)
+    user_columns = _add_columns()
+
+    connection = op.get_bind()
+    _backfill_month_day(connection)
+    _backfill_name_keys(connection)
+    if 'family_id' not in user_columns:
+        _backfill_families(connection)
+    if 'ancestry' not in existing:
+        _backfill_ancestry(connection)
+
+
+def downgrade():
+    with op.batch_alter_table('important_dates') as batch_op:
+        batch_op.drop_index('ix_important_dates_month_day')
+        batch_op.drop_column('month_day')
+    with op.batch_alter_table('person') as batch_op:
+        batch_op.drop_index('ix_person_name_key')
+        batch_op.drop_column('name_key')
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_index('ix_user_deleted_at')
+        batch_op.drop_column('deleted_at')
+        batch_op.drop_constraint('fk_user_family_id_family', type_='foreignkey')
+        batch_op.drop_index('ix_user_family_id')
+        batch_op.drop_column('family_id')
+    for table in ('job', 'tree_layout', 'data_version', 'duplicate_candidate',
+                  'derived_relative', 'ancestry', 'family'):
+        op.drop_table(table)
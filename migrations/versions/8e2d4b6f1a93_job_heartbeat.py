@@ -0,0 +1,34 @@
+"""Job heartbeat
+
+Adds job.heartbeat_at, which progress() moves forward, so that running
+jobs are reclaimed when their heartbeat stops rather than a fixed time
+after they started. Running jobs start from their start time.
+
+Revision ID: 8e2d4b6f1a93
+Revises: 3c1f9a2b7d4e
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e2d4b6f1a93'
+down_revision = '3c1f9a2b7d4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('job')}
+    if 'heartbeat_at' in columns:
+        return
+    with op.batch_alter_table('job') as batch_op:
+        batch_op.add_column(sa.Column('heartbeat_at', sa.DateTime(), nullable=True))
+    op.execute('UPDATE job SET heartbeat_at = started_at')
+
+
+def downgrade():
+    with op.batch_alter_table('job') as batch_op:
+        batch_op.drop_column('heartbeat_at')
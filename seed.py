@@ -13,6 +13,10 @@ from family_tree.models import (
     ImportantDateTypeEnum,
     ContactDetails
 )
+from family_tree.graph_index import rebuild_graph_index
+from family_tree.services.ancestry import rebuild_ancestry
+from family_tree.services.derived import rebuild_derived_relatives
+from family_tree.services.family import rebuild_families
 
 
 def seed_database(app=None):
@@ -338,6 +342,12 @@ def seed_database(app=None):
         # Commit to DB
         db.session.bulk_save_objects(relationships)
         db.session.commit()
+
+        # Bulk inserts bypass the incremental maintenance, rebuild derived tables
+        rebuild_ancestry(db)
+        rebuild_families(db)
+        rebuild_derived_relatives(db)
+        rebuild_graph_index(db)
         print("SEEDING SUCCESSFULL!")
 
 if __name__ == "__main__":
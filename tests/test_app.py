@@ -0,0 +1,591 @@
+import gzip
+import os
+import runpy
+import shutil
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestGunicornConfig:
+    def load(self):
+        return runpy.run_path(os.path.join(ROOT, 'gunicorn.conf.py'))
+
+    def test_settings(self):
+        settings = self.load()
+        assert settings['preload_app'] is True
+        assert settings['wsgi_app'] == 'app:app'
+        assert 1 <= settings['workers']
+        assert settings['max_requests_jitter'] > 0
+        if settings['worker_class'] == 'gthread':
+            assert settings['threads'] >= 1
+
+    def test_post_fork_reopens_connections(self, app, db):
+        settings = self.load()
+        pool = db.engine.pool
+        logs = []
+        server = SimpleNamespace(log=SimpleNamespace(info=logs.append))
+        worker = SimpleNamespace(pid=1, app=SimpleNamespace(wsgi=lambda: app))
+
+        settings['post_fork'](server, worker)
+        assert db.engine.pool is not pool
+        assert logs == ['Worker 1 ready']
+
+    def test_post_fork_reopens_every_bind(self, tmp_path):
+        from family_tree import db
+
+        app = TestReadWriteRouting().create_app(tmp_path)
+        settings = self.load()
+        worker = SimpleNamespace(pid=1, app=SimpleNamespace(wsgi=lambda: app))
+        with app.app_context():
+            pools = {bind: engine.pool for bind, engine in db.engines.items()}
+            assert {None, 'reader'} <= set(pools)
+            settings['post_fork'](SimpleNamespace(log=SimpleNamespace(info=print)), worker)
+            assert all(db.engines[bind].pool is not pool for bind, pool in pools.items())
+
+
+class TestImportTime:
+    # Modules only needed by a few views or by the flask command line
+    LAZY_MODULES = ('PIL', 'numpy', 'brotli', 'flask_migrate', 'alembic',
+                    'family_tree.services.analytics', 'family_tree.services.gedcom',
+                    'family_tree.services.export', 'family_tree.services.imports')
+    # About 0.65s measured; the margin absorbs slower CI machines
+    BUDGET_US = 1_000_000
+
+    def test_create_app_import_budget(self):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'from family_tree import create_app; from tests.testconfig import TestConfig; '
+             'create_app(TestConfig)'],
+            cwd=ROOT, capture_output=True, text=True, check=True)
+
+        cumulative, total = {}, 0
+        for line in result.stderr.splitlines():
+            _, microseconds, name = line.split('|')
+            if not microseconds.strip().isdigit():
+                continue
+            cumulative[name.strip()] = int(microseconds)
+            if not name[1:].startswith(' '):
+                # Top level imports, whose times add up to the whole start up
+                total += int(microseconds)
+        loaded = [name for name in cumulative
+                  if name.startswith(tuple(module + '.' for module in self.LAZY_MODULES))
+                  or name in self.LAZY_MODULES]
+        assert loaded == []
+        assert total < self.BUDGET_US
+
+
+class TestReadWriteRouting:
+    def create_app(self, tmp_path, **settings):
+        from family_tree import create_app
+        from tests.testconfig import TestConfig
+
+        class RoutingConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'site.db'}"
+        for name, value in settings.items():
+            setattr(RoutingConfig, name, value)
+        return create_app(config_class=RoutingConfig)
+
+    def test_reads_and_writes_use_separate_engines(self, tmp_path):
+        from sqlalchemy import select, text
+        from sqlalchemy.exc import OperationalError
+        from family_tree import db
+        from family_tree.database import READ_BIND
+        from family_tree.models import User
+
+        app = self.create_app(tmp_path)
+        with app.app_context():
+            db.create_all()
+            reader, writer = db.engines[READ_BIND], db.engine
+            assert db.session.get_bind(clause=select(User)) is reader
+
+            db.session.add(User(username='user1', email='user1@example.com', password_hash='password'))
+            db.session.flush()
+            # Reads inside a transaction that wrote see its own changes
+            assert db.session.get_bind(clause=select(User)) is writer
+            assert db.session.scalars(select(User.username)).all() == ['user1']
+            db.session.commit()
+
+            assert db.session.get_bind(clause=select(User)) is reader
+            assert db.session.scalars(select(User.username)).all() == ['user1']
+            assert db.session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+            with reader.connect() as connection, pytest.raises(OperationalError):
+                connection.execute(text("DELETE FROM user"))
+            db.session.remove()
+            db.drop_all()
+
+    def test_snapshot_bind(self, tmp_path):
+        from sqlalchemy import select
+        from family_tree import db
+        from family_tree.database import SNAPSHOT_BIND, use_bind
+        from family_tree.models import User
+
+        snapshot_path = tmp_path / 'snapshot.db'
+        app = self.create_app(tmp_path, DATABASE_SNAPSHOT_URI=f'sqlite:///{snapshot_path}')
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(username='user1', email='user1@example.com', password_hash='password'))
+            db.session.commit()
+            db.session.remove()
+            db.engine.dispose()
+            shutil.copy(tmp_path / 'site.db', snapshot_path)
+
+            db.session.add(User(username='user2', email='user2@example.com', password_hash='password'))
+            db.session.commit()
+            with use_bind(db, SNAPSHOT_BIND):
+                assert db.session.scalars(select(User.username)).all() == ['user1']
+            assert db.session.scalars(select(User.username)).all() == ['user1', 'user2']
+            db.session.remove()
+
+
+class TestRoutedRequests:
+    def create_app(self, tmp_path, **settings):
+        from family_tree import db
+
+        app = TestReadWriteRouting().create_app(tmp_path, **settings)
+        with app.app_context():
+            db.create_all()
+        return app
+
+    def sign_up(self, client):
+        client.post('/register', data={
+            'username': 'routeduser', 'email': 'routeduser@example.com', 'password': 'pass'})
+        client.post('/login', data={'email': 'routeduser@example.com', 'password': 'pass'})
+        client.post('/edit_profile', data={'first_name': 'John', 'last_name': 'Doe', 'gender': 'MALE'})
+
+    def test_write_then_read_in_one_request(self, tmp_path):
+        import io
+        import os
+        from PIL import Image
+        from family_tree import db
+        from family_tree.models import Person, Picture
+
+        app = self.create_app(tmp_path)
+        client = app.test_client()
+        self.sign_up(client)
+        with app.app_context():
+            assert Person.query.one().first_name == 'John'
+
+        # The picture is written through the queue, then the page reads it back
+        png = io.BytesIO()
+        Image.new('RGB', (10, 10)).save(png, 'PNG')
+        response = client.post('/display_profile', data={
+            'picture_filename': (io.BytesIO(png.getvalue()), 'picture.png')
+        }, content_type='multipart/form-data')
+        assert response.status_code == 200
+        with app.app_context():
+            picture_filename = Picture.query.one().picture_filename
+            db.session.remove()
+        assert picture_filename.encode() in response.data
+        assert app.extensions['write_queue'].stats['commits'] >= 3
+        os.remove(os.path.join(app.root_path, 'static/profile_pictures', picture_filename))
+
+    def test_busy_writer_answers_503(self, tmp_path):
+        import threading
+        from family_tree import db
+        from family_tree.models import ImportantDates, User
+
+        app = self.create_app(tmp_path, DATABASE_WRITE_TIMEOUT=0.2)
+        client = app.test_client()
+        self.sign_up(client)
+
+        # A long merge or import holds the only writer connection
+        holding, release = threading.Event(), threading.Event()
+
+        def hold_writer():
+            with app.app_context():
+                db.session.add(User(username='other', email='other@example.com', password_hash='password'))
+                db.session.flush()
+                holding.set()
+                release.wait(5)
+                db.session.rollback()
+                db.session.remove()
+
+        thread = threading.Thread(target=hold_writer)
+        thread.start()
+        assert holding.wait(5)
+        data = {'date_type': 'BIRTH', 'date': '1980-01-02'}
+        try:
+            response = client.post('/add_important_date', data=data)
+            assert response.status_code == 503
+            assert response.headers['Retry-After'] == '5'
+        finally:
+            release.set()
+            thread.join()
+
+        assert client.post('/add_important_date', data=data).status_code == 302
+        with app.app_context():
+            assert ImportantDates.query.count() == 1
+            db.session.remove()
+
+
+class TestWriteQueue:
+    def create_app(self, tmp_path, **settings):
+        return TestReadWriteRouting().create_app(tmp_path, **settings)
+
+    def test_concurrent_writes_are_group_committed(self, tmp_path):
+        import threading
+        from family_tree import db
+        from family_tree.cursor import Cursor
+        from family_tree.models import User
+
+        app = self.create_app(tmp_path)
+        write_queue = app.extensions['write_queue']
+        with app.app_context():
+            db.create_all()
+
+        errors = []
+
+        def register(i):
+            with app.app_context():
+                try:
+                    Cursor().add(db, User, username=f'user{i}', email=f'user{i}@example.com',
+                                 password_hash='password')
+                except Exception as error:
+                    errors.append(error)
+
+        threads = [threading.Thread(target=register, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with app.app_context():
+            assert errors == []
+            assert User.query.count() == 20
+        assert write_queue.stats['writes'] == 20
+        assert 1 <= write_queue.stats['commits'] <= 20
+
+    def test_failed_write_only_fails_its_caller(self, tmp_path):
+        from sqlalchemy.exc import IntegrityError
+        from family_tree import db
+        from family_tree.models import User
+
+        app = self.create_app(tmp_path)
+        write_queue = app.extensions['write_queue']
+        with app.app_context():
+            db.create_all()
+
+        def add(name):
+            return lambda session: session.add(
+                User(username=name, email=f'{name}@example.com', password_hash='password'))
+
+        futures = [write_queue.submit(add(name)) for name in ('user1', 'user2', 'user1', 'user3')]
+        assert futures[2].exception(timeout=5).__class__ is IntegrityError
+        for future in (futures[0], futures[1], futures[3]):
+            assert future.exception(timeout=5) is None
+        with app.app_context():
+            assert sorted(user.username for user in User.query.all()) == ['user1', 'user2', 'user3']
+
+    def test_locked_database_is_retried(self, tmp_path):
+        import sqlite3
+        import threading
+        from family_tree import db
+        from family_tree.cursor import Cursor
+        from family_tree.models import User
+
+        app = self.create_app(tmp_path, DATABASE_BUSY_TIMEOUT=10)
+        write_queue = app.extensions['write_queue']
+        with app.app_context():
+            db.create_all()
+
+        # Another process holding the write lock
+        other = sqlite3.connect(tmp_path / 'site.db', isolation_level=None, check_same_thread=False)
+        other.execute('BEGIN IMMEDIATE')
+        threading.Timer(0.2, other.execute, args=('COMMIT',)).start()
+
+        with app.app_context():
+            Cursor().add(db, User, username='user1', email='user1@example.com', password_hash='password')
+            assert User.query.count() == 1
+        assert write_queue.stats['retries'] >= 1
+        other.close()
+
+
+    def test_timed_out_write_is_abandoned(self, tmp_path):
+        import threading
+        from family_tree import db
+        from family_tree.cursor import Cursor
+        from family_tree.models import User
+        from family_tree.writes import WriteTimeout
+
+        app = self.create_app(tmp_path, WRITE_QUEUE_TIMEOUT=0.1)
+        write_queue = app.extensions['write_queue']
+        with app.app_context():
+            db.create_all()
+
+        # The writer is busy with a slow change
+        started, release = threading.Event(), threading.Event()
+        slow = write_queue.submit(lambda session: started.set() or release.wait(5))
+        assert started.wait(5)
+        with app.app_context(), pytest.raises(WriteTimeout, match='abandoned'):
+            Cursor().add(db, User, username='user1', email='user1@example.com', password_hash='password')
+        release.set()
+        slow.result(timeout=5)
+
+        write_queue.submit(lambda session: None).result(timeout=5)
+        with app.app_context():
+            assert User.query.count() == 0
+
+    @pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+    def test_dead_writer_is_restarted_on_its_queue(self, tmp_path):
+        import threading
+        from family_tree import db
+        from family_tree.models import User
+
+        app = self.create_app(tmp_path)
+        write_queue = app.extensions['write_queue']
+        with app.app_context():
+            db.create_all()
+
+        def add(name):
+            return lambda session: session.add(
+                User(username=name, email=f'{name}@example.com', password_hash='password'))
+
+        def die(session):
+            started.set()
+            release.wait(5)
+            raise SystemExit
+
+        # The writer dies with a write still waiting in the queue
+        started, release = threading.Event(), threading.Event()
+        write_queue.submit(die)
+        assert started.wait(5)
+        waiting = write_queue.submit(add('user1'))
+        dead = write_queue._thread
+        release.set()
+        dead.join(5)
+        assert not dead.is_alive()
+
+        later = write_queue.submit(add('user2'))
+        assert waiting.exception(timeout=5) is None and later.exception(timeout=5) is None
+        with app.app_context():
+            assert sorted(user.username for user in User.query.all()) == ['user1', 'user2']
+
+
+class TestBackup:
+    def test_backup_and_restore(self, tmp_path):
+        from family_tree import db
+        from family_tree.backup import create_backup, list_backups, restore_backup
+        from family_tree.models import User
+
+        app = TestReadWriteRouting().create_app(
+            tmp_path, BACKUP_DIR=str(tmp_path / 'backups'), BACKUP_KEEP=2, BACKUP_PAGES_PER_STEP=1,
+            BACKUP_STEP_SLEEP=0, WRITE_QUEUE_ENABLED=False)
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(username='user1', email='user1@example.com', password_hash='password'))
+            db.session.commit()
+
+            path = create_backup(app.config)
+            with gzip.open(path, 'rb') as backup:
+                assert backup.read(16) == b'SQLite format 3\x00'
+
+            db.session.add(User(username='user2', email='user2@example.com', password_hash='password'))
+            db.session.commit()
+            restore_backup(app.config, path)
+            db.session.remove()
+            assert [user.username for user in User.query.all()] == ['user1']
+
+            paths = [create_backup(app.config) for _ in range(3)]
+            assert list_backups(app.config) == paths[:0:-1]
+            db.session.remove()
+
+    def test_backup_finishes_under_writes(self, tmp_path):
+        import sqlite3
+        import threading
+        from family_tree import db
+        from family_tree.backup import create_backup
+        from family_tree.models import User
+
+        app = TestReadWriteRouting().create_app(
+            tmp_path, BACKUP_DIR=str(tmp_path / 'backups'), BACKUP_PAGES_PER_STEP=1,
+            BACKUP_STEP_SLEEP=0.001, BACKUP_MAX_RESTARTS=2, WRITE_QUEUE_ENABLED=False)
+        with app.app_context():
+            db.create_all()
+            db.session.add_all(User(username=f'user{i}', email=f'user{i}@example.com',
+                                    password_hash='password' * 20) for i in range(500))
+            db.session.commit()
+            db.session.remove()
+
+        # Every write from another connection restarts a copy in steps
+        stop = threading.Event()
+
+        def write():
+            connection = sqlite3.connect(str(tmp_path / 'site.db'), isolation_level=None)
+            while not stop.is_set():
+                connection.execute("UPDATE user SET email = email || 'x' WHERE id = 1")
+            connection.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        warnings = []
+        logger = SimpleNamespace(info=lambda message: None, warning=warnings.append)
+        try:
+            path = create_backup(app.config, logger)
+        finally:
+            stop.set()
+            writer.join()
+        assert len(warnings) == 1
+        with gzip.open(path, 'rb') as backup, open(tmp_path / 'copy.db', 'wb') as copy:
+            shutil.copyfileobj(backup, copy)
+        connection = sqlite3.connect(str(tmp_path / 'copy.db'))
+        assert connection.execute('SELECT count(*) FROM user').fetchone()[0] == 500
+        connection.close()
+
+    def test_restore_command_rebuilds_graph_index(self, tmp_path):
+        from family_tree import db
+        from family_tree.backup import create_backup
+        from family_tree.graph_index import get_graph_index, rebuild_graph_index
+        from family_tree.models import Relatives, RelativesTypeEnum, User
+
+        app = TestReadWriteRouting().create_app(
+            tmp_path, BACKUP_DIR=str(tmp_path / 'backups'), GRAPH_INDEX_PATH=str(tmp_path / 'graph.idx'),
+            WRITE_QUEUE_ENABLED=False)
+        with app.app_context():
+            db.create_all()
+            db.session.add_all(User(id=i, username=f'user{i}', email=f'user{i}@example.com',
+                                    password_hash='password') for i in (1, 2))
+            db.session.commit()
+            path = create_backup(app.config)
+            db.session.add_all([
+                Relatives(user_id=1, relative_user_id=2, relation_type=RelativesTypeEnum.SIBLING),
+                Relatives(user_id=2, relative_user_id=1, relation_type=RelativesTypeEnum.SIBLING)])
+            db.session.commit()
+            rebuild_graph_index(db)
+            assert get_graph_index().edge_count == 2
+            db.session.remove()
+
+        result = app.test_cli_runner().invoke(args=['restore-db', '--yes', path])
+        assert result.exit_code == 0
+        with app.app_context():
+            assert get_graph_index().edge_count == 0
+
+    def test_restore_command_checks_backup(self, tmp_path):
+        from family_tree import db
+
+        app = TestReadWriteRouting().create_app(tmp_path, BACKUP_DIR=str(tmp_path / 'backups'))
+        with app.app_context():
+            db.create_all()
+        corrupt = tmp_path / 'backups' / 'site-corrupt.db.gz'
+        corrupt.parent.mkdir()
+        corrupt.write_bytes(gzip.compress(b'not a database' * 100))
+
+        result = app.test_cli_runner().invoke(args=['restore-db', '--yes', str(corrupt)])
+        assert result.exit_code != 0
+        result = app.test_cli_runner().invoke(args=['backup-db'])
+        assert 'Backed up database' in result.output
+
+    def test_scheduler(self, tmp_path):
+        import logging
+        import time
+        from family_tree import db
+        from family_tree.backup import BackupScheduler, list_backups
+
+        app = TestReadWriteRouting().create_app(tmp_path, BACKUP_DIR=str(tmp_path / 'backups'),
+                                                BACKUP_INTERVAL=0.05)
+        with app.app_context():
+            db.create_all()
+        scheduler = BackupScheduler(app.config, logging.getLogger(__name__))
+        assert scheduler.start()
+        # Only one scheduler runs at a time
+        assert not BackupScheduler(app.config, logging.getLogger(__name__)).start()
+        deadline = time.monotonic() + 5
+        while not list_backups(app.config) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        scheduler.stop()
+        assert list_backups(app.config)
+
+        other = BackupScheduler(app.config, logging.getLogger(__name__))
+        assert other.start()
+        other.stop()
+
+
+class TestJobWorkers:
+    def test_workers_run_queued_jobs(self, tmp_path):
+        import time
+        from family_tree import db
+        from family_tree.jobs import enqueue, job, start_job_workers
+        from family_tree.models import Job, JobStatusEnum
+
+        @job('test_square')
+        def square(db, progress, value):
+            return value * value
+
+        app = TestReadWriteRouting().create_app(tmp_path, JOBS_EAGER=False, JOBS_WORKERS=2,
+                                                JOBS_POLL_INTERVAL=0.02)
+        with app.app_context():
+            db.create_all()
+            job_ids = [enqueue(db, 'test_square', value=value).id for value in range(5)]
+
+        pool = start_job_workers(app, db)
+        try:
+            deadline = time.monotonic() + 5
+            with app.app_context():
+                while time.monotonic() < deadline:
+                    db.session.remove()
+                    jobs = Job.query.filter(Job.id.in_(job_ids)).order_by(Job.id).all()
+                    if all(queued.status == JobStatusEnum.SUCCEEDED for queued in jobs):
+                        break
+                    time.sleep(0.05)
+                assert [queued.result for queued in jobs] == ['0', '1', '4', '9', '16']
+                assert all(queued.attempts == 1 for queued in jobs)
+        finally:
+            pool.stop()
+
+
+class TestMigrations:
+    # The tables of the database the app shipped with, before the migrations
+    ORIGINAL_SCHEMA = (
+        'CREATE TABLE user (id INTEGER NOT NULL PRIMARY KEY, username VARCHAR(100) NOT NULL UNIQUE, '
+        'email VARCHAR(120) NOT NULL UNIQUE, password_hash TEXT NOT NULL, is_admin BOOLEAN)',
+        'CREATE TABLE person (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL '
+        'REFERENCES user (id), gender VARCHAR(6) NOT NULL, first_name VARCHAR(100) NOT NULL, '
+        'middle_name VARCHAR(100), last_name VARCHAR(100) NOT NULL)',
+        'CREATE TABLE important_dates (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL '
+        'REFERENCES user (id), date_type VARCHAR(8) NOT NULL, date DATE NOT NULL)',
+        'CREATE TABLE relatives (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL '
+        'REFERENCES user (id), relative_user_id INTEGER NOT NULL REFERENCES user (id), '
+        'relation_type VARCHAR(11) NOT NULL)'
+    )
+
+    def test_upgrade_original_database(self, tmp_path):
+        import sqlite3
+        from flask_migrate import Migrate, upgrade
+        from family_tree import db
+
+        path = tmp_path / 'site.db'
+        connection = sqlite3.connect(path)
+        for statement in self.ORIGINAL_SCHEMA:
+            connection.execute(statement)
+        connection.executemany('INSERT INTO user VALUES (?, ?, ?, ?, 0)', [
+            (i, f'user{i}', f'user{i}@example.com', 'password') for i in range(1, 5)])
+        connection.executemany("INSERT INTO person VALUES (?, ?, 'MALE', ?, NULL, 'Smith')", [
+            (i, i, name) for i, name in enumerate(['John', 'Jon', 'Mary', 'Ann'], start=1)])
+        connection.execute("INSERT INTO important_dates VALUES (1, 1, 'BIRTH', '1950-03-07')")
+        # 1 is the parent of 2, who is the parent of 3; 4 is on their own
+        connection.executemany('INSERT INTO relatives VALUES (?, ?, ?, ?)', [
+            (1, 2, 1, 'PARENT'), (2, 1, 2, 'CHILD'), (3, 3, 2, 'PARENT'), (4, 2, 3, 'CHILD')])
+        connection.commit()
+        connection.close()
+
+        app = TestReadWriteRouting().create_app(tmp_path)
+        Migrate(app, db, directory=os.path.join(ROOT, 'migrations'), render_as_batch=True)
+        with app.app_context():
+            upgrade()
+            db.engine.dispose()
+
+        connection = sqlite3.connect(path)
+        assert connection.execute('SELECT month_day FROM important_dates').fetchall() == [(307,)]
+        assert connection.execute('SELECT name_key FROM person WHERE id IN (1, 2)').fetchall() \
+            == [('S530J500',), ('S530J500',)]
+        families = dict(connection.execute('SELECT id, family_id FROM user').fetchall())
+        assert families[1] == families[2] == families[3] is not None and families[4] is None
+        assert connection.execute('SELECT size FROM family').fetchall() == [(3,)]
+        assert sorted(connection.execute('SELECT * FROM ancestry').fetchall()) == [
+            (1, 2, 1), (1, 3, 2), (2, 3, 1)]
+        assert 'heartbeat_at' in [row[1] for row in connection.execute('PRAGMA table_info(job)')]
+        connection.close()
@@ -0,0 +1,214 @@
+import socketserver
+import threading
+import time
+
+import pytest
+
+from family_tree.cache import (
+    LRUCache,
+    SQLiteCache,
+    RedisCache,
+    cached,
+    invalidate_tags
+)
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough of the Redis protocol to exercise RedisCache.
+    """
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def bulk(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def handle(self):
+        data = self.server.data
+        expires = {}
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            for key, expiry in list(expires.items()):
+                if expiry < time.monotonic():
+                    data.pop(key, None)
+                    del expires[key]
+            command = args[0].upper()
+            if command == b'GET':
+                reply = self.bulk(data.get(args[1]))
+            elif command == b'MGET':
+                reply = b'*%d\r\n' % (len(args) - 1) + b''.join(self.bulk(data.get(key)) for key in args[1:])
+            elif command == b'SET':
+                data[args[1]] = args[2]
+                if len(args) == 5 and args[3].upper() == b'PX':
+                    expires[args[1]] = time.monotonic() + int(args[4]) / 1000
+                reply = b'+OK\r\n'
+            elif command == b'DEL':
+                reply = b':%d\r\n' % sum(data.pop(key, None) is not None for key in args[1:])
+            elif command == b'INCR':
+                data[args[1]] = str(int(data.get(args[1], b'0')) + 1).encode()
+                reply = b':' + data[args[1]] + b'\r\n'
+            elif command == b'SCAN':
+                keys = [key for key in data if key.startswith(args[3].rstrip(b'*'))]
+                reply = b'*2\r\n$1\r\n0\r\n*%d\r\n' % len(keys) + b''.join(self.bulk(key) for key in keys)
+            else:
+                reply = b'-ERR unknown command\r\n'
+            self.wfile.write(reply)
+
+
+@pytest.fixture()
+def redis_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _RespHandler)
+    server.daemon_threads = True
+    server.data = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestCacheBackends:
+    def check_backend(self, backend):
+        assert backend.get('missing') is None
+        backend.set('key', {'value': [1, 2]})
+        assert backend.get('key') == {'value': [1, 2]}
+        assert backend.get_many(['key', 'missing']) == [{'value': [1, 2]}, None]
+        assert backend.incr('counter') == 1
+        assert backend.incr('counter') == 2
+        backend.delete('key')
+        assert backend.get('key') is None
+
+        backend.set('short', 'lived', ttl=0.05)
+        time.sleep(0.1)
+        assert backend.get('short') is None
+
+        backend.set('key', 'value')
+        backend.clear()
+        assert backend.get('key') is None
+
+    def test_lru(self):
+        self.check_backend(LRUCache())
+        backend = LRUCache(max_entries=2)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+        assert (backend.get('a'), backend.get('b'), backend.get('c')) == (1, None, 3)
+
+    def test_sqlite_shared_file(self, tmp_path):
+        path = str(tmp_path / 'cache.db')
+        self.check_backend(SQLiteCache(path))
+        SQLiteCache(path).set('shared', 'value')
+        assert SQLiteCache(path).get('shared') == 'value'
+
+    def test_sqlite_stays_bounded(self, tmp_path):
+        backend = SQLiteCache(str(tmp_path / 'cache.db'), max_entries=10)
+        backend.incr('tag:people')
+        backend.set('expired', 'value', ttl=0.01)
+        time.sleep(0.02)
+        for number in range(100):
+            backend.set(f'key{number}', number)
+        count = backend._connection().execute('SELECT count(*) FROM cache').fetchone()[0]
+        assert count <= 10
+        assert backend.get('tag:people') == 1
+        assert backend.get('key99') == 99 and backend.get('key0') is None
+
+    def test_redis(self, redis_server):
+        host, port = redis_server.server_address
+        self.check_backend(RedisCache(f'redis://{host}:{port}/0'))
+        RedisCache(f'redis://{host}:{port}/0').set('shared', 'value')
+        assert b'family_tree:shared' in redis_server.data
+
+
+class TestCachedDecorator:
+    def test_tag_invalidation(self, app, db):
+        calls = []
+
+        @cached(tags=lambda db, user_id: (f'user:{user_id}',))
+        def load(db, user_id):
+            calls.append(user_id)
+            return {'user_id': user_id}
+
+        assert load(db, 1) == load(db, 1) == {'user_id': 1}
+        load(db, 2)
+        assert calls == [1, 2]
+
+        invalidate_tags('user:1')
+        load(db, 1)
+        load(db, 2)
+        assert calls == [1, 2, 1]
+
+    def test_tag_versions_survive_eviction(self, app, db):
+        calls = []
+
+        @cached(tags=('people',))
+        def load(db):
+            calls.append(len(calls))
+            return len(calls)
+
+        app.extensions['cache'] = LRUCache(max_entries=4)
+        assert load(db) == 1
+        invalidate_tags('people')
+        assert load(db) == 2
+        invalidate_tags('people')
+        # Fill the cache well past its size; the counter must stay
+        for number in range(10):
+            app.extensions['cache'].set(f'key{number}', number)
+        assert load(db) == 3
+        assert app.extensions['cache'].get('tag:people') == 2
+
+    def test_person_choices_invalidated_by_profile_change(self, app, db):
+        from family_tree.cursor import Cursor
+        from family_tree.models import User, Person, GenderEnum
+        from family_tree.services.user import get_person_choices
+
+        cursor = Cursor()
+        cursor.add(db, User, id=1, username='user1', email='user1@example.com', password_hash='password')
+        cursor.add(db, Person, user_id=1, first_name='First', last_name='Last', gender=GenderEnum.MALE)
+        assert get_person_choices(db, User) == [(1, 'First Last')]
+
+        person = Person.query.filter_by(user_id=1).first()
+        cursor.update(db, Person, person.id, first_name='Renamed')
+        assert get_person_choices(db, User) == [(1, 'Renamed Last')]
+
+
+class TestTemplating:
+    def test_fragment_cache(self, app):
+        calls = []
+
+        def render():
+            calls.append(1)
+            return '<b>card</b>'
+
+        template = app.jinja_env.from_string(
+            "{% cache 'card', user_id, version %}{{ render()|safe }} {{ name }}{% endcache %}")
+        with app.test_request_context():
+            assert template.render(render=render, user_id=1, version=1, name='<x>') == '<b>card</b> &lt;x&gt;'
+            assert template.render(render=render, user_id=1, version=1, name='other') == '<b>card</b> &lt;x&gt;'
+            assert template.render(render=render, user_id=1, version=2, name='other') == '<b>card</b> other'
+        assert len(calls) == 2
+
+    def test_precompile_templates(self, tmp_path):
+        from family_tree import create_app
+        from family_tree.templating import precompile_templates
+        from tests.testconfig import TestConfig
+
+        class BytecodeConfig(TestConfig):
+            JINJA_BYTECODE_CACHE_DIR = str(tmp_path)
+
+        app = create_app(config_class=BytecodeConfig)
+        count = precompile_templates(app)
+        assert count == len(app.jinja_env.list_templates()) > 0
+        assert len(list(tmp_path.iterdir())) == count
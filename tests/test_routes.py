@@ -1,3 +1,5 @@
+import io
+
 import pytest
 
 from sqlalchemy import or_ 
@@ -17,9 +19,12 @@ from family_tree.models import (
     Address,
     ImportantDateTypeEnum,
     ImportantDates,
-    ContactDetails
+    ContactDetails,
+    DuplicateCandidate
 )
 
+from family_tree.services.family import rebuild_families
+
 
 class TestCommonRoutes:
     def test_register_sucess(self, client):
@@ -209,6 +214,53 @@ class TestUserRoutes:
         assert response.status_code == 200 or response.status_code == 302
         assert b'Profile updated successfully!' in response.data
 
+    def test_profile_picture_validated_before_saving(self, client, app):
+        import os
+        from PIL import Image
+        from family_tree.models import Job, Picture
+
+        client.post('/register', data={
+            'username': 'pictureuser',
+            'email': 'pictureuser@example.com',
+            'password': 'pass'
+        })
+        client.post('/login', data={
+            'email': 'pictureuser@example.com',
+            'password': 'pass',
+        }, follow_redirects=True)
+        client.post('/edit_profile', data={
+            'first_name': 'John',
+            'last_name': 'Doe',
+            'gender': 'MALE'
+        })
+        picture_dir = os.path.join(app.root_path, 'static/profile_pictures')
+        stored = set(os.listdir(picture_dir))
+
+        response = client.post('/display_profile', data={
+            'picture_filename': (io.BytesIO(b'<script>not an image</script>'), 'picture.jpg')
+        }, content_type='multipart/form-data')
+        assert b'The file is not a JPEG or PNG image.' in response.data
+
+        png = io.BytesIO()
+        Image.new('RGB', (300, 200)).save(png, 'PNG')
+        app.config['PICTURE_MAX_BYTES'] = 10
+        response = client.post('/display_profile', data={
+            'picture_filename': (io.BytesIO(png.getvalue()), 'picture.png')
+        }, content_type='multipart/form-data')
+        assert b'Pictures can be at most 0 MB.' in response.data
+        assert set(os.listdir(picture_dir)) == stored
+        assert Picture.query.count() == 0 and Job.query.count() == 0
+
+        app.config['PICTURE_MAX_BYTES'] = 1024 * 1024
+        response = client.post('/display_profile', data={
+            'picture_filename': (io.BytesIO(png.getvalue()), 'picture.png')
+        }, content_type='multipart/form-data')
+        assert b'Profile Picture Updated!' in response.data
+        picture_filename = Picture.query.one().picture_filename
+        with Image.open(os.path.join(picture_dir, picture_filename)) as image:
+            assert image.size == (125, 83)
+        os.remove(os.path.join(picture_dir, picture_filename))
+
     def test_address(self, client):
         client.post('/register', data={
             'username': 'newuser',
@@ -652,6 +704,54 @@ class TestUserRoutes:
         assert any(d.date_type.name == 'BIRTH' and d.date ==
                    datetime.date(2000, 1, 1) for d in dates)
 
+    def test_important_dates_conditional_get(self, app, client):
+        client.post('/register', data={
+            'username': 'dateuser',
+            'email': 'dateuser@example.com',
+            'password': 'pass'
+        })
+        client.post('/login', data={
+            'email': 'dateuser@example.com',
+            'password': 'pass',
+        }, follow_redirects=True)
+
+        response = client.get('/display_important_dates')
+        etag = response.headers['ETag']
+        assert response.status_code == 200
+
+        response = client.get('/display_important_dates', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+
+        # Another page of the same user has its own tag
+        assert client.get('/display_contact_details').headers['ETag'] != etag
+
+        # Writing to the user's rows changes the tag; the flash forces a render
+        response = client.post('/add_important_date', data={
+            'date_type': 'BIRTH',
+            'date': '2000-01-01',
+        }, follow_redirects=True)
+        assert b'Important date added successfully!' in response.data
+        response = client.get('/display_important_dates', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert b'2000-01-01' in response.data
+
+        last_modified = response.headers['Last-Modified']
+        response = client.get('/display_important_dates', headers={
+            'If-Modified-Since': last_modified})
+        assert response.status_code == 304
+
+        # A deploy with new templates renders again for If-Modified-Since too
+        from datetime import datetime, timedelta, timezone
+        app.extensions['template_version'] = 'deployed'
+        app.extensions['template_modified_at'] = (
+            datetime.now(timezone.utc).replace(microsecond=0) + timedelta(minutes=1))
+        response = client.get('/display_important_dates', headers={
+            'If-Modified-Since': last_modified})
+        assert response.status_code == 200
+        assert response.headers['Last-Modified'] != last_modified
+
     def test_delete_important_date_success(self, client):
         from family_tree.models import ImportantDates
         import datetime
@@ -1048,6 +1148,31 @@ class TestUserRoutes:
         assert response.status_code == 200 or response.status_code == 302
         assert b'Could not find relation with relative user id' in response.data
 
+    def test_export_record(self, client, app):
+        seed_database(app)
+        client.post('/login', data={
+            'email':'charlie@example.com',
+            'password':'password123'
+        }, follow_redirects = True)
+
+        response = client.get('/export_record.json')
+        assert response.status_code == 200
+        record = response.get_json()
+        assert record['profile']['first_name'] == 'Charlie'
+        assert record['addresses'][0]['pin_code'] == 400001
+        assert record['important_dates'][0] == {'id': 3, 'date_type': 'BIRTH', 'date': '2020-02-29'}
+        assert record['contact_details'][0]['mobile_no'] == '7700900900'
+        assert {'relative_user_id': 4, 'relation_type': 'PARENT'}.items() <= record['relatives'][0].items()
+
+        response = client.get('/export_record.csv')
+        assert response.headers['Content-Disposition'] == 'attachment; filename=charlie.csv'
+        lines = response.get_data(as_text=True).splitlines()
+        assert lines[0] == 'section,item,field,value'
+        assert 'profile,1,first_name,Charlie' in lines
+        assert 'relatives,1,relative_user_id,4' in lines
+
+        assert client.get('/export_record.xml').status_code == 404
+
 class TestAdminRoutes:
     def test_delete_user(self, client, app):
         seed_database(app)
@@ -1103,3 +1228,365 @@ class TestAdminRoutes:
         ).all()
         assert len(relatives) == 0
 
+    def test_display_families(self, client, app):
+        seed_database(app)
+        client.post('/login', data={
+            'email':'alice@example.com',
+            'password':'password123'
+        }, follow_redirects = True)
+
+        charlie = User.query.filter_by(id=3).first()
+        response = client.get('/admin/display_families')
+        assert response.status_code == 200
+        assert f'#{charlie.family_id}'.encode() in response.data
+
+        response = client.get(f'/admin/display_family/{charlie.family_id}')
+        assert response.status_code == 200
+        assert b'Charlie Campbell' in response.data
+        assert b'person_user_no_10 Random' in response.data
+
+        # Deleting the hub of the family breaks it apart
+        client.post('/admin/delete_user/3', follow_redirects = True)
+        assert User.query.filter_by(id=10).first().family_id is None
+        assert User.query.filter_by(id=5).first().family_id == User.query.filter_by(id=6).first().family_id
+
+    def test_analytics(self, client, app):
+        seed_database(app)
+        client.post('/login', data={
+            'email':'alice@example.com',
+            'password':'password123'
+        }, follow_redirects = True)
+
+        charlie = User.query.filter_by(id=3).first()
+        response = client.get('/admin/analytics')
+        assert response.status_code == 200
+        assert b'Largest Families' in response.data
+        assert f'#{charlie.family_id}'.encode() in response.data
+
+    def test_duplicates(self, client, app):
+        seed_database(app)
+        client.post('/login', data={
+            'email':'alice@example.com',
+            'password':'password123'
+        }, follow_redirects = True)
+
+        # Seeded people share a name and are unrelated
+        response = client.post('/admin/find_duplicates', follow_redirects = True)
+        assert response.status_code == 200
+        assert b'Duplicate detection queued' in response.data
+        candidate = DuplicateCandidate.query.order_by(DuplicateCandidate.user_id,
+                                                      DuplicateCandidate.other_user_id).first()
+        assert candidate is not None
+        assert f'#{candidate.other_user_id}'.encode() in response.data
+
+        survivor_id, duplicate_id = candidate.user_id, candidate.other_user_id
+        response = client.post(f'/admin/merge_users/{survivor_id}/{duplicate_id}',
+                               follow_redirects = True)
+        assert b'Merged Successfully!' in response.data
+        assert db.session.get(User, duplicate_id) is None
+
+        response = client.post(f'/admin/merge_users/{survivor_id}/{survivor_id}',
+                               follow_redirects = True)
+        assert b'Could not merge' in response.data
+
+    def test_import_relatives(self, client, app):
+        seed_database(app)
+        client.post('/login', data={
+            'email':'alice@example.com',
+            'password':'password123'
+        }, follow_redirects = True)
+
+        response = client.get('/admin/import_relatives')
+        assert response.status_code == 200
+
+        count = Relatives.query.count()
+        csv_data = b'user_id,relative_user_id,relation_type\n3,9999,SPOUSE\n3,3,SIBLING\n'
+        response = client.post('/admin/import_relatives', data={
+            'relatives_file': (io.BytesIO(csv_data), 'relatives.csv')
+        }, content_type='multipart/form-data', follow_redirects = True)
+        assert response.status_code == 200
+        assert b'0 relations accepted, 2 rows rejected' in response.data
+        assert b'Relative 9999 does not exist' in response.data
+        assert Relatives.query.count() == count
+
+        response = client.post('/admin/import_relatives', data={
+            'relatives_file': (io.BytesIO(b'{}'), 'relatives.json')
+        }, content_type='multipart/form-data', follow_redirects = True)
+        assert b'JSON import must be a list of relations' in response.data
+
+    def test_export_users(self, client, app):
+        seed_database(app)
+        client.post('/login', data={
+            'email':'alice@example.com',
+            'password':'password123'
+        }, follow_redirects = True)
+
+        response = client.get('/admin/export_users.csv')
+        assert response.status_code == 200
+        lines = response.get_data(as_text=True).splitlines()
+        assert lines[0] == 'id,username,email,first_name,middle_name,last_name,gender,country_code,mobile_no,contact_email'
+        assert lines[1] == '2,bob,bob@example.com,Bob,,Brown,MALE,1,2025550181,bob.contact@example.com'
+        assert len(lines) == 23
+
+        users = client.get('/admin/export_users.json').get_json()
+        assert [user['id'] for user in users] == list(range(2, 24))
+        assert users[1]['contacts'] == [
+            {'country_code': 44, 'mobile_no': '7700900900', 'contact_email': 'charlie.contact@example.com'}]
+        assert users[2]['contacts'] == []
+
+    def test_export_gedcom(self, client, app):
+        seed_database(app)
+        client.post('/login', data={
+            'email':'alice@example.com',
+            'password':'password123'
+        }, follow_redirects = True)
+
+        response = client.get('/admin/export_gedcom')
+        assert response.status_code == 200
+        assert 'family_tree.ged' in response.headers['Content-Disposition']
+        data = response.get_data(as_text=True)
+        assert data.startswith('0 HEAD\n')
+        assert '1 NAME Charlie Lee /Campbell/\n2 GIVN Charlie Lee\n2 SURN Campbell\n1 SEX U\n' in data
+        assert '0 @F1@ FAM\n' in data
+        assert data.endswith('0 TRLR\n')
+
+
+
+class TestTreeRoutes:
+    def create_family(self):
+        # 1 -> 2 -> 3 -> 4 (parent -> child), 2 <-> 5 spouses
+        users = [User(id=1, username='user1', email='user1@example.com',
+                      password_hash=bcrypt.generate_password_hash('password123').decode('utf-8'))]
+        users += [User(id=i, username=f'user{i}', email=f'user{i}@example.com',
+                       password_hash='password') for i in range(2, 6)]
+        db.session.add_all(users)
+        for i in range(1, 6):
+            db.session.add(Person(user_id=i, first_name=f'First{i}', last_name='Family',
+                                  gender=GenderEnum.FEMALE))
+        for parent_id, child_id in [(1, 2), (2, 3), (3, 4)]:
+            db.session.add(Relatives(user_id=child_id, relative_user_id=parent_id,
+                                     relation_type=RelativesTypeEnum.PARENT))
+            db.session.add(Relatives(user_id=parent_id, relative_user_id=child_id,
+                                     relation_type=RelativesTypeEnum.CHILD))
+        db.session.add(Relatives(user_id=2, relative_user_id=5, relation_type=RelativesTypeEnum.SPOUSE))
+        db.session.add(Relatives(user_id=5, relative_user_id=2, relation_type=RelativesTypeEnum.SPOUSE))
+        db.session.commit()
+        rebuild_families(db)
+
+    def login(self, client):
+        client.post('/login', data={
+            'email': 'user1@example.com',
+            'password': 'password123'
+        }, follow_redirects=True)
+
+    def test_tree_json(self, client):
+        self.create_family()
+        self.login(client)
+
+        response = client.get('/tree/1.json?hops=2')
+        assert response.status_code == 200
+        data = response.get_json()
+        nodes = {e['data']['id']: e['data'] for e in data['elements'] if e['group'] == 'nodes'}
+        edges = {e['data']['id'] for e in data['elements'] if e['group'] == 'edges'}
+        assert set(nodes) == {1, 2, 3, 5}
+        assert nodes[3]['depth'] == 2
+        assert nodes[1]['picture_url'].endswith('default.jpg')
+        assert edges == {'1-2', '2-3', '2-5'}
+
+    def test_tree_ndjson_and_etag(self, client):
+        import json
+
+        self.create_family()
+        self.login(client)
+
+        response = client.get('/tree/2.ndjson?hops=1')
+        assert response.mimetype == 'application/x-ndjson'
+        elements = [json.loads(line) for line in response.data.decode().splitlines()]
+        seen = set()
+        for element in elements:
+            # Nodes always arrive before the edges that reference them
+            if element['group'] == 'nodes':
+                seen.add(element['data']['id'])
+            else:
+                assert {element['data']['source'], element['data']['target']} <= seen
+        assert seen == {1, 2, 3, 5}
+
+        etag = response.headers['ETag']
+        response = client.get('/tree/2.ndjson?hops=1', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+        # Any change to the graph produces a new version
+        db.session.add(Relatives(user_id=4, relative_user_id=5, relation_type=RelativesTypeEnum.SIBLING))
+        db.session.commit()
+        response = client.get('/tree/2.ndjson?hops=1', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+    def test_compressed_responses(self, client):
+        import gzip
+        import json
+
+        self.create_family()
+        self.login(client)
+
+        response = client.get('/tree/2.ndjson?hops=1', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert response.headers['ETag'].startswith('W/')
+        lines = gzip.decompress(response.data).decode().splitlines()
+        assert {json.loads(line)['data']['id'] for line in lines} >= {1, 2, 3, 5}
+
+        # The weak ETag still matches for a conditional request
+        response = client.get('/tree/2.ndjson?hops=1', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
+        response = client.get('/dashboard', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert b'</html>' in gzip.decompress(response.data)
+
+        response = client.get('/dashboard')
+        assert 'Content-Encoding' not in response.headers
+
+    def test_precompressed_static(self, app, client, tmp_path):
+        import gzip
+        from family_tree.compression import compress_static
+
+        (tmp_path / 'css').mkdir()
+        (tmp_path / 'css' / 'site.css').write_text('body { margin: 0; }\n' * 50)
+        (tmp_path / 'css' / 'tiny.css').write_text('p {}')
+        assert compress_static(str(tmp_path)) == 1
+        assert compress_static(str(tmp_path)) == 0
+
+        app.static_folder = str(tmp_path)
+        response = client.get('/static/css/site.css', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.mimetype == 'text/css'
+        assert gzip.decompress(response.data).startswith(b'body { margin: 0; }')
+        response.close()
+
+        response = client.get('/static/css/site.css')
+        assert 'Content-Encoding' not in response.headers
+        response.close()
+
+    def test_relation_path(self, client):
+        self.create_family()
+        self.login(client)
+        response = client.get('/tree/path/4/5.json')
+        assert response.status_code == 200
+        path = response.get_json()['path']
+        assert [step['user_id'] for step in path] == [4, 3, 2, 5]
+        assert [step['relation'] for step in path] == [None, 'PARENT', 'PARENT', 'SPOUSE']
+        assert path[-1]['name'] == 'First5 Family'
+        assert client.get('/tree/path/4/999.json').status_code == 404
+
+    def test_tree_unknown_user(self, client):
+        self.create_family()
+        self.login(client)
+        response = client.get('/tree/999.json')
+        assert response.status_code == 404
+
+    def test_tree_of_other_family(self, client):
+        self.create_family()
+        db.session.add(User(id=6, username='user6', email='user6@example.com',
+                            password_hash='password'))
+        db.session.commit()
+        self.login(client)
+        assert client.get('/tree/6.json').status_code == 403
+        assert client.get('/tree/path/1/6.json').status_code == 403
+
+    def test_tree_hides_deleted_user(self, app, client):
+        from datetime import date
+        from family_tree.services.purge import soft_delete_user
+
+        self.create_family()
+        today = date.today()
+        db.session.add(ImportantDates(user_id=2, date_type=ImportantDateTypeEnum.BIRTH,
+                                      date=today.replace(year=1960)))
+        db.session.commit()
+        self.login(client)
+        assert b'First2 Family' in client.get('/dashboard').data
+
+        # Left for the purge job, but hidden straight away
+        app.config['JOBS_EAGER'] = False
+        soft_delete_user(db, 2)
+        data = client.get('/tree/1.json?hops=3').get_json()
+        assert [e['data']['id'] for e in data['elements']] == [1]
+        assert client.get('/tree/2.json').status_code == 404
+        assert client.get('/tree/path/1/2.json').status_code == 404
+        # 4 is still in the family, but only reachable through 2
+        response = client.get('/tree/path/1/4.json')
+        assert response.status_code == 200 and response.get_json()['path'] is None
+        assert b'First2 Family' not in client.get('/dashboard').data
+
+    def test_tree_edge_without_reciprocal(self, client):
+        self.create_family()
+        Relatives.query.filter_by(user_id=2, relative_user_id=5).delete()
+        db.session.commit()
+        self.login(client)
+
+        data = client.get('/tree/5.json?hops=1').get_json()
+        edges = [e['data'] for e in data['elements'] if e['group'] == 'edges']
+        assert [(e['id'], e['source'], e['target']) for e in edges] == [('2-5', 5, 2)]
+
+    def test_display_tree(self, client):
+        self.create_family()
+        User.query.filter_by(id=2).first().password_hash = \
+            bcrypt.generate_password_hash('password123').decode('utf-8')
+        db.session.commit()
+        client.post('/login', data={
+            'email': 'user2@example.com',
+            'password': 'password123'
+        }, follow_redirects=True)
+
+        response = client.get('/display_tree')
+        assert response.status_code == 200
+        assert b'<svg' in response.data
+        assert b'First4 Family' in response.data
+
+        response = client.get('/display_relatives')
+        assert b'Generation -1' in response.data
+        assert b'Same generation' in response.data
+
+    def test_display_extended_family(self, client):
+        from family_tree.services.ancestry import rebuild_ancestry
+        from family_tree.services.derived import rebuild_derived_relatives
+
+        self.create_family()
+        rebuild_ancestry(db)
+        rebuild_derived_relatives(db)
+        self.login(client)
+
+        response = client.get('/display_relatives')
+        assert b'Extended Family' in response.data
+        assert b'First3 Family' in response.data and b'Grandchild' in response.data
+
+
+class TestJobRoutes:
+    def login(self, client, email):
+        client.post('/login', data={
+            'email': email,
+            'password': 'password123'
+        }, follow_redirects=True)
+
+    def test_job_status(self, client, app):
+        from family_tree.models import Job
+
+        seed_database(app)
+        self.login(client, 'alice@example.com')
+        response = client.post('/admin/rebuild_graph', follow_redirects=True)
+        assert b'Rebuild of the family tree queued as job' in response.data
+
+        job = Job.query.filter_by(name='rebuild_graph').first()
+        response = client.get(f'/jobs/{job.id}')
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data['status'] == 'succeeded'
+        assert data['progress'] == 1.0
+        assert data['result']['families'] >= 1
+
+        # Other users cannot see an admin's jobs
+        client.get('/logout')
+        self.login(client, 'bob@example.com')
+        assert client.get(f'/jobs/{job.id}').status_code == 404
+        assert client.get('/jobs/999').status_code == 404
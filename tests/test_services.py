@@ -1,3 +1,5 @@
+import pytest
+
 from family_tree import db, bcrypt
 
 from family_tree.models import (
@@ -326,3 +328,915 @@ class TestUserService:
         picture_filename = Picture.query.filter_by(user_id=2).first()
         assert picture_filename is None
 
+
+
+class TestAncestryService:
+    def create_family(self, count):
+        for i in range(1, count + 1):
+            db.session.add(User(id=i, username=f'user{i}', email=f'user{i}@example.com',
+                                password_hash='password'))
+            db.session.add(Person(user_id=i, first_name=f'First{i}', last_name='Family',
+                                  gender=GenderEnum.MALE if i % 2 else GenderEnum.FEMALE))
+        db.session.commit()
+
+    def add_parent(self, parent_id, child_id):
+        from werkzeug.datastructures import MultiDict
+
+        child = User.query.filter_by(id=child_id).first()
+        form = UpsertRelativeForm(formdata=MultiDict({
+            'relative_user_id': parent_id,
+            'relation_type': 'PARENT'
+        }))
+        add_relative_to_database(db, Relatives, RelativesTypeEnum, child, form)
+
+    def test_incremental_add_and_delete(self, db):
+        from family_tree.services.ancestry import (
+            get_ancestors,
+            get_descendants,
+            count_generations
+        )
+        self.create_family(4)
+        # 1 -> 2 -> 3 -> 4 (parent -> child)
+        self.add_parent(1, 2)
+        self.add_parent(3, 4)
+        self.add_parent(2, 3)
+
+        assert get_ancestors(db, 4) == [(3, 1), (2, 2), (1, 3)]
+        assert get_descendants(db, 1) == [(2, 1), (3, 2), (4, 3)]
+        assert count_generations(db, 2) == 4
+
+        user2 = User.query.filter_by(id=2).first()
+        assert delete_relative_from_database(db, User, Relatives, user2, 3) == True
+        assert get_ancestors(db, 4) == [(3, 1)]
+        assert get_descendants(db, 1) == [(2, 1)]
+
+    def test_common_ancestors_and_rebuild(self, db):
+        from family_tree.models import Ancestry
+        from family_tree.services.ancestry import (
+            get_common_ancestors,
+            rebuild_ancestry
+        )
+        self.create_family(5)
+        # 1 is the grandparent of 4 and 5 through 2 and 3
+        self.add_parent(1, 2)
+        self.add_parent(1, 3)
+        self.add_parent(2, 4)
+        self.add_parent(3, 5)
+
+        assert get_common_ancestors(db, 4, 5) == [(1, 2, 2)]
+
+        incremental = sorted((a.ancestor_id, a.descendant_id, a.distance)
+                             for a in Ancestry.query.all())
+        assert rebuild_ancestry(db) == len(incremental)
+        rebuilt = sorted((a.ancestor_id, a.descendant_id, a.distance)
+                         for a in Ancestry.query.all())
+        assert rebuilt == incremental
+
+    def test_check_validity_relation_prevents_cycles(self, db):
+        self.create_family(3)
+        self.add_parent(1, 2)
+        self.add_parent(2, 3)
+
+        user1 = User.query.filter_by(id=1).first()
+        assert check_validity_relation(db, User, Relatives, user1, 3, 'PARENT') == False
+        user3 = User.query.filter_by(id=3).first()
+        assert check_validity_relation(db, User, Relatives, user3, 1, 'CHILD') == False
+
+
+class TestLayoutService:
+    def test_compute_layout(self):
+        from family_tree.services.layout import compute_layout
+
+        # 1 + 2 are spouses with children 3 and 4, 5 is married to 3 and
+        # 6 is the child of 3 and 5
+        layout = compute_layout(
+            [1, 2, 3, 4, 5, 6],
+            {(1, 3), (2, 3), (1, 4), (2, 4), (3, 6), (5, 6)},
+            {(1, 2), (3, 5)})
+        generations = {user_id: node['generation'] for user_id, node in layout['nodes'].items()}
+        assert generations == {1: 0, 2: 0, 3: 1, 4: 1, 5: 1, 6: 2}
+        assert layout['generations'] == 3
+        assert layout['width'] == 3
+        # Spouses sit next to each other
+        nodes = layout['nodes']
+        assert abs(nodes[3]['x'] - nodes[5]['x']) == 1
+
+    def test_layout_cache_invalidation(self, db):
+        from family_tree.models import TreeLayout
+        from family_tree.services.layout import get_component_layout
+
+        family = TestAncestryService()
+        family.create_family(3)
+        family.add_parent(1, 2)
+
+        layout = get_component_layout(db, 2)
+        assert layout['nodes'][1]['generation'] == 0
+        assert layout['nodes'][2]['generation'] == 1
+        cached = db.session.get(TreeLayout, layout['component_id'])
+        assert cached.version == layout['version']
+
+        # A second read is served from the cache
+        cached.layout = cached.layout.replace('"generations": 2', '"generations": 99')
+        db.session.commit()
+        assert get_component_layout(db, 1)['generations'] == 99
+
+        # A relation change in the family invalidates the cached layout
+        family.add_parent(2, 3)
+        layout = get_component_layout(db, 1)
+        assert layout['generations'] == 3
+        assert layout['nodes'][3]['generation'] == 2
+
+    def test_concurrent_layout_miss(self, db, monkeypatch):
+        from sqlalchemy import insert
+        from family_tree.models import TreeLayout
+        from family_tree.services import layout as layout_service
+
+        family = TestAncestryService()
+        family.create_family(2)
+        family.add_parent(1, 2)
+        family_id = db.session.get(User, 1).family_id
+        build_layout = layout_service._build_layout
+
+        def build_while_another_request_stores(db, member_ids):
+            # Another worker missed too and stored its layout first
+            db.session.execute(insert(TreeLayout).values(
+                component_id=family_id, version=0, layout='{}'))
+            return build_layout(db, member_ids)
+
+        monkeypatch.setattr(layout_service, '_build_layout', build_while_another_request_stores)
+        layout = layout_service.get_component_layout(db, 2)
+        assert db.session.get(TreeLayout, family_id).version == layout['version']
+
+
+class TestFamilyService:
+    def test_union_and_split(self, db):
+        from family_tree.models import Family
+        from family_tree.services.family import get_family_id
+
+        family = TestAncestryService()
+        family.create_family(5)
+        family.add_parent(1, 2)
+        family.add_parent(3, 4)
+        first, second = get_family_id(db, 1), get_family_id(db, 3)
+        assert first is not None and second is not None and first != second
+        assert get_family_id(db, 5) is None
+
+        # Joining the two families relabels one of them
+        family.add_parent(2, 3)
+        merged = get_family_id(db, 1)
+        assert {get_family_id(db, i) for i in range(1, 5)} == {merged}
+        assert db.session.get(Family, merged).size == 4
+        assert Family.query.count() == 1
+
+        # Removing the bridge splits them again
+        user2 = User.query.filter_by(id=2).first()
+        delete_relative_from_database(db, User, Relatives, user2, 3)
+        assert get_family_id(db, 1) == get_family_id(db, 2)
+        assert get_family_id(db, 3) == get_family_id(db, 4)
+        assert get_family_id(db, 1) != get_family_id(db, 3)
+        assert sorted(f.size for f in Family.query.all()) == [2, 2]
+
+        # Removing the last relation leaves both users without a family
+        user4 = User.query.filter_by(id=4).first()
+        delete_relative_from_database(db, User, Relatives, user4, 3)
+        assert get_family_id(db, 3) is None and get_family_id(db, 4) is None
+        assert Family.query.count() == 1
+
+    def test_rebuild_families(self, db):
+        from family_tree.services.family import get_family_id, rebuild_families
+
+        TestAncestryService().create_family(5)
+        for user_id, relative_user_id in [(1, 2), (2, 1), (3, 4), (4, 3)]:
+            db.session.add(Relatives(user_id=user_id, relative_user_id=relative_user_id,
+                                     relation_type=RelativesTypeEnum.SIBLING))
+        db.session.commit()
+
+        assert rebuild_families(db) == 2
+        assert get_family_id(db, 1) == get_family_id(db, 2)
+        assert get_family_id(db, 3) == get_family_id(db, 4)
+        assert get_family_id(db, 1) != get_family_id(db, 3)
+        assert get_family_id(db, 5) is None
+
+
+class TestDerivedRelativesService:
+    def add_spouse(self, user_id, spouse_id):
+        from werkzeug.datastructures import MultiDict
+
+        user = User.query.filter_by(id=user_id).first()
+        form = UpsertRelativeForm(formdata=MultiDict({
+            'relative_user_id': spouse_id,
+            'relation_type': 'SPOUSE'
+        }))
+        add_relative_to_database(db, Relatives, RelativesTypeEnum, user, form)
+
+    def create_family(self):
+        family = TestAncestryService()
+        family.create_family(9)
+        # 1 and 2 have children 3 and 4; 3 has 6 with spouse 5 and 8 with 9;
+        # 4 has 7
+        self.add_spouse(1, 2)
+        for parent_id, child_id in [(1, 3), (2, 3), (1, 4), (2, 4), (3, 6), (5, 6),
+                                    (3, 8), (9, 8), (4, 7)]:
+            family.add_parent(parent_id, child_id)
+        self.add_spouse(3, 5)
+        return family
+
+    def relations(self, user_id):
+        from family_tree.services.derived import get_derived_relatives
+
+        return {rel['relative_user_id']: rel['relationship']
+                for rel in get_derived_relatives(db, user_id)}
+
+    def test_derived_relations(self, db):
+        self.create_family()
+
+        assert self.relations(6) == {1: 'GRANDPARENT', 2: 'GRANDPARENT', 8: 'HALFSIBLING',
+                                     4: 'AUNT_UNCLE', 7: 'COUSIN'}
+        assert self.relations(1) == {6: 'GRANDCHILD', 7: 'GRANDCHILD', 8: 'GRANDCHILD',
+                                     5: 'CHILD_IN_LAW'}
+        assert self.relations(4) == {3: 'SIBLING', 6: 'NIECE_NEPHEW', 8: 'NIECE_NEPHEW',
+                                     5: 'SIBLING_IN_LAW'}
+        assert self.relations(5) == {1: 'PARENT_IN_LAW', 2: 'PARENT_IN_LAW',
+                                     4: 'SIBLING_IN_LAW'}
+
+    def test_incremental_matches_rebuild(self, db):
+        from family_tree.models import DerivedRelative
+        from family_tree.services.derived import rebuild_derived_relatives
+
+        self.create_family()
+        user4 = User.query.filter_by(id=4).first()
+        delete_relative_from_database(db, User, Relatives, user4, 1)
+        delete_relative_from_database(db, User, Relatives, user4, 2)
+        assert 7 not in self.relations(6)
+        assert 3 not in self.relations(4)
+
+        incremental = sorted((row.user_id, row.relative_user_id, row.relation)
+                             for row in DerivedRelative.query.all())
+        assert rebuild_derived_relatives(db) == len(incremental)
+        rebuilt = sorted((row.user_id, row.relative_user_id, row.relation)
+                         for row in DerivedRelative.query.all())
+        assert rebuilt == incremental
+
+
+class TestAnalyticsService:
+    def test_graph_stats(self, db, monkeypatch):
+        from family_tree.services import analytics
+
+        family = TestAncestryService()
+        family.create_family(7)
+        # 1 -> 2 -> 3 and 1 -> 4 in one family, 5 -> 6 in another, 7 alone
+        for parent_id, child_id in [(1, 2), (2, 3), (1, 4), (5, 6)]:
+            family.add_parent(parent_id, child_id)
+
+        graph = analytics.load_graph(db)
+        assert list(graph.indptr) == [0, 2, 4, 5, 6, 7, 8, 8]
+        stats = analytics.compute_graph_stats(graph)
+        assert stats['users'] == 7 and stats['relations'] == 4
+        assert stats['families'] == 2 and stats['max_generations'] == 3
+        assert [(family['size'], family['generations'])
+                for family in stats['largest_families']] == [(4, 3), (2, 2)]
+        assert stats['generation_histogram'] == [(1, 2), (2, 3), (3, 1)]
+        assert stats['degree_histogram'] == [(0, 1), (1, 4), (2, 2)]
+        assert stats['orphans'] == 1 and stats['orphan_ids'] == [7]
+
+        # The fallback without numpy gives the same answers
+        monkeypatch.setattr(analytics, 'np', None)
+        fallback = analytics.compute_graph_stats(graph)
+        assert fallback.pop('backend') == 'array'
+        stats.pop('backend')
+        assert fallback == stats
+
+        # Cached until the tree changes
+        assert analytics.get_graph_stats(db)['relations'] == 4
+        family.add_parent(6, 7)
+        assert analytics.get_graph_stats(db)['relations'] == 5
+
+
+class TestGraphIndex:
+    def test_patch_matches_rebuild(self, app, db, tmp_path):
+        from family_tree.graph_index import build_graph_index, get_graph_index
+        from family_tree.services.tree import find_relation_path, get_component_ids
+
+        path = str(tmp_path / 'graph.idx')
+        app.config['GRAPH_INDEX_PATH'] = path
+        family = TestAncestryService()
+        family.create_family(6)
+        # Each write patches the index: 1 -> 2 -> 3, 4 -> 5
+        for parent_id, child_id in [(2, 3), (1, 2), (4, 5)]:
+            family.add_parent(parent_id, child_id)
+
+        index = get_graph_index()
+        assert index.relatives(2) == [(1, RelativesTypeEnum.PARENT), (3, RelativesTypeEnum.CHILD)]
+        assert index.edge_count == 6 and 6 not in index
+        assert get_component_ids(db, 3) == {1, 2, 3}
+        assert [step['user_id'] for step in find_relation_path(db, 1, 3, 4)] == [1, 2, 3]
+        assert find_relation_path(db, 1, 5, 4) is None
+
+        user2 = User.query.filter_by(id=2).first()
+        delete_relative_from_database(db, User, Relatives, user2, 3)
+        family.add_parent(5, 6)
+        index = get_graph_index()
+        assert index.relatives(3) == [] and index.neighbour_ids(5) == [4, 6]
+        with open(path, 'rb') as index_file:
+            patched = index_file.read()
+        assert build_graph_index(db, path) == 6
+        with open(path, 'rb') as index_file:
+            assert index_file.read() == patched
+
+        # Without the index the same answers come from the database
+        app.config['GRAPH_INDEX_PATH'] = None
+        assert get_graph_index() is None
+        assert get_component_ids(db, 6) == {4, 5, 6}
+        assert [step['relation'] for step in find_relation_path(db, 4, 6, 4)] == \
+            [None, 'CHILD', 'CHILD']
+
+    def test_soft_delete_drops_user(self, app, db, tmp_path):
+        from family_tree.graph_index import build_graph_index, get_graph_index
+        from family_tree.services.purge import soft_delete_user
+        from family_tree.services.tree import find_relation_path
+
+        path = str(tmp_path / 'graph.idx')
+        app.config['GRAPH_INDEX_PATH'] = path
+        family = TestAncestryService()
+        family.create_family(3)
+        for parent_id, child_id in [(1, 2), (2, 3)]:
+            family.add_parent(parent_id, child_id)
+
+        # Gone from the index before the purge job runs
+        app.config['JOBS_EAGER'] = False
+        soft_delete_user(db, 2)
+        index = get_graph_index()
+        assert 2 not in index and index.relatives(1) == [] and index.edge_count == 0
+        assert find_relation_path(db, 1, 3, 4) is None
+        with open(path, 'rb') as index_file:
+            patched = index_file.read()
+        assert build_graph_index(db, path) == 0
+        with open(path, 'rb') as index_file:
+            assert index_file.read() == patched
+
+
+class TestDuplicateService:
+    def create_people(self):
+        from datetime import date
+        from family_tree.models import ImportantDates, ImportantDateTypeEnum
+
+        people = [(1, 'John', 'Smith', GenderEnum.MALE, date(1950, 3, 1)),
+                  (2, 'Jon', 'Smyth', GenderEnum.MALE, date(1950, 3, 1)),
+                  (3, 'Mary', 'Smith', GenderEnum.FEMALE, None),
+                  (4, 'Ann', 'Jones', GenderEnum.FEMALE, None),
+                  (5, 'John', 'Smith', GenderEnum.MALE, date(1980, 5, 2))]
+        for user_id, first_name, last_name, gender, birth in people:
+            db.session.add(User(id=user_id, username=f'user{user_id}',
+                                email=f'user{user_id}@example.com', password_hash='password'))
+            db.session.add(Person(user_id=user_id, first_name=first_name,
+                                  last_name=last_name, gender=gender))
+            if birth:
+                db.session.add(ImportantDates(user_id=user_id, date=birth,
+                                              date_type=ImportantDateTypeEnum.BIRTH))
+        db.session.commit()
+        # 2 is 3's parent and 4's spouse, 1 is 5's parent
+        TestAncestryService().add_parent(2, 3)
+        TestDerivedRelativesService().add_spouse(2, 4)
+        TestAncestryService().add_parent(1, 5)
+
+    def test_name_key(self):
+        from family_tree.utils import name_key, soundex
+
+        assert soundex('Robert') == soundex('Rupert') == 'R163'
+        assert soundex('Ashcraft') == 'A261'
+        assert name_key('Jon', 'Smyth') == name_key('John', 'Smith') == 'S530J500'
+        assert name_key(None, '') is None
+        assert Person(first_name='Jon', last_name='Smyth').name_key == 'S530J500'
+
+    def test_find_and_merge_duplicates(self, db):
+        import json
+        from datetime import date
+        from family_tree.jobs import enqueue
+        from family_tree.models import (
+            Ancestry,
+            ContactDetails,
+            DerivedRelative,
+            DuplicateCandidate,
+            ImportantDates,
+            ImportantDateTypeEnum
+        )
+        from family_tree.services.derived import rebuild_derived_relatives
+        from family_tree.services.duplicates import dismiss_duplicate, get_duplicate_candidates
+        from family_tree.services.merge import merge_users
+
+        self.create_people()
+        # 1 and 5 are related, 2 and 5 were born decades apart
+        duplicates_job = enqueue(db, 'find_duplicates')
+        assert json.loads(duplicates_job.result)['candidates'] == 1
+        candidates = get_duplicate_candidates(db)
+        assert [(c['user_id'], c['other_user_id']) for c in candidates] == [(1, 2)]
+        assert candidates[0]['other_name'] == 'Jon Smyth'
+
+        dismiss_duplicate(db, 2, 1)
+        enqueue(db, 'find_duplicates')
+        assert get_duplicate_candidates(db) == []
+        DuplicateCandidate.query.delete()
+        db.session.commit()
+        enqueue(db, 'find_duplicates')
+
+        with pytest.raises(ValueError):
+            merge_users(db, 1, 5)
+        db.session.add_all([
+            ContactDetails(user_id=2, country_code=44, mobile_no='7700900123'),
+            ImportantDates(user_id=2, date_type=ImportantDateTypeEnum.MARRIAGE,
+                           date=date(1975, 6, 1)),
+            Picture(user_id=2, picture_filename='jon.jpg')
+        ])
+        db.session.commit()
+        moved = merge_users(db, 1, 2)
+        # The birth dates are equal, so only the marriage is moved
+        assert moved == {'relatives': 2, 'address': 0, 'important_dates': 1,
+                         'contact_details': 1}
+
+        assert db.session.get(User, 2) is None
+        survivor = db.session.get(User, 1)
+        assert sorted(d.date_type.value for d in survivor.important_dates) == ['BIRTH', 'MARRIAGE']
+        assert survivor.contact_details[0].mobile_no == '7700900123'
+        assert survivor.profile_picture.picture_filename == 'jon.jpg'
+        assert DuplicateCandidate.query.count() == 0
+        assert {(r.user_id, r.relative_user_id, r.relation_type) for r in Relatives.query.filter_by(user_id=1)} == {
+            (1, 3, RelativesTypeEnum.CHILD), (1, 4, RelativesTypeEnum.SPOUSE),
+            (1, 5, RelativesTypeEnum.CHILD)}
+        assert Relatives.query.filter_by(relative_user_id=2).count() == 0
+        assert Ancestry.query.filter_by(ancestor_id=1, descendant_id=3).first().distance == 1
+        assert db.session.get(User, 3).family_id == db.session.get(User, 5).family_id
+
+        merged = sorted((row.user_id, row.relative_user_id, row.relation)
+                        for row in DerivedRelative.query.all())
+        rebuild_derived_relatives(db)
+        assert sorted((row.user_id, row.relative_user_id, row.relation)
+                      for row in DerivedRelative.query.all()) == merged
+
+
+    def test_merge_people_with_parents(self, db):
+        from family_tree.models import Ancestry
+        from family_tree.services.merge import merge_users
+
+        family = TestAncestryService()
+        # Odd users are men, even users women
+        family.create_family(9)
+        for parent_id, child_id in [(1, 5), (2, 5), (1, 6), (4, 6), (3, 7), (3, 8), (4, 8), (1, 9)]:
+            family.add_parent(parent_id, child_id)
+        relations = Relatives.query.count()
+
+        with pytest.raises(ValueError, match='more than two parents'):
+            merge_users(db, 5, 6)
+        with pytest.raises(ValueError, match='two parents of the same gender'):
+            merge_users(db, 7, 9)
+        assert Relatives.query.count() == relations
+        assert db.session.get(User, 6) is not None and db.session.get(User, 9) is not None
+
+        # The shared parent is kept once
+        assert merge_users(db, 7, 8)['relatives'] == 1
+        assert {(r.relative_user_id, r.relation_type) for r in Relatives.query.filter_by(user_id=7)} == {
+            (3, RelativesTypeEnum.PARENT), (4, RelativesTypeEnum.PARENT)}
+        assert Relatives.query.filter_by(user_id=3, relative_user_id=7).count() == 1
+        assert Relatives.query.count() == relations - 2
+        assert {row.ancestor_id for row in Ancestry.query.filter_by(descendant_id=7)} == {3, 4}
+
+    def test_merge_checks_the_relatives_side(self, db):
+        from family_tree.services.merge import merge_users
+
+        family = TestAncestryService()
+        # Odd users are men, even users women
+        family.create_family(6)
+        for parent_id, child_id in [(3, 5), (2, 5)]:
+            family.add_parent(parent_id, child_id)
+        family_rows = Relatives.query.count()
+
+        # 4 has no relations of her own, but would be 5's second mother
+        with pytest.raises(ValueError, match='User 5 would have two parents of the same gender'):
+            merge_users(db, 4, 3)
+        assert Relatives.query.count() == family_rows
+        assert db.session.get(User, 3) is not None
+
+        assert merge_users(db, 1, 3)['relatives'] == 1
+        assert {row.relative_user_id for row in Relatives.query.filter_by(
+            user_id=5, relation_type=RelativesTypeEnum.PARENT)} == {1, 2}
+
+    def test_merge_keeps_one_of_each_unique_detail(self, db):
+        from datetime import date
+        from family_tree.models import Address, ImportantDates, ImportantDateTypeEnum
+        from family_tree.services.merge import merge_users
+
+        TestAncestryService().create_family(2)
+
+        def address(user_id, is_permanent, first_line):
+            return Address(user_id=user_id, is_permanent=is_permanent, first_line=first_line,
+                           pin_code=12345, state='Kent', country='UK')
+
+        db.session.add_all([
+            address(1, True, '1 High Street'),
+            address(2, True, '2 Low Road'),
+            address(2, False, '3 Mill Lane'),
+            ImportantDates(user_id=1, date_type=ImportantDateTypeEnum.BIRTH, date=date(1950, 3, 1)),
+            ImportantDates(user_id=2, date_type=ImportantDateTypeEnum.BIRTH, date=date(1951, 3, 1)),
+            ImportantDates(user_id=1, date_type=ImportantDateTypeEnum.MARRIAGE, date=date(1975, 6, 1)),
+            ImportantDates(user_id=2, date_type=ImportantDateTypeEnum.MARRIAGE, date=date(1990, 6, 1))
+        ])
+        db.session.commit()
+
+        moved = merge_users(db, 1, 2)
+        # The survivor's permanent address and birth date win
+        assert moved['address'] == 1 and moved['important_dates'] == 1
+        survivor = db.session.get(User, 1)
+        assert sorted((a.is_permanent, a.first_line) for a in survivor.addresses) == [
+            (False, '3 Mill Lane'), (True, '1 High Street')]
+        assert sorted((d.date_type.value, d.date) for d in survivor.important_dates) == [
+            ('BIRTH', date(1950, 3, 1)), ('MARRIAGE', date(1975, 6, 1)),
+            ('MARRIAGE', date(1990, 6, 1))]
+        assert Address.query.count() == 2 and ImportantDates.query.count() == 3
+
+class TestPurgeService:
+    def test_soft_delete_and_purge(self, app, db):
+        import json
+        import os
+        from family_tree.jobs import claim_job, run_job
+        from family_tree.models import Ancestry, DerivedRelative, JobStatusEnum
+        from family_tree.services.derived import rebuild_derived_relatives
+        from family_tree.services.purge import soft_delete_user
+        from family_tree.services.snapshot import get_user_snapshot
+        from family_tree.services.user import get_person_choices
+
+        family = TestAncestryService()
+        family.create_family(4)
+        family.add_parent(1, 2)
+        family.add_parent(2, 3)
+        family.add_parent(1, 4)
+        picture_path = os.path.join(app.root_path, 'static/profile_pictures', 'purge_test.jpg')
+        with open(picture_path, 'wb') as picture_file:
+            picture_file.write(b'picture')
+        db.session.add(Picture(user_id=2, picture_filename='purge_test.jpg'))
+        db.session.commit()
+
+        # Hidden at once, purged by the job
+        app.config['JOBS_EAGER'] = False
+        purge_job = soft_delete_user(db, 2)
+        assert purge_job.status == JobStatusEnum.QUEUED
+        assert soft_delete_user(db, 2) is None
+        assert 2 not in [rel['relative_user_id'] for rel in get_user_snapshot(db, 1)['relatives']]
+        assert 2 not in [user_id for user_id, _ in get_person_choices(db, User)]
+        assert db.session.get(Person, 2) is not None
+
+        run_job(db, claim_job(db, 'test'))
+        assert json.loads(purge_job.result) == {
+            'purged': True, 'relatives': 4, 'address': 0, 'important_dates': 0,
+            'contact_details': 0, 'picture': 1, 'person': 1}
+        assert db.session.get(User, 2) is None
+        assert Relatives.query.filter(Relatives.relative_user_id == 2).count() == 0
+        assert not os.path.exists(picture_path)
+        assert {(row.ancestor_id, row.descendant_id) for row in Ancestry.query.all()} == {(1, 4)}
+        assert db.session.get(User, 3).family_id is None
+
+        purged = sorted((row.user_id, row.relative_user_id) for row in DerivedRelative.query.all())
+        rebuild_derived_relatives(db)
+        assert sorted((row.user_id, row.relative_user_id)
+                      for row in DerivedRelative.query.all()) == purged
+
+
+class TestImportService:
+    def test_import_relatives(self, db):
+        from family_tree.models import Family
+        from family_tree.services.ancestry import get_ancestors
+        from family_tree.services.imports import import_relatives
+
+        TestAncestryService().create_family(6)
+        rows = [
+            {'user_id': 2, 'relative_user_id': 1, 'relation_type': 'PARENT'},
+            {'user_id': 3, 'relative_user_id': 2, 'relation_type': 'parent'},
+            {'user_id': 2, 'relative_user_id': 1, 'relation_type': 'PARENT'},
+            {'user_id': 1, 'relative_user_id': 3, 'relation_type': 'PARENT'},
+            {'user_id': 4, 'relative_user_id': 99, 'relation_type': 'SPOUSE'},
+            {'user_id': 4, 'relative_user_id': 'x', 'relation_type': 'SPOUSE'},
+            {'user_id': 4, 'relative_user_id': 5, 'relation_type': 'COUSIN'},
+            {'user_id': 4, 'relative_user_id': 5, 'relation_type': 'SPOUSE'},
+            {'user_id': 6, 'relative_user_id': 4, 'relation_type': 'SPOUSE'},
+            # 3 is male, 5 is male: second father for 2
+            {'user_id': 2, 'relative_user_id': 5, 'relation_type': 'PARENT'},
+        ]
+        result = import_relatives(db, rows)
+
+        assert result['imported'] == 3
+        assert [error['row'] for error in result['errors']] == [3, 4, 5, 6, 7, 9, 10]
+        assert 'already exists' in result['errors'][0]['error']
+        assert 'own ancestor' in result['errors'][1]['error']
+        assert 'spouse' in result['errors'][5]['error']
+        assert 'same gender' in result['errors'][6]['error']
+
+        assert Relatives.query.count() == 6
+        assert get_ancestors(db, 3) == [(2, 1), (1, 2)]
+        assert sorted(f.size for f in Family.query.all()) == [2, 3]
+
+    def test_import_skips_deleted_users(self, app, db):
+        from family_tree.services.imports import import_relatives
+        from family_tree.services.purge import soft_delete_user
+
+        family = TestAncestryService()
+        family.create_family(4)
+        family.add_parent(1, 2)
+        app.config['JOBS_EAGER'] = False
+        soft_delete_user(db, 1)
+
+        result = import_relatives(db, [
+            {'user_id': 4, 'relative_user_id': 1, 'relation_type': 'SPOUSE'},
+            # 1 and 3 are both men, but 1 is no longer 2's father
+            {'user_id': 2, 'relative_user_id': 3, 'relation_type': 'PARENT'}
+        ])
+        assert result == {'imported': 1, 'errors': [
+            {'row': 1, 'error': 'Relative 1 does not exist'}]}
+        assert Relatives.query.filter_by(user_id=4).count() == 0
+
+    def test_import_relatives_dry_run(self, db):
+        from family_tree.services.imports import import_relatives
+
+        TestAncestryService().create_family(2)
+        result = import_relatives(db, [{'user_id': 2, 'relative_user_id': 1, 'relation_type': 'PARENT'}],
+                                  dry_run=True)
+        assert result == {'imported': 1, 'errors': []}
+        assert Relatives.query.count() == 0
+
+
+GEDCOM_SAMPLE = b"""\xef\xbb\xbf0 HEAD
+1 GEDC
+2 VERS 7.0
+0 @I1@ INDI
+1 NAME John Paul /Smith/
+1 SEX M
+1 BIRT
+2 DATE 12 JAN 1950
+1 RESI
+2 ADDR 1 Main Street
+3 CITY Shillong
+3 STAE Meghalaya
+3 POST 793001
+3 CTRY India
+0 @I2@ INDI
+1 NAME Mary /Smith/
+2 GIVN Mary
+2 SURN Smith
+1 SEX F
+1 NOTE A very long
+2 CONC  note
+0 @I3@ INDI
+1 NAME Anna /Smith/
+1 SEX X
+1 BIRT
+2 DATE ABT 1980
+0 @I4@ INDI
+1 NAME Tom /Smith/
+1 SEX M
+0 @F1@ FAM
+1 HUSB @I1@
+1 WIFE @I2@
+1 CHIL @I3@
+1 CHIL @I4@
+1 MARR
+2 DATE 3 MAR 1975
+0 TRLR
+"""
+
+
+class TestGedcomService:
+    def test_parse_records(self, app):
+        import io
+        from family_tree.services.gedcom import iter_gedcom_lines, iter_gedcom_records
+
+        records = list(iter_gedcom_records(iter_gedcom_lines(io.BytesIO(GEDCOM_SAMPLE))))
+        assert [record['tag'] for record in records] == ['HEAD', 'INDI', 'INDI', 'INDI', 'INDI', 'FAM', 'TRLR']
+        note = [child for child in records[2]['children'] if child['tag'] == 'NOTE'][0]
+        assert note['tag'] == 'NOTE' and note['value'] == 'A very long note'
+
+    def test_import_and_export(self, db):
+        import io
+        from family_tree.models import Address, ImportantDates
+        from family_tree.services.ancestry import get_ancestors
+        from family_tree.services.gedcom import import_gedcom, iter_gedcom
+
+        result = import_gedcom(db, io.BytesIO(GEDCOM_SAMPLE), batch_size=2)
+        assert result == {'individuals': 4, 'families': 1, 'relations': 12, 'skipped': 0}
+
+        john = Person.query.filter_by(first_name='John').first()
+        anna = Person.query.filter_by(first_name='Anna').first()
+        assert john.middle_name == 'Paul' and john.last_name == 'Smith'
+        assert anna.gender == GenderEnum.OTHER
+        assert Address.query.filter_by(user_id=john.user_id).one().pin_code == 793001
+        assert {(d.user_id, d.date_type.value) for d in ImportantDates.query.all()} == {
+            (john.user_id, 'BIRTH'), (john.user_id, 'MARRIAGE'), (john.user_id + 1, 'MARRIAGE')}
+        assert Relatives.query.filter_by(user_id=anna.user_id, relation_type=RelativesTypeEnum.SIBLING).count() == 1
+        assert [ancestor for ancestor, _ in get_ancestors(db, anna.user_id)] == [john.user_id, john.user_id + 1]
+        assert db.session.get(User, anna.user_id).family.size == 4
+
+        exported = ''.join(iter_gedcom(db))
+        assert exported.startswith('0 HEAD\n') and exported.endswith('0 TRLR\n')
+        assert f'0 @I{john.user_id}@ INDI\n1 NAME John Paul /Smith/\n' in exported
+        assert '1 BIRT\n2 DATE 12 JAN 1950\n' in exported
+        assert '3 POST 793001\n' in exported
+        assert (f'0 @F1@ FAM\n1 HUSB @I{john.user_id}@\n1 WIFE @I{john.user_id + 1}@\n'
+                f'1 MARR\n2 DATE 3 MAR 1975\n1 CHIL @I{anna.user_id}@\n') in exported
+
+
+    def test_import_skips_invalid_relations(self, db):
+        import io
+        from family_tree.services.gedcom import import_gedcom
+
+        extra = (b"0 @I5@ INDI\n1 NAME Paul /Smith/\n1 SEX M\n"
+                 b"0 @F2@ FAM\n1 HUSB @I5@\n1 WIFE @I2@\n1 CHIL @I3@\n"
+                 b"0 @F3@ FAM\n1 HUSB @I3@\n1 CHIL @I1@\n0 TRLR\n")
+        result = import_gedcom(db, io.BytesIO(GEDCOM_SAMPLE.replace(b'0 TRLR\n', extra)))
+        # Mary has a spouse already, Anna two parents, and John cannot be Anna's child
+        assert result == {'individuals': 5, 'families': 3, 'relations': 12, 'skipped': 4}
+        for user in User.query.all():
+            parents = Relatives.query.filter_by(user_id=user.id, relation_type=RelativesTypeEnum.PARENT).count()
+            spouses = Relatives.query.filter_by(user_id=user.id, relation_type=RelativesTypeEnum.SPOUSE).count()
+            assert parents <= 2 and spouses <= 1
+        assert Relatives.query.count() == 12
+
+    def test_export_leaves_out_admins_and_deleted_users(self, db):
+        from datetime import datetime
+        from family_tree.services.gedcom import iter_gedcom
+
+        ancestry = TestAncestryService()
+        ancestry.create_family(4)
+        for parent_id, child_id in [(1, 2), (2, 3), (2, 4)]:
+            ancestry.add_parent(parent_id, child_id)
+        db.session.get(User, 1).is_admin = True
+        db.session.get(User, 3).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        exported = ''.join(iter_gedcom(db))
+        assert '0 @I2@ INDI' in exported and '0 @I4@ INDI' in exported
+        assert '@I1@' not in exported and '@I3@' not in exported
+        assert '0 @F1@ FAM\n1 WIFE @I2@\n1 CHIL @I4@\n' in exported
+
+class TestEventsService:
+    def test_upcoming_events(self, db):
+        from datetime import date
+        from family_tree.models import ImportantDates, ImportantDateTypeEnum
+        from family_tree.services.events import get_upcoming_events
+
+        ancestry = TestAncestryService()
+        ancestry.create_family(4)
+        ancestry.add_parent(1, 2)
+        ancestry.add_parent(2, 3)
+        dates = [
+            (1, ImportantDateTypeEnum.BIRTH, date(1950, 1, 3)),
+            (1, ImportantDateTypeEnum.MARRIAGE, date(1975, 6, 1)),
+            (2, ImportantDateTypeEnum.BIRTH, date(1980, 12, 30)),
+            (3, ImportantDateTypeEnum.BIRTH, date(2004, 2, 29)),
+            # Not related to user 2
+            (4, ImportantDateTypeEnum.BIRTH, date(1990, 12, 31)),
+        ]
+        for user_id, date_type, event_date in dates:
+            db.session.add(ImportantDates(user_id=user_id, date_type=date_type, date=event_date))
+        db.session.commit()
+        assert ImportantDates.query.filter_by(user_id=3).first().month_day == 229
+
+        events = get_upcoming_events(db, 2, today=date(2024, 12, 28), days=10)
+        assert [(e['user_id'], e['days_until'], e['relation']) for e in events] == [
+            (2, 2, None), (1, 6, 'PARENT')]
+        assert events[1]['years'] == 75 and events[1]['label'] == 'Birthday'
+
+        events = get_upcoming_events(db, 2, today=date(2025, 2, 20), days=30)
+        assert [(e['user_id'], e['next_date']) for e in events] == [(3, date(2025, 3, 1))]
+        assert get_upcoming_events(db, 2, today=date(2025, 5, 1), days=40, limit=1)[0]['label'] == 'Anniversary'
+
+    def test_events_without_month_day(self, db):
+        from datetime import date
+        from sqlalchemy import insert
+        from family_tree.models import ImportantDates, ImportantDateTypeEnum
+        from family_tree.services.events import backfill_month_days, get_upcoming_events
+
+        ancestry = TestAncestryService()
+        ancestry.create_family(2)
+        ancestry.add_parent(1, 2)
+        # Rows written before month_day existed
+        db.session.execute(insert(ImportantDates), [
+            {'user_id': 1, 'date_type': ImportantDateTypeEnum.BIRTH, 'date': date(1950, 1, 3)},
+            {'user_id': 2, 'date_type': ImportantDateTypeEnum.BIRTH, 'date': date(1980, 7, 1)}])
+        db.session.commit()
+        assert ImportantDates.query.filter(ImportantDates.month_day.isnot(None)).count() == 0
+        assert get_upcoming_events(db, 2, today=date(2024, 12, 28), days=10) == []
+
+        assert backfill_month_days(db) == 2
+        assert backfill_month_days(db) == 0
+        events = get_upcoming_events(db, 2, today=date(2024, 12, 28), days=10)
+        assert [(e['user_id'], e['days_until']) for e in events] == [(1, 6)]
+        assert len(get_upcoming_events(db, 2, days=365)) == 2
+
+
+class TestSnapshotService:
+    def test_snapshot_cache_and_invalidation(self, db):
+        from sqlalchemy import event
+        from family_tree.cursor import Cursor
+        from family_tree.models import Address
+        from family_tree.services.snapshot import get_user_snapshot
+
+        ancestry = TestAncestryService()
+        ancestry.create_family(2)
+        ancestry.add_parent(1, 2)
+        cursor = Cursor()
+
+        snapshot = get_user_snapshot(db, 2)
+        assert snapshot['person']['gender'] == GenderEnum.FEMALE
+        assert snapshot['relatives'][0]['first_name'] == 'First1'
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            assert get_user_snapshot(db, 2) == snapshot
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        assert statements == []
+
+        cursor.add(db, Address, user_id=2, is_permanent=True, first_line='1 Main Street',
+                   pin_code=793001, state='Meghalaya', country='India')
+        assert get_user_snapshot(db, 2)['addresses'][0]['pin_code'] == 793001
+
+        # A relative's name change reaches this user's relatives list
+        person = Person.query.filter_by(user_id=1).first()
+        cursor.update(db, Person, person.id, first_name='Renamed')
+        assert get_user_snapshot(db, 2)['relatives'][0]['first_name'] == 'Renamed'
+
+
+class TestJobService:
+    def test_eager_jobs(self, app, db):
+        from family_tree.jobs import enqueue, job, job_to_dict
+        from family_tree.models import Job, JobStatusEnum
+
+        calls = []
+
+        @job('test_flaky')
+        def flaky(db, progress, fail_times):
+            calls.append(1)
+            progress(0.5, 'Halfway')
+            if len(calls) <= fail_times:
+                raise RuntimeError('Temporary failure')
+            return {'calls': len(calls)}
+
+        app.config['JOBS_RETRY_DELAY'] = 0
+        flaky_job = enqueue(db, 'test_flaky', fail_times=1)
+        status = job_to_dict(flaky_job)
+        assert status['status'] == 'succeeded'
+        assert status['attempts'] == 2
+        assert status['result'] == {'calls': 2}
+        assert status['message'] == 'Halfway'
+
+        failed_job = enqueue(db, 'test_flaky', max_attempts=2, fail_times=10)
+        assert failed_job.status == JobStatusEnum.FAILED
+        assert failed_job.error == 'RuntimeError: Temporary failure'
+
+        assert enqueue(db, 'no_such_job').status == JobStatusEnum.FAILED
+        assert Job.query.count() == 3
+
+    def test_long_job_with_heartbeat_is_not_reclaimed(self, app, db):
+        from datetime import datetime, timedelta
+        from family_tree.jobs import claim_job, enqueue, job, run_job
+        from family_tree.models import Job, JobStatusEnum
+
+        claimed = []
+
+        @job('test_long')
+        def long_job(db, progress):
+            # Started long ago, but still reporting progress
+            current_job = Job.query.filter_by(name='test_long').one()
+            current_job.started_at = current_job.heartbeat_at = datetime.utcnow() - timedelta(hours=1)
+            db.session.commit()
+            progress(0.5, 'Still working')
+            claimed.append(claim_job(db, 'other'))
+            return 'done'
+
+        app.config['JOBS_EAGER'] = False
+        long_job_id = enqueue(db, 'test_long').id
+        assert claim_job(db, 'test') == long_job_id
+        assert run_job(db, long_job_id).status == JobStatusEnum.SUCCEEDED
+        assert claimed == [None]
+
+        # Without a heartbeat for JOBS_TIMEOUT the job is claimed again
+        stalled = enqueue(db, 'test_long')
+        assert claim_job(db, 'test') == stalled.id
+        stalled.heartbeat_at = datetime.utcnow() - timedelta(seconds=app.config['JOBS_TIMEOUT'] + 1)
+        db.session.commit()
+        assert claim_job(db, 'other') == stalled.id
+        assert db.session.get(Job, stalled.id).attempts == 2
+
+    def test_rebuild_graph_job(self, db):
+        import json
+        from family_tree.jobs import enqueue
+        from family_tree.models import Ancestry
+
+        ancestry = TestAncestryService()
+        ancestry.create_family(3)
+        ancestry.add_parent(1, 2)
+        ancestry.add_parent(2, 3)
+        db.session.query(Ancestry).delete()
+        db.session.commit()
+
+        rebuild_job = enqueue(db, 'rebuild_graph')
+        assert json.loads(rebuild_job.result)['families'] == 1
+        assert Ancestry.query.filter_by(ancestor_id=1, descendant_id=3).first().distance == 2
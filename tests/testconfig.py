@@ -1,6 +1,15 @@
-class TestConfig:
+from family_tree.config import Config
+
+
+class TestConfig(Config):
     TESTING = True
     WTF_CSRF_ENABLED = False
     SECRET_KEY = 'you-will-never-guess'
+    # Read/write routing is off in memory; TestRoutedRequests in
+    # test_app.py runs requests against a file database with it on
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    CACHE_TYPE = 'lru'
+    JINJA_BYTECODE_CACHE_DIR = None
+    JOBS_EAGER = True
+    GRAPH_INDEX_PATH = None